@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 import os
+import sys
+from typing import List
 
 from keystone_scim import VERSION, LOGO, InterceptHandler
 from keystone_scim.store.mongodb_store import set_up
@@ -30,11 +33,25 @@ from aiohttp_apispec import AiohttpApiSpec
 from keystone_scim.rest import get_error_handling_mw
 from keystone_scim.rest.user import get_user_routes
 from keystone_scim.rest.group import get_group_routes
+from keystone_scim.rest.export import get_export_routes
+from keystone_scim.rest.bulk import get_bulk_routes
+from keystone_scim.rest.service_provider_config import get_service_provider_config_routes
 from keystone_scim.security.authn import bearer_token_check
+from keystone_scim.store.caching_store import CachingStore
+from keystone_scim.util.bulk_export import RESOURCE_TYPES, export_resources
+from keystone_scim.util.bulk_import import DEFAULT_BATCH_SIZE, READERS, ImportProgress, import_resources
+from keystone_scim.util import json_codec, store_migration
 
 
 async def health(_: web.Request):
-    return web.json_response({"healthy": True})
+    return json_codec.json_response({"healthy": True})
+
+
+async def cache_metrics(_: web.Request):
+    metrics = {name: store.stats() for name, store in stores.impl.items() if isinstance(store, CachingStore)}
+    if stores.invalidation_bus is not None:
+        metrics["invalidation"] = {"changes": stores.invalidation_bus.changes}
+    return json_codec.json_response(metrics)
 
 
 async def root(_: web.Request):
@@ -45,7 +62,7 @@ async def print_logo(_logger):
     return [_logger.info(f" {ln}") for ln in LOGO.split("\n")]
 
 
-async def serve(port: int = 5001):
+async def set_up_store():
     if CONFIG.get("store.pg.host") is not None:
         postgresql_store.set_up_schema()
     elif CONFIG.get("store.mysql.host") is not None:
@@ -53,6 +70,12 @@ async def serve(port: int = 5001):
     elif CONFIG.get("store.mongo.host") or CONFIG.get("store.mongo.dsn"):
         await set_up()
 
+
+async def serve(port: int = 5001):
+    await set_up_store()
+    if stores.invalidation_bus is not None:
+        stores.invalidation_bus.start()
+
     error_handling_mw = await get_error_handling_mw()
 
     # Create a sub-app for the SCIM 2.0 API to handle authentication separately from docs:
@@ -61,6 +84,9 @@ async def serve(port: int = 5001):
     scim_api.middlewares.append(bearer_token_check)
     scim_api.add_routes(get_user_routes())
     scim_api.add_routes(get_group_routes())
+    scim_api.add_routes(get_export_routes())
+    scim_api.add_routes(get_bulk_routes())
+    scim_api.add_routes(get_service_provider_config_routes())
 
     # Append SCIM 2.0 API to root web app:
     app = web.Application()
@@ -76,6 +102,8 @@ async def serve(port: int = 5001):
     # Health/readiness probe endpoint:
     app.add_routes([web.get("/", root)])
     app.add_routes([web.get("/health", health)])
+    # Hit ratio of the store caches (empty if caching is disabled):
+    app.add_routes([web.get("/metrics/cache", cache_metrics)])
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -87,7 +115,111 @@ async def serve(port: int = 5001):
     await site.start()
 
 
+async def import_file(path: str, fmt: str, batch_size: int):
+    await set_up_store()
+    read = READERS[fmt]
+
+    def log_progress(progress: ImportProgress):
+        logger.info("Import progress: %s", progress)
+
+    if path == "-":
+        progress = await import_resources(
+            stores.get("users"), stores.get("groups"), read(sys.stdin), batch_size, log_progress
+        )
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            progress = await import_resources(
+                stores.get("users"), stores.get("groups"), read(f), batch_size, log_progress
+            )
+    logger.info("Import completed: %s", progress)
+
+
+async def export_file(path: str, resource_types: List[str], batch_size: int):
+    out = sys.stdout.buffer if path == "-" else open(path, "wb")
+
+    async def write(chunk: bytes):
+        out.write(chunk)
+
+    try:
+        exported = await export_resources(stores.get("users"), stores.get("groups"), write, resource_types, batch_size)
+    finally:
+        out.flush()
+        if out is not sys.stdout.buffer:
+            out.close()
+    logger.info("Export completed: %s", ", ".join(f"{n} {rt}" for rt, n in exported.items()))
+
+
+async def migrate_store(target_config: str, checkpoint_file: str, batch_size: int, concurrency: int,
+                        verify: bool = True, migrate: bool = True) -> bool:
+    await set_up_store()
+    source = (stores.get("users"), stores.get("groups"))
+    target = await store_migration.load_target_stores(target_config)
+    if migrate:
+        checkpoint = store_migration.Checkpoint(checkpoint_file)
+        created = await store_migration.migrate(source, target, checkpoint, batch_size, concurrency)
+        logger.info("Migration completed: %s", ", ".join(f"{n} {rt} created" for rt, n in created.items()))
+    if not verify:
+        return True
+    report = await store_migration.verify(source, target, batch_size)
+    for rt, res in report.items():
+        log = logger.info if res["match"] else logger.error
+        log("Verification of %s %s: source %s, target %s", rt, "passed" if res["match"] else "FAILED",
+            res["source"], res["target"])
+    return all([res["match"] for res in report.values()])
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="keystone-scim", description="Keystone SCIM 2.0 API")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="Run the SCIM 2.0 API (default)")
+    import_cmd = commands.add_parser("import", help="Bulk-load SCIM users and groups into the configured store")
+    import_cmd.add_argument("file", help="An NDJSON or CSV file of SCIM resources ('-' to read from stdin)")
+    import_cmd.add_argument("--format", dest="fmt", choices=sorted(READERS.keys()), default=None,
+                            help="The input format (inferred from the file extension by default)")
+    import_cmd.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="The number of resources written per bulk write")
+    export_cmd = commands.add_parser("export", help="Stream all SCIM users and groups as NDJSON")
+    export_cmd.add_argument("file", nargs="?", default="-", help="The output file (stdout by default)")
+    export_cmd.add_argument("--type", dest="resource_types", default=",".join(RESOURCE_TYPES),
+                            type=lambda v: v.lower().split(","), help="users, groups, or users,groups (default)")
+    export_cmd.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="The number of resources read and written at a time")
+    migrate_cmd = commands.add_parser("migrate", help="Copy all users and groups of the configured store into "
+                                                      "another store, and verify the copy")
+    migrate_cmd.add_argument("--target-config", required=True,
+                             help="A configuration file whose 'store' section describes the target store")
+    migrate_cmd.add_argument("--checkpoint", default=None,
+                             help="A file recording the migration's progress, to resume an interrupted migration")
+    migrate_cmd.add_argument("--batch-size", type=int, default=store_migration.DEFAULT_BATCH_SIZE,
+                             help="The number of resources written per bulk write")
+    migrate_cmd.add_argument("--concurrency", type=int, default=store_migration.DEFAULT_CONCURRENCY,
+                             help="The number of bulk writes in flight")
+    verification = migrate_cmd.add_mutually_exclusive_group()
+    verification.add_argument("--skip-verify", action="store_true", help="Skip the verification pass")
+    verification.add_argument("--verify-only", action="store_true", help="Only run the verification pass")
+    args = parser.parse_args(argv)
+    if args.command == "export" and not set(args.resource_types).issubset(RESOURCE_TYPES):
+        parser.error("--type must be users, groups, or users,groups")
+    if args.command == "import" and args.fmt is None:
+        args.fmt = "csv" if args.file.lower().endswith(".csv") else "ndjson"
+    return args
+
+
 def run() -> None:
+    args = parse_args()
+    if args.command in ("import", "export", "migrate"):
+        try:
+            if args.command == "import":
+                asyncio.run(import_file(args.file, args.fmt, args.batch_size))
+            elif args.command == "export":
+                asyncio.run(export_file(args.file, args.resource_types, args.batch_size))
+            elif not asyncio.run(migrate_store(args.target_config, args.checkpoint, args.batch_size,
+                                               args.concurrency, not args.skip_verify, not args.verify_only)):
+                exit(1)
+        except Exception:
+            logger.exception("The %s has failed", args.command)
+            exit(9)
+        exit(0)
     loop = asyncio.get_event_loop()
     try:
         logger.info("Running version %s of the API", VERSION)
@@ -10,7 +10,12 @@ class BaseResource(Schema):
     pass
 
 
-class ListQueryParams(Schema):
+class ProjectionQueryParams(Schema):
+    attributes = fields.Str()
+    excluded_attributes = fields.Str(attribute="excludedAttributes")
+
+
+class ListQueryParams(ProjectionQueryParams):
     start_index = fields.Str(attribute="startIndex", dump_default="1")
     count = fields.Str(attribute="count", dump_default="100")
     filter = fields.Str()
@@ -44,6 +49,7 @@ __all__ = [
     "ErrorResponse",
     "ListQueryParams",
     "ListResponse",
+    "ProjectionQueryParams",
     "DEFAULT_ERROR_SCHEMA",
     "DEFAULT_LIST_SCHEMA",
     "DEFAULT_PATCH_OP_SCHEMA",
@@ -0,0 +1,30 @@
+from marshmallow import fields, Schema, validate
+
+DEFAULT_BULK_REQUEST_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+DEFAULT_BULK_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkResponse"
+
+
+class BulkOperation(Schema):
+    method = fields.Str(required=True, validate=validate.OneOf(["POST", "PUT", "PATCH", "DELETE"]))
+    bulk_id = fields.Str(attribute="bulkId")
+    path = fields.Str(required=True)
+    data = fields.Dict()
+
+
+class BulkRequest(Schema):
+    schemas = fields.List(fields.Str, dump_default=[DEFAULT_BULK_REQUEST_SCHEMA])
+    fail_on_errors = fields.Int(attribute="failOnErrors")
+    operations = fields.List(fields.Nested(BulkOperation), attribute="Operations", required=True)
+
+
+class BulkOperationResult(Schema):
+    method = fields.Str(required=True)
+    bulk_id = fields.Str(attribute="bulkId")
+    location = fields.Str()
+    status = fields.Str(required=True)
+    response = fields.Dict()
+
+
+class BulkResponse(Schema):
+    schemas = fields.List(fields.Str, dump_default=[DEFAULT_BULK_RESPONSE_SCHEMA])
+    operations = fields.List(fields.Nested(BulkOperationResult), attribute="Operations")
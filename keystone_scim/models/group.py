@@ -7,6 +7,7 @@ DEFAULT_GROUP_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:Group"
 
 class GroupMember(Schema):
     value = fields.Str()
+    display = fields.Str()
 
 
 class OperationValue(Schema):
@@ -36,3 +37,11 @@ class ListGroupsResponse(ListResponse):
         attribute="Resources",
         dump_default=[]
     )
+
+
+class ListGroupMembersResponse(ListResponse):
+    resources = fields.List(
+        fields.Nested(GroupMember),
+        attribute="Resources",
+        dump_default=[]
+    )
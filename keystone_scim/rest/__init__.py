@@ -5,7 +5,11 @@ from pymysql.err import IntegrityError
 from pymongo.errors import DuplicateKeyError
 
 from keystone_scim.models import DEFAULT_ERROR_SCHEMA
-from keystone_scim.util.exc import ResourceNotFound, ResourceAlreadyExists, UnauthorizedRequest
+from keystone_scim.util.exc import InvalidPatchOperation, PreconditionFailed, ResourceNotFound, ResourceAlreadyExists, \
+    UnauthorizedRequest
+
+NOT_FOUND_ERRORS = (ResourceNotFound, CosmosResourceNotFoundError)
+CONFLICT_ERRORS = (IntegrityError, UniqueViolation, DuplicateKeyError, ResourceAlreadyExists)
 
 
 async def get_error_handling_mw():
@@ -14,14 +18,19 @@ async def get_error_handling_mw():
     await catcher.add_scenarios(
         *[sc.with_additional_fields(err_schemas) for sc in canned.AIOHTTP_SCENARIOS],
 
+        catch(InvalidPatchOperation).with_status_code(400).and_stringify().with_additional_fields(
+            {**err_schemas, "scimType": "invalidValue"}),
+
         catch(ResourceNotFound).with_status_code(404).and_stringify().with_additional_fields(err_schemas),
 
         catch(CosmosResourceNotFoundError).with_status_code(404).and_return(
             "Resource not found").with_additional_fields(err_schemas),
 
-        catch(IntegrityError, UniqueViolation, DuplicateKeyError, ResourceAlreadyExists).with_status_code(409).and_return(
+        catch(*CONFLICT_ERRORS).with_status_code(409).and_return(
             "Resource already exists").with_additional_fields(err_schemas),
 
+        catch(PreconditionFailed).with_status_code(412).and_stringify().with_additional_fields(err_schemas),
+
         catch(UnauthorizedRequest).with_status_code(401).and_return("Unauthorized request").with_additional_fields(
             err_schemas)
     )
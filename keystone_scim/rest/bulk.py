@@ -0,0 +1,252 @@
+import logging
+from typing import Dict, List, Optional, Tuple, Union
+
+from aiohttp import web
+from aiohttp_apispec import docs, request_schema
+
+from keystone_scim.models import DEFAULT_ERROR_SCHEMA, ErrorResponse
+from keystone_scim.models.bulk import BulkRequest, BulkResponse, DEFAULT_BULK_RESPONSE_SCHEMA
+from keystone_scim.rest import CONFLICT_ERRORS, NOT_FOUND_ERRORS
+from keystone_scim.rest.group import GroupPatch, coalesce_group_operations, get_group, get_max_members
+from keystone_scim.store import BaseStore, RDBMSStore
+from keystone_scim.util import json_codec
+from keystone_scim.util.config import Config
+from keystone_scim.util.exc import InvalidPatchOperation
+from keystone_scim.util.store_util import Stores
+
+LOGGER = logging.getLogger(__name__)
+CONFIG = Config()
+DEFAULT_MAX_OPERATIONS = 1000
+DEFAULT_MAX_PAYLOAD_SIZE = 1048576
+BULK_ID_PREFIX = "bulkId:"
+
+
+def get_bulk_limits() -> Tuple[int, int]:
+    """
+    :return: The maximum number of operations and the maximum payload size (in bytes) of a bulk request
+    """
+    return (
+        int(CONFIG.get("bulk.max_operations", DEFAULT_MAX_OPERATIONS)),
+        int(CONFIG.get("bulk.max_payload_size", DEFAULT_MAX_PAYLOAD_SIZE)),
+    )
+
+
+def _error(status: int, detail: str, scim_type: Optional[str] = None) -> Dict:
+    err = {"schemas": [DEFAULT_ERROR_SCHEMA], "detail": detail, "status": str(status)}
+    if scim_type:
+        err["scimType"] = scim_type
+    return err
+
+
+def _result(operation: Dict, status: int) -> Dict:
+    result = {"method": str(operation.get("method", "")).upper(), "status": str(status)}
+    if operation.get("bulkId") is not None:
+        result["bulkId"] = operation["bulkId"]
+    return result
+
+
+def _success(operation: Dict, status: int, location: str, resource: Optional[Dict] = None) -> Dict:
+    result = {**_result(operation, status), "location": location}
+    if resource is not None:
+        result["response"] = resource
+    return result
+
+
+def _failure(operation: Dict, status: int, detail: str, scim_type: Optional[str] = None) -> Dict:
+    return {**_result(operation, status), "response": _error(status, detail, scim_type)}
+
+
+def _too_large(detail: str) -> web.Response:
+    return json_codec.json_response(_error(413, detail), status=413)
+
+
+def _resolve_bulk_ids(value, bulk_ids: Dict[str, str], unresolved: set):
+    """
+    Replaces every "bulkId:<id>" reference in a (nested) value with the ID of the resource created by the
+    operation with that bulk ID, and collects the references that could not be resolved.
+    """
+    if isinstance(value, str) and value.startswith(BULK_ID_PREFIX):
+        bulk_id = value[len(BULK_ID_PREFIX):]
+        if bulk_id in bulk_ids:
+            return bulk_ids[bulk_id]
+        unresolved.add(bulk_id)
+        return value
+    if isinstance(value, dict):
+        return {k: _resolve_bulk_ids(v, bulk_ids, unresolved) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve_bulk_ids(v, bulk_ids, unresolved) for v in value]
+    return value
+
+
+def _parse_path(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    :return: The resource type ('Users' or 'Groups') and resource ID of an operation's path, e.g. '/Users/123'
+    """
+    parts = [p for p in (path or "").split("/") if p]
+    if len(parts) == 0 or parts[0] not in ("Users", "Groups") or len(parts) > 2:
+        return None, None
+    return parts[0], parts[1] if len(parts) == 2 else None
+
+
+def get_bulk_routes(_user_store: Union[BaseStore, RDBMSStore] = None,
+                    _group_store: Union[BaseStore, RDBMSStore] = None):
+    bulk_routes = web.RouteTableDef()
+    user_store: Union[BaseStore, RDBMSStore] = _user_store or Stores().get("users")
+    group_store: Union[BaseStore, RDBMSStore] = _group_store or Stores().get("groups")
+    stores = {"Users": user_store, "Groups": group_store}
+
+    @bulk_routes.view("/Bulk")
+    class BulkView(web.View):
+
+        def _location(self, resource_type: str, resource_id: str) -> str:
+            return f"{self.request.url.parent}/{resource_type}/{resource_id}"
+
+        async def _create_run(self, resource_type: str, operations: List[Dict]) -> List[Dict]:
+            """
+            Creates the resources of consecutive POST operations of the same resource type with a single
+            bulk write.
+            """
+            resources = []
+            for operation in operations:
+                resource = dict(operation.get("data") or {})
+                if resource_type == "Groups":
+                    resource["members"] = resource.get("members", [])
+                    if not resource.get("meta"):
+                        resource["meta"] = {"resourceType": "Group"}
+                resources.append(resource)
+            created_ids = await stores[resource_type].bulk_create(resources)
+            return [
+                _success(o, 201, self._location(resource_type, created_id)) if created_id
+                else _failure(o, 409, "Resource already exists", "uniqueness")
+                for o, created_id in zip(operations, created_ids)
+            ]
+
+        def _next_run(self, operations: List[Dict], index: int, bulk_ids: Dict[str, str],
+                      limit: Optional[int] = None) -> List[Dict]:
+            """
+            :param limit: The maximum number of operations of the run (if any)
+            :return:      The operation at 'index' (with its bulk ID references resolved), followed by the
+                          operations that can be applied along with it: consecutive creations of the same resource
+                          type, which don't reference each other, or consecutive patches of the same group.
+            """
+            operation = operations[index]
+            run = [{**operation, "data": _resolve_bulk_ids(operation.get("data"), bulk_ids, set())}]
+            resource_type, resource_id = _parse_path(operation.get("path"))
+            method = str(operation.get("method", "")).upper()
+            batched = (method == "POST" and resource_type and not resource_id) or \
+                      (method == "PATCH" and resource_type == "Groups" and resource_id)
+            for nxt in operations[index + 1:]:
+                if limit is not None and len(run) >= limit:
+                    break
+                unresolved = set()
+                data = _resolve_bulk_ids(nxt.get("data"), bulk_ids, unresolved)
+                if not batched or unresolved or nxt.get("path") != operation.get("path") or \
+                        str(nxt.get("method", "")).upper() != method:
+                    break
+                run.append({**nxt, "data": data})
+            return run
+
+        async def _patch_group_run(self, group_id: str, operations: List[Dict]) -> List[Dict]:
+            """
+            Applies consecutive patches of the same group at once. The PATCH operations of each bulk operation are
+            validated on their own, so that an invalid one only fails the bulk operation it belongs to.
+            """
+            patch = GroupPatch()
+            failures = {}
+            for i, operation in enumerate(operations):
+                try:
+                    patch = await coalesce_group_operations(
+                        group_store, user_store, group_id, (operation.get("data") or {}).get("Operations", []), patch
+                    )
+                except InvalidPatchOperation as e:
+                    failures[i] = _failure(operation, 400, str(e), "invalidValue")
+            if len(failures) == len(operations):
+                return list(failures.values())
+            _ = await patch.apply(group_store, group_id)
+            group, _ = await get_group(group_store, group_id, max_members=get_max_members())
+            return [
+                failures.get(i) or _success(o, 200, self._location("Groups", group_id), group)
+                for i, o in enumerate(operations)
+            ]
+
+        async def _apply_run(self, method: str, path: str, run: List[Dict]) -> List[Dict]:
+            resource_type, resource_id = _parse_path(path)
+            if resource_type is None:
+                return [_failure(o, 400, f"Invalid path: {path}", "invalidPath") for o in run]
+            try:
+                if method == "POST" and not resource_id:
+                    return await self._create_run(resource_type, run)
+                if method == "PATCH" and resource_type == "Groups" and resource_id:
+                    return await self._patch_group_run(resource_id, run)
+                store = stores[resource_type]
+                if method in ("PUT", "PATCH") and resource_id:
+                    resource = await store.update(resource_id, **(run[0].get("data") or {}))
+                    return [_success(run[0], 200, self._location(resource_type, resource_id), resource)]
+                if method == "DELETE" and resource_id:
+                    _ = await store.delete(resource_id)
+                    return [_success(run[0], 204, self._location(resource_type, resource_id))]
+                return [_failure(o, 400, f"Unsupported operation: {method} {path}", "invalidPath") for o in run]
+            except InvalidPatchOperation as e:
+                return [_failure(o, 400, str(e), "invalidValue") for o in run]
+            except NOT_FOUND_ERRORS as e:
+                return [_failure(o, 404, str(e) or "Resource not found") for o in run]
+            except CONFLICT_ERRORS:
+                return [_failure(o, 409, "Resource already exists", "uniqueness") for o in run]
+            except Exception as e:
+                LOGGER.exception("Bulk operation %s %s has failed", method, path)
+                return [_failure(o, 500, str(e)) for o in run]
+
+        @docs(
+            tags=["Bulk"],
+            summary="Apply bulk operations",
+            description="Applies a batch of operations on users and groups. Consecutive creations of the same "
+                        "resource type, and consecutive patches of the same group, are applied together",
+            responses={
+                200: {"description": "The result of each operation", "schema": BulkResponse},
+                413: {"description": "Too many operations or payload too large", "schema": ErrorResponse},
+            },
+        )
+        @request_schema(BulkRequest, strict=False)
+        async def post(self) -> web.Response:
+            max_operations, max_payload_size = get_bulk_limits()
+            payload = b""
+            if (self.request.content_length or 0) <= max_payload_size:
+                payload = await self.request.read()
+            if len(payload) > max_payload_size or (self.request.content_length or 0) > max_payload_size:
+                return _too_large(f"The payload exceeds the maximum size of {max_payload_size} bytes")
+            data: Dict = json_codec.loads(payload)
+            operations: List[Dict] = data.get("Operations") or []
+            if len(operations) > max_operations:
+                return _too_large(f"The number of operations exceeds the maximum of {max_operations}")
+            fail_on_errors = data.get("failOnErrors")
+
+            bulk_ids: Dict[str, str] = {}
+            results: List[Dict] = []
+            errors = 0
+            index = 0
+            while index < len(operations) and (not fail_on_errors or errors < fail_on_errors):
+                operation = operations[index]
+                method = str(operation.get("method", "")).upper()
+                unresolved = set()
+                path = _resolve_bulk_ids(operation.get("path"), bulk_ids, unresolved)
+                _ = _resolve_bulk_ids(operation.get("data"), bulk_ids, unresolved)
+                if unresolved:
+                    run = [operation]
+                    run_results = [_failure(operation, 409, f"Unresolved bulkId references: "
+                                                            f"{', '.join(sorted(unresolved))}", "invalidValue")]
+                else:
+                    # Each operation fails at most once, so a run of at most as many operations as the errors that
+                    # are still allowed never applies an operation after the last allowed error:
+                    limit = fail_on_errors - errors if fail_on_errors else None
+                    run = self._next_run(operations, index, bulk_ids, limit)
+                    run_results = await self._apply_run(method, path, run)
+                index += len(run)
+                for result in run_results:
+                    if result["status"] == "201" and result.get("bulkId") is not None:
+                        bulk_ids[result["bulkId"]] = result["location"].rsplit("/", 1)[-1]
+                    if int(result["status"]) >= 400:
+                        errors += 1
+                results.extend(run_results)
+            return json_codec.json_response({"schemas": [DEFAULT_BULK_RESPONSE_SCHEMA], "Operations": results})
+
+    return bulk_routes
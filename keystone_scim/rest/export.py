@@ -0,0 +1,47 @@
+import logging
+from typing import Union
+
+from aiohttp import web
+from aiohttp_apispec import docs
+
+from keystone_scim.models import ErrorResponse
+from keystone_scim.store import BaseStore, RDBMSStore
+from keystone_scim.util.bulk_export import RESOURCE_TYPES, export_resources
+from keystone_scim.util.store_util import Stores
+
+LOGGER = logging.getLogger(__name__)
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def get_export_routes(_user_store: Union[BaseStore, RDBMSStore] = None,
+                      _group_store: Union[BaseStore, RDBMSStore] = None):
+    export_routes = web.RouteTableDef()
+    user_store: Union[BaseStore, RDBMSStore] = _user_store or Stores().get("users")
+    group_store: Union[BaseStore, RDBMSStore] = _group_store or Stores().get("groups")
+
+    @export_routes.view("/Export")
+    class ExportView(web.View):
+
+        @docs(
+            tags=["Export"],
+            summary="Export users and groups",
+            description="Streams all users and/or groups (query parameter 'resourceType', comma-separated) as "
+                        "newline-delimited JSON",
+            produces=[NDJSON_CONTENT_TYPE],
+            responses={
+                200: {"description": "One SCIM resource per line"},
+                400: {"description": "Invalid resource type", "schema": ErrorResponse},
+            },
+        )
+        async def get(self) -> web.StreamResponse:
+            resource_types = self.request.query.get("resourceType", ",".join(RESOURCE_TYPES)).lower().split(",")
+            if not set(resource_types).issubset(RESOURCE_TYPES):
+                raise web.HTTPBadRequest(reason="resourceType must be one of: users, groups")
+            response = web.StreamResponse(headers={"Content-Type": NDJSON_CONTENT_TYPE})
+            await response.prepare(self.request)
+            exported = await export_resources(user_store, group_store, response.write, resource_types)
+            LOGGER.info("Exported %s", exported)
+            await response.write_eof()
+            return response
+
+    return export_routes
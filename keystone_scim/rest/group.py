@@ -1,7 +1,7 @@
-import asyncio
-from typing import Dict, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
+import copy
 import logging
-import sys
+import re
 
 from aiohttp import web
 from aiohttp_apispec import (
@@ -10,12 +10,228 @@ from aiohttp_apispec import (
     querystring_schema,
 )
 
-from keystone_scim.models import ListQueryParams, ErrorResponse, DEFAULT_LIST_SCHEMA
-from keystone_scim.models.group import Group, PatchGroupOp, ListGroupsResponse
-from keystone_scim.store import BaseStore, RDBMSStore, DocumentStore, DatabaseStore
+from keystone_scim.models import ListQueryParams, ErrorResponse, DEFAULT_LIST_SCHEMA, ProjectionQueryParams
+from keystone_scim.models.group import Group, PatchGroupOp, ListGroupsResponse, ListGroupMembersResponse
+from keystone_scim.store import BaseStore, RDBMSStore
+from keystone_scim.util import json_codec
+from keystone_scim.util.config import Config
+from keystone_scim.util.etag import etag_headers, etag_matches, if_match_version
+from keystone_scim.util.exc import InvalidPatchOperation
+from keystone_scim.util.projection import Projection, parse_attribute_list
 from keystone_scim.util.store_util import Stores
 
+CONFIG = Config()
 LOGGER = logging.getLogger(__name__)
+DEFAULT_MAX_MEMBERS = 1000
+MEMBERS_FILTER_PATH = re.compile(r"^members\[(.+)\]$", re.IGNORECASE)
+MEMBER_ID_FILTER = re.compile(r'^\s*value\s+eq\s+"(?P<id>[^"]+)"\s*$', re.IGNORECASE)
+
+
+def get_max_members() -> int:
+    """
+    :return: The maximum number of members returned with a group (0 for no limit). The remaining members are
+             read from the '/Groups/{group_id}/members' endpoint.
+    """
+    return int(CONFIG.get("groups.max_members", DEFAULT_MAX_MEMBERS))
+
+
+def _is_members_attribute(attribute: str) -> bool:
+    return attribute.lower().rsplit(":", 1)[-1].split(".")[0] == "members"
+
+
+async def get_group(group_store: Union[BaseStore, RDBMSStore],
+                    group_id: str,
+                    attributes: Optional[List[str]] = None,
+                    excluded_attributes: Optional[List[str]] = None,
+                    max_members: int = 0) -> Tuple[Dict, int]:
+    """
+    Reads a group, with at most 'max_members' of its members (0 for all of them), which are read as a page
+    rather than aggregated along with the group.
+
+    :return: The group, and its total number of members
+    """
+    projection = Projection(attributes, excluded_attributes)
+    if max_members <= 0 or not projection.includes("members"):
+        group = await group_store.get_by_id(group_id, attributes, excluded_attributes)
+        return group, len(group.get("members") or [])
+    if attributes:
+        group = await group_store.get_by_id(
+            group_id, attributes=[a for a in attributes if not _is_members_attribute(a)] or ["id"]
+        )
+    else:
+        group = await group_store.get_by_id(
+            group_id, excluded_attributes=(excluded_attributes or []) + ["members"]
+        )
+    members, total = await group_store.get_members(group_id, start_index=1, count=max_members)
+    group["members"] = projection.apply({"members": members})["members"]
+    return group, total
+
+
+class GroupPatch:
+    """
+    The net effect of the operations of a group PATCH request, which is applied to the store at once. Member
+    additions and removals are netted out per member, so that only the last change of each member is applied.
+    """
+
+    def __init__(self):
+        self.attributes: Dict = {}
+        # The members replacing the current ones, if any; later additions and removals apply to them:
+        self.members: Optional[Dict[str, Dict]] = None
+        self.members_to_add: Dict[str, Dict] = {}
+        self.member_ids_to_remove: Set[str] = set()
+
+    def replace_members(self, members: List[Dict]):
+        self.members = {m.get("value"): m for m in members}
+        self.members_to_add = {}
+        self.member_ids_to_remove = set()
+
+    def add_members(self, members: List[Dict]):
+        for member in members:
+            member_id = member.get("value")
+            if self.members is not None:
+                self.members[member_id] = member
+            else:
+                self.member_ids_to_remove.discard(member_id)
+                self.members_to_add[member_id] = member
+
+    def remove_members(self, member_ids: List[str]):
+        for member_id in member_ids:
+            if self.members is not None:
+                self.members.pop(member_id, None)
+            else:
+                self.members_to_add.pop(member_id, None)
+                self.member_ids_to_remove.add(member_id)
+
+    async def apply(self, group_store: Union[BaseStore, RDBMSStore], group_id: str,
+                    expected_version: Optional[str] = None):
+        _ = await group_store.patch_group(
+            group_id,
+            attributes=self.attributes,
+            members_to_add=list(self.members_to_add.values()),
+            member_ids_to_remove=sorted(self.member_ids_to_remove),
+            members=list(self.members.values()) if self.members is not None else None,
+            expected_version=expected_version,
+        )
+
+
+def _validate_members(operation: Dict, members) -> List[Dict]:
+    if not isinstance(members, list) or not all(isinstance(m, dict) and m.get("value") for m in members):
+        raise InvalidPatchOperation(operation, "'value' must be a list of members with a 'value' attribute")
+    return members
+
+
+async def _select_members(group_store: Union[BaseStore, RDBMSStore],
+                          user_store: Union[BaseStore, RDBMSStore],
+                          group_id: str,
+                          op_type: str,
+                          _filter: str) -> List[Dict]:
+    """
+    :return: The members selected by the filter of a 'members[...]' path: members of the group for removals,
+             and users for additions
+    """
+    member_id = MEMBER_ID_FILTER.match(_filter)
+    if op_type == "remove" and member_id:
+        # Removing a member that isn't in the group is a no-op, so the filter needn't be looked up:
+        return [{"value": member_id.group("id")}]
+    if op_type == "remove":
+        return await group_store.search_members(_filter=_filter, group_id=group_id)
+    users, _ = await user_store.search(_filter=_filter.replace("value", "id"))
+    return [{"value": u.get("id"), "display": u.get("userName")} for u in users]
+
+
+async def coalesce_group_operations(group_store: Union[BaseStore, RDBMSStore],
+                                    user_store: Union[BaseStore, RDBMSStore],
+                                    group_id: str,
+                                    operations: List[Dict],
+                                    patch: Optional[GroupPatch] = None) -> GroupPatch:
+    """
+    Validates the operations of a group PATCH request, and coalesces them into their net effect (after the
+    effect of 'patch', if given, which is left as it is). Nothing is written to the store, so an invalid
+    operation fails the request as a whole. Scenarios:
+
+    1. Patch group metadata: replace operation without a path.
+        {
+            "op": "replace",
+            "value": {
+                "id": "abf4dd94-a4c0-4f67-89c9-76b03340cb9b",
+                "displayName": "Test SCIMv2"
+            }
+        }
+    2. Add or remove members with a path
+        {
+            "op": "{add, remove}",
+            "path": "members[value eq "89bb1940-b905-4575-9e7f-6f887cfb368e"]"
+        }
+    3. Add or remove a list of members with a "members" path and values list:
+        {
+            "op": "{add, remove}",
+            "path": "members",
+            "value": [{
+                "value": "23a35c27-23d3-4c03-b4c5-6443c09e7173",
+                "display": "test.user@company.com"
+            }]
+        }
+    4. Override the entire list of members with "replace" op and "members" path:
+        {
+            "op": "replace",
+            "path": "members",
+            "value": [
+                {
+                    "value": "23a35c27-23d3-4c03-b4c5-6443c09e7173",
+                    "display": "test.user@okta.local"
+                },
+                {
+                    "value": "89bb1940-b905-4575-9e7f-6f887cfb368e",
+                    "display": "test.user@okta.local"
+                }
+            ]
+        }
+    """
+    patch = copy.deepcopy(patch) if patch is not None else GroupPatch()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise InvalidPatchOperation(operation, "operations must be objects")
+        op_type = str(operation.get("op", "")).lower()
+        op_value = operation.get("value")
+        op_path = operation.get("path")
+        if op_type not in ("add", "remove", "replace"):
+            raise InvalidPatchOperation(operation, "'op' must be one of 'add', 'remove' or 'replace'")
+        members_filter = MEMBERS_FILTER_PATH.match(op_path or "")
+
+        if not op_path:
+            if op_type == "remove" or not isinstance(op_value, dict):
+                raise InvalidPatchOperation(operation, "'value' must be an object with the attributes to patch")
+            if "members" in op_value:
+                members = _validate_members(operation, op_value["members"])
+                if op_type == "replace":
+                    patch.replace_members(members)
+                else:
+                    patch.add_members(members)
+            patch.attributes.update({k: v for k, v in op_value.items() if k not in ("id", "members")})
+        elif op_path.lower() == "members":
+            if op_type == "remove" and op_value is None:
+                patch.replace_members([])
+                continue
+            members = _validate_members(operation, op_value)
+            if op_type == "replace":
+                patch.replace_members(members)
+            elif op_type == "add":
+                patch.add_members(members)
+            else:
+                patch.remove_members([m.get("value") for m in members])
+        elif members_filter:
+            if op_type == "replace" or op_value:
+                raise InvalidPatchOperation(operation, "members selected by a filter can only be added or removed")
+            members = await _select_members(group_store, user_store, group_id, op_type, members_filter.group(1))
+            if op_type == "add":
+                patch.add_members(members)
+            else:
+                patch.remove_members([m.get("value") for m in members])
+        elif op_type == "remove" or op_path == "id":
+            raise InvalidPatchOperation(operation, f"'{op_path}' can't be removed or replaced")
+        else:
+            patch.attributes[op_path] = op_value
+    return patch
 
 
 def get_group_routes(_group_store: Union[BaseStore, RDBMSStore] = None,
@@ -30,16 +246,42 @@ def get_group_routes(_group_store: Union[BaseStore, RDBMSStore] = None,
         @docs(
             tags=["Groups"],
             summary="Get a group",
-            description="Returns a specific group by ID",
+            description="Returns a specific group by ID, unless its version matches the 'If-None-Match' header",
             responses={
                 200: {"description": "Group search results", "schema": Group},
+                304: {"description": "Group not modified"},
                 404: {"description": "Group not found", "schema": ErrorResponse}
             },
         )
+        @querystring_schema(ProjectionQueryParams)
         async def get(self) -> web.Response:
+            # Clients holding the current version only need its entity tag, which is read without the group
+            # and its members:
+            if_none_match = self.request.headers.get("If-None-Match")
+            if if_none_match:
+                version = await group_store.get_version(self.request.match_info["group_id"])
+                if etag_matches(if_none_match, version):
+                    return web.Response(status=304, headers={"ETag": version})
+            return await self._group_response()
+
+        async def _group_response(self) -> web.Response:
+            # Large groups are trimmed to the first page of their members, and the response headers point to
+            # the members endpoint:
             group_id = self.request.match_info["group_id"]
-            group = await group_store.get_by_id(resource_id=group_id)
-            return web.json_response(group)
+            max_members = get_max_members()
+            group, total_members = await get_group(
+                group_store,
+                group_id,
+                attributes=parse_attribute_list(self.request.query.get("attributes")),
+                excluded_attributes=parse_attribute_list(self.request.query.get("excludedAttributes")),
+                max_members=max_members,
+            )
+            headers = etag_headers(group)
+            if len(group.get("members") or []) < total_members:
+                headers["X-Total-Members"] = str(total_members)
+                headers["Link"] = f'<{self.request.url.parent.path}/{group_id}/members' \
+                                  f'?startIndex={max_members + 1}&count={max_members}>; rel="next"'
+            return json_codec.json_response(group, headers=headers)
 
         @docs(
             tags=["Groups"],
@@ -47,147 +289,68 @@ def get_group_routes(_group_store: Union[BaseStore, RDBMSStore] = None,
             description="Deletes a specific group by ID",
             responses={
                 200: {"description": "Group deleted successfully"},
-                404: {"description": "Group not found", "schema": ErrorResponse}
+                404: {"description": "Group not found", "schema": ErrorResponse},
+                412: {"description": "Group modified since the 'If-Match' version", "schema": ErrorResponse}
             },
         )
         async def delete(self) -> web.Response:
             group_id = self.request.match_info["group_id"]
-            _ = await group_store.delete(group_id)
-            return web.json_response({})
-
-        async def _execute_group_operation(self, operation: Dict) -> Dict:
-            """
-            Scenarios:
-
-            1. Patch group metadata: replace operation without a path.
-                {
-                    "op": "replace",
-                    "value": {
-                        "id": "abf4dd94-a4c0-4f67-89c9-76b03340cb9b",
-                        "displayName": "Test SCIMv2"
-                    }
-                }
-            2. Add or remove members with a path
-                {
-                    "op": "{add, remove}",
-                    "path": "members[value eq "89bb1940-b905-4575-9e7f-6f887cfb368e"]"
-                }
-            3. Add or remove a list of members with a "members" path and values list:
-                {
-                    "op": "{add, remove}",
-                    "path": "members",
-                    "value": [{
-                        "value": "23a35c27-23d3-4c03-b4c5-6443c09e7173",
-                        "display": "test.user@company.com"
-                    }]
-                }
-            4. Override the entire list of members with "replace" op and "members" path:
-                {
-                    "op": "replace",
-                    "path": "members",
-                    "value": [
-                        {
-                            "value": "23a35c27-23d3-4c03-b4c5-6443c09e7173",
-                            "display": "test.user@okta.local"
-                        },
-                        {
-                            "value": "89bb1940-b905-4575-9e7f-6f887cfb368e",
-                            "display": "test.user@okta.local"
-                        }
-                    ]
-                }
-            """
-            is_dbs = isinstance(group_store, DatabaseStore)
-            is_rdbmss = isinstance(group_store, RDBMSStore)
-            is_docs = isinstance(group_store, DocumentStore)
-            group_id = self.request.match_info["group_id"]
-            if hasattr(group_store, "resource_db"):
-                group = group_store.resource_db[group_id]
-            else:
-                group = await group_store.get_by_id(group_id)
-            op_type = operation.get("op")
-            op_value = operation.get("value")
-            op_path = operation.get("path")
-
-            if op_type == "replace" and not op_path:
-                # Patch group metadata: replace operation without a path
-                return await group_store.update(group_id, **op_value)
-            if op_path and op_path.startswith("members[") and not op_value:
-                # Remove members with a path:
-                _filter = op_path.strip("members[").strip("]")
-                if is_dbs:
-                    if op_type == "remove":
-                        if is_rdbmss:
-                            selected_members = await group_store.search_members(
-                                _filter=_filter, group_id=group_id
-                            )
-                            _ = await group_store.remove_users_from_group(
-                                user_ids=[m.get("id") for m in selected_members], group_id=group_id
-                            )
-                        else:
-                            _filter = _filter.replace("value", "id").replace("display", "userName")
-                            u, _ = await user_store.search(_filter=_filter)
-                            _ = await group_store.remove_users_from_group(
-                                user_ids=[m.get("id") for m in u], group_id=group_id
-                            )
-                    elif op_type == "add":
-                        selected_members, _ = await user_store.search(_filter=_filter.replace("value", "id"))
-                        for m in selected_members:
-                            _ = await group_store.add_user_to_group(
-                                user_id=m.get("id"), group_id=group_id
-                            )
-                    return group
-                else:
-                    selected_members, _ = await group["members_store"].search(
-                        _filter=_filter,
-                        start_index=1,
-                        count=sys.maxsize
-                    )
-                    for member in selected_members:
-                        if op_type == "remove":
-                            _ = await group["members_store"].delete(member.get("value"))
-                        return group
-            if op_path == "members" and op_type == "replace" and op_value:
-                if is_dbs:
-                    _ = await group_store.set_group_members(users=op_value, group_id=group_id)
-                    return group
-                else:
-                    return await group_store.update(group_id, **{"members": op_value})
-            if op_path == "members" and op_value:
-                for member in op_value:
-                    member_id = member.get("value")
-                    if is_dbs:
-                        if op_type == "add":
-                            _ = await group_store.add_user_to_group(member.get("value"), group_id)
-                        elif op_type == "remove":
-                            _ = await group_store.remove_users_from_group([member.get("value")], group_id)
-                    else:
-                        if op_type == "add":
-                            await group["members_store"].create(member)
-                        elif op_type == "remove":
-                            await group["members_store"].delete(member_id)
-                return group
-
-            return {}
+            expected_version = await if_match_version(group_store, "Group", group_id, self.request.headers)
+            _ = await group_store.delete(group_id, expected_version=expected_version)
+            return json_codec.json_response({})
 
         @docs(
             tags=["Groups"],
             summary="Patch a group",
-            description="Patch a specific group by ID (partial update)",
+            description="Patch a specific group by ID (partial update). The patched group isn't returned "
+                        "when the request has a 'Prefer: return=minimal' header",
             responses={
                 200: {"description": "Group patched successfully"},
-                404: {"description": "Group not found", "schema": ErrorResponse}
+                204: {"description": "Group patched successfully (minimal response)"},
+                400: {"description": "Invalid patch operation", "schema": ErrorResponse},
+                404: {"description": "Group not found", "schema": ErrorResponse},
+                412: {"description": "Group modified since the 'If-Match' version", "schema": ErrorResponse}
             },
         )
         @request_schema(PatchGroupOp, strict=False)
+        @querystring_schema(ProjectionQueryParams)
         async def patch(self) -> web.Response:
-            data: Dict = await self.request.json()
-            operations = data.get("Operations")
-            group = {}
-            for operation in operations:
-                group = await self._execute_group_operation(operation)
-            group = await group_store.get_by_id(group["id"])
-            return web.json_response(group)
+            data: Dict = await json_codec.read_json(self.request)
+            group_id = self.request.match_info["group_id"]
+            expected_version = await if_match_version(group_store, "Group", group_id, self.request.headers)
+            # The operations are validated and coalesced first, then applied with a single store call (which is
+            # conditioned on the 'If-Match' version, if any):
+            patch = await coalesce_group_operations(group_store, user_store, group_id, data.get("Operations") or [])
+            _ = await patch.apply(group_store, group_id, expected_version)
+            if "return=minimal" in self.request.headers.get("Prefer", ""):
+                return web.Response(status=204)
+            return await self._group_response()
+
+    @group_routes.view("/Groups/{group_id}/members")
+    class GroupMembersView(web.View):
+
+        @docs(
+            tags=["Groups"],
+            summary="Get the members of a group",
+            description="Returns a page of the members of a specific group, ordered by their ID",
+            responses={
+                200: {"description": "Group members", "schema": ListGroupMembersResponse},
+                404: {"description": "Group not found", "schema": ErrorResponse}
+            },
+        )
+        @querystring_schema(ListQueryParams)
+        async def get(self) -> web.Response:
+            group_id = self.request.match_info["group_id"]
+            start_index = max(int(self.request.query.get("startIndex", "1")), 1)
+            items_per_page = max(int(self.request.query.get("count", "100")), 0)
+            members, total_results = await group_store.get_members(group_id, start_index, items_per_page)
+            return json_codec.json_response({
+                "schemas": [DEFAULT_LIST_SCHEMA],
+                "startIndex": start_index,
+                "totalResults": total_results,
+                "itemsPerPage": len(members),
+                "Resources": members,
+            })
 
     @group_routes.view("/Groups")
     class GroupsView(web.View):
@@ -209,11 +372,13 @@ def get_group_routes(_group_store: Union[BaseStore, RDBMSStore] = None,
                 _filter=self.request.query.get("filter"),
                 start_index=start_index,
                 count=items_per_page,
+                attributes=parse_attribute_list(self.request.query.get("attributes")),
+                excluded_attributes=parse_attribute_list(self.request.query.get("excludedAttributes")),
             )
             for g in groups:
                 if "member_ids" in g:
                     del g["member_ids"]
-            return web.json_response({
+            return json_codec.json_response({
                 "schemas": [DEFAULT_LIST_SCHEMA],
                 "startIndex": start_index,
                 "totalResults": total_results,
@@ -232,11 +397,11 @@ def get_group_routes(_group_store: Union[BaseStore, RDBMSStore] = None,
         )
         @request_schema(Group, strict=True)
         async def post(self) -> web.Response:
-            group: Dict = await self.request.json()
+            group: Dict = await json_codec.read_json(self.request)
             group["members"] = group.get("members", [])
             if not group.get("meta"):
                 group["meta"] = {"resourceType": "Group"}
             new_group = await group_store.create(group)
-            return web.json_response(new_group, status=201)
+            return json_codec.json_response(new_group, status=201, headers=etag_headers(new_group))
 
     return group_routes
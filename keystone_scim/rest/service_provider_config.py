@@ -0,0 +1,46 @@
+from aiohttp import web
+from aiohttp_apispec import docs
+
+from keystone_scim.rest.bulk import get_bulk_limits
+from keystone_scim.util import json_codec
+
+DEFAULT_SERVICE_PROVIDER_CONFIG_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"
+
+
+def get_service_provider_config_routes():
+    spc_routes = web.RouteTableDef()
+
+    @spc_routes.view("/ServiceProviderConfig")
+    class ServiceProviderConfigView(web.View):
+
+        @docs(
+            tags=["ServiceProviderConfig"],
+            summary="Get the service provider configuration",
+            description="Returns the SCIM features supported by the API",
+            responses={
+                200: {"description": "The service provider configuration"},
+            },
+        )
+        async def get(self) -> web.Response:
+            max_operations, max_payload_size = get_bulk_limits()
+            return json_codec.json_response({
+                "schemas": [DEFAULT_SERVICE_PROVIDER_CONFIG_SCHEMA],
+                "patch": {"supported": True},
+                "bulk": {
+                    "supported": True,
+                    "maxOperations": max_operations,
+                    "maxPayloadSize": max_payload_size,
+                },
+                "filter": {"supported": True, "maxResults": 100},
+                "changePassword": {"supported": False},
+                "sort": {"supported": False},
+                "etag": {"supported": True},
+                "authenticationSchemes": [{
+                    "type": "oauthbearertoken",
+                    "name": "OAuth Bearer Token",
+                    "description": "Authentication with a bearer token",
+                }],
+                "meta": {"resourceType": "ServiceProviderConfig"},
+            })
+
+    return spc_routes
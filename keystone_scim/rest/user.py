@@ -8,9 +8,13 @@ from aiohttp_apispec import (
     querystring_schema, headers_schema,
 )
 
-from keystone_scim.models import ListQueryParams, ErrorResponse, DEFAULT_LIST_SCHEMA, AuthHeaders
+from keystone_scim.models import ListQueryParams, ErrorResponse, DEFAULT_LIST_SCHEMA, AuthHeaders, \
+    ProjectionQueryParams
 from keystone_scim.models.user import User, ListUsersResponse
 from keystone_scim.store import BaseStore, RDBMSStore
+from keystone_scim.util import json_codec
+from keystone_scim.util.etag import etag_headers, etag_matches, if_match_version
+from keystone_scim.util.projection import parse_attribute_list
 from keystone_scim.util.store_util import Stores
 
 LOGGER = logging.getLogger(__name__)
@@ -26,16 +30,28 @@ def get_user_routes(_user_store: BaseStore = None):
         @docs(
             tags=["Users"],
             summary="Get a user",
-            description="Returns a specific user by ID",
+            description="Returns a specific user by ID, unless its version matches the 'If-None-Match' header",
             responses={
                 200: {"description": "User search results", "schema": User},
+                304: {"description": "User not modified"},
                 404: {"description": "User not found", "schema": ErrorResponse}
             },
         )
+        @querystring_schema(ProjectionQueryParams)
         async def get(self) -> web.Response:
             user_id = self.request.match_info["user_id"]
-            user = await user_store.get_by_id(resource_id=user_id)
-            return web.json_response(user)
+            # Clients holding the current version only need its entity tag, which is read without the user:
+            if_none_match = self.request.headers.get("If-None-Match")
+            if if_none_match:
+                version = await user_store.get_version(user_id)
+                if etag_matches(if_none_match, version):
+                    return web.Response(status=304, headers={"ETag": version})
+            user = await user_store.get_by_id(
+                resource_id=user_id,
+                attributes=parse_attribute_list(self.request.query.get("attributes")),
+                excluded_attributes=parse_attribute_list(self.request.query.get("excludedAttributes")),
+            )
+            return json_codec.json_response(user, headers=etag_headers(user))
 
         @docs(
             tags=["Users"],
@@ -43,13 +59,15 @@ def get_user_routes(_user_store: BaseStore = None):
             description="Deletes a specific user by ID",
             responses={
                 200: {"description": "User deleted/deactivated successfully"},
-                404: {"description": "User not found", "schema": ErrorResponse}
+                404: {"description": "User not found", "schema": ErrorResponse},
+                412: {"description": "User modified since the 'If-Match' version", "schema": ErrorResponse}
             },
         )
         async def delete(self) -> web.Response:
             user_id = self.request.match_info["user_id"]
-            _ = await user_store.delete(user_id)
-            return web.json_response({})
+            expected_version = await if_match_version(user_store, "User", user_id, self.request.headers)
+            _ = await user_store.delete(user_id, expected_version=expected_version)
+            return json_codec.json_response({})
 
         @docs(
             tags=["Users"],
@@ -57,15 +75,17 @@ def get_user_routes(_user_store: BaseStore = None):
             description="Patch a specific user by ID (partial update)",
             responses={
                 200: {"description": "User patched successfully", "schema": User},
-                404: {"description": "User not found", "schema": ErrorResponse}
+                404: {"description": "User not found", "schema": ErrorResponse},
+                412: {"description": "User modified since the 'If-Match' version", "schema": ErrorResponse}
             },
         )
         @request_schema(User(), strict=False)
         async def patch(self) -> web.Response:
             user_id = self.request.match_info["user_id"]
-            data: Dict = await self.request.json()
-            user = await user_store.update(resource_id=user_id, **data)
-            return web.json_response(user)
+            data: Dict = await json_codec.read_json(self.request)
+            expected_version = await if_match_version(user_store, "User", user_id, self.request.headers)
+            user = await user_store.update(resource_id=user_id, expected_version=expected_version, **data)
+            return json_codec.json_response(user, headers=etag_headers(user))
 
         @docs(
             tags=["Users"],
@@ -73,15 +93,17 @@ def get_user_routes(_user_store: BaseStore = None):
             description="Update a specific user by ID",
             responses={
                 200: {"description": "User updated successfully", "schema": User},
-                404: {"description": "User not found", "schema": ErrorResponse}
+                404: {"description": "User not found", "schema": ErrorResponse},
+                412: {"description": "User modified since the 'If-Match' version", "schema": ErrorResponse}
             },
         )
         @request_schema(User(), strict=False)
         async def put(self) -> web.Response:
             user_id = self.request.match_info["user_id"]
-            data: Dict = await self.request.json()
-            user = await user_store.update(resource_id=user_id, **data)
-            return web.json_response(user)
+            data: Dict = await json_codec.read_json(self.request)
+            expected_version = await if_match_version(user_store, "User", user_id, self.request.headers)
+            user = await user_store.update(resource_id=user_id, expected_version=expected_version, **data)
+            return json_codec.json_response(user, headers=etag_headers(user))
 
 
     @user_routes.view("/Users")
@@ -105,8 +127,10 @@ def get_user_routes(_user_store: BaseStore = None):
                 _filter=self.request.query.get("filter"),
                 start_index=start_index,
                 count=items_per_page,
+                attributes=parse_attribute_list(self.request.query.get("attributes")),
+                excluded_attributes=parse_attribute_list(self.request.query.get("excludedAttributes")),
             )
-            return web.json_response({
+            return json_codec.json_response({
                 "schemas": [DEFAULT_LIST_SCHEMA],
                 "startIndex": start_index,
                 "totalResults": total_results,
@@ -125,8 +149,8 @@ def get_user_routes(_user_store: BaseStore = None):
         )
         @request_schema(User(), strict=True)
         async def post(self) -> web.Response:
-            user: Dict = await self.request.json()
+            user: Dict = await json_codec.read_json(self.request)
             new_user = await user_store.create(user)
-            return web.json_response(new_user, status=201)
+            return json_codec.json_response(new_user, status=201, headers=etag_headers(new_user))
 
     return user_routes
\ No newline at end of file
@@ -1,27 +1,128 @@
 import re
+import sys
 from abc import ABC
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from keystone_scim.util.exc import PreconditionFailed, ResourceAlreadyExists
 
 
 class BaseStore:
     filter_map = {}
     sensitive_fields = ["password"]
 
-    async def get_by_id(self, resource_id: str):
+    # 'get_by_id' and 'search' accept the optional 'attributes' and 'excluded_attributes' lists of the RFC 7644
+    # projection parameters, so that stores can skip reading (or aggregating) attributes that aren't returned.
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None):
         raise NotImplementedError("Method 'get_by_id' not implemented")
 
     async def search(self, **kwargs: Dict):
         raise NotImplementedError("Method 'search' not implemented")
 
-    async def update(self, resource_id: str, **kwargs: Dict):
+    # Writes of an existing resource accept the resource's 'expected_version' (an entity tag, e.g. of an 'If-Match'
+    # header). They're only applied if it's still the resource's version, which is checked atomically with the
+    # write, and fail with a 'PreconditionFailed' error otherwise.
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
         raise NotImplementedError("Method 'update' not implemented")
 
     async def create(self, resource: Dict):
         raise NotImplementedError("Method 'create' not implemented")
 
-    async def delete(self, resource_id: str):
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
         raise NotImplementedError("Method 'delete' not implemented")
 
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        """
+        Creates a batch of resources, skipping resources that already exist. Stores with a native bulk write
+        path override this one-by-one fallback.
+
+        :return: The ID of each created resource, or None for each skipped one, in the order of 'resources'
+        """
+        created = []
+        for resource in resources:
+            try:
+                created.append((await self.create(resource)).get("id"))
+            except ResourceAlreadyExists:
+                created.append(None)
+        return created
+
+    async def get_members(self, group_id: str, start_index: int = 1, count: int = 100) -> Tuple[List[Dict], int]:
+        """
+        Returns a page of a group's members, ordered by their ID. Stores that can read a page of members
+        without reading them all override this fallback.
+
+        :return: The page of members, and the total number of members of the group
+        """
+        group = await self.get_by_id(group_id)
+        members = sorted(group.get("members") or [], key=lambda m: str(m.get("value")))
+        return members[start_index - 1: start_index - 1 + count], len(members)
+
+    async def get_version(self, resource_id: str) -> Optional[str]:
+        """
+        :return: The current version of a resource (its 'meta.version', i.e. its entity tag), which changes with
+                 every write of the resource. Stores that can read the version alone override this fallback.
+        """
+        resource = await self.get_by_id(resource_id, attributes=["meta.version"])
+        return (resource.get("meta") or {}).get("version")
+
+    async def _precondition_failed(self, resource_type: str, resource_id: str) -> PreconditionFailed:
+        """
+        :return: The error of a write conditioned on the version of a resource that didn't match any resource,
+                 unless the resource doesn't exist at all (in which case 'ResourceNotFound' is raised)
+        """
+        return PreconditionFailed(resource_type, resource_id, await self.get_version(resource_id))
+
+    async def search_members(self, _filter: str, group_id: str) -> List[Dict]:
+        """
+        :return: The members of a group (as {"value": <user ID>}) selected by a members filter, e.g. the filter
+                 of a 'members[display sw "john"]' PATCH path. Databases evaluate the filter themselves; this
+                 fallback evaluates it against the group's members in memory.
+        """
+        from keystone_scim.store.memory_store import MemoryStore
+        group = await self.get_by_id(group_id, attributes=["members"])
+        members, _ = await MemoryStore("Member", resources=group.get("members") or [], key_attr="value").search(
+            _filter=_filter,
+            start_index=1,
+            count=sys.maxsize
+        )
+        return [{"value": m.get("value")} for m in members]
+
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        """
+        Applies the net effect of a group PATCH request: the attributes to update, the members to add and the
+        members to remove, after replacing the group's members with 'members' (if given). This fallback reads
+        the group's members once and writes the group once.
+        """
+        if members is None:
+            group = await self.get_by_id(group_id, attributes=["members"])
+            members = group.get("members") or []
+        patched = {m.get("value"): m for m in members}
+        for member_id in member_ids_to_remove:
+            patched.pop(member_id, None)
+        for member in members_to_add:
+            patched.setdefault(member.get("value"), member)
+        _ = await self.update(group_id, expected_version, **{**attributes, "members": list(patched.values())})
+
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        """
+        Yields every resource in the store in the order of their IDs, reading at most one batch at a time. Stores
+        with a cursor or an ordered key override this fallback, which pages through 'search' and gets slower with
+        each page (and only yields the resources in order if 'search' returns them in order).
+
+        :param after: The ID after which the scan starts (e.g., the last ID of an interrupted scan)
+        """
+        start_index = 1
+        while True:
+            resources, _ = await self.search(_filter=None, start_index=start_index, count=batch_size)
+            for resource in resources:
+                if after is None or str(resource.get("id")) > after:
+                    yield resource
+            if len(resources) < batch_size:
+                return
+            start_index += batch_size
+
     def clean_up_store(self):
         raise NotImplementedError("Method 'clean_up_store' not implemented")
 
@@ -57,14 +158,30 @@ class DatabaseStore(BaseStore, ABC):
     async def add_user_to_group(self, user_id: str, group_id: str):
         raise NotImplementedError("Method 'add_user_to_group' not implemented")
 
+    async def add_users_to_group(self, user_ids: List[str], group_id: str):
+        raise NotImplementedError("Method 'add_users_to_group' not implemented")
+
     async def set_group_members(self, users: List[Dict], group_id: str):
         raise NotImplementedError("Method 'set_group_members' not implemented")
 
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        # Memberships are stored apart from the group, so they're changed without reading the group. These are
+        # separate writes, so a failure can leave the patch partly applied: stores that can apply it with a single
+        # write (or transaction) override this fallback, as all the database stores do.
+        if attributes or expected_version is not None:
+            _ = await self.update(group_id, expected_version, **attributes)
+        if members is not None:
+            _ = await self.set_group_members([m.get("value") for m in members], group_id)
+        if member_ids_to_remove:
+            _ = await self.remove_users_from_group(member_ids_to_remove, group_id)
+        if members_to_add:
+            _ = await self.add_users_to_group([m.get("value") for m in members_to_add], group_id)
 
-class RDBMSStore(DatabaseStore, ABC):
 
-    async def search_members(self, _filter: str, group_id: str):
-        raise NotImplementedError("Method 'search_members' not implemented")
+class RDBMSStore(DatabaseStore, ABC):
+    pass
 
 
 class DocumentStore(DatabaseStore, ABC):
@@ -0,0 +1,345 @@
+import asyncio
+import copy
+import logging
+import re
+from typing import AsyncIterator, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from keystone_scim.store import BaseStore
+from keystone_scim.util.cache import LRUCache
+
+LOGGER = logging.getLogger(__name__)
+CACHEABLE_OPERATIONS = ("get_by_id", "get_members", "search")
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 30
+# An equality filter on a single attribute, e.g. the 'userName eq "x"' probe IdPs send before creating a user:
+EQ_FILTER = re.compile(r'^\s*(?P<attribute>\w+)\s+eq\s+"(?P<value>[^"\\]*)"\s*$', re.I)
+
+
+def _attributes_key(attributes: Optional[List[str]]) -> Optional[Tuple[str, ...]]:
+    # Projections don't depend on the order (or case) of the attribute names:
+    return tuple(sorted({a.lower() for a in attributes})) if attributes else None
+
+
+class CachingStore(BaseStore):
+    """
+    A read-through cache in front of another store. The results of the cached operations are kept in a size-
+    and TTL-bounded LRU, and every write through this store invalidates the entries it may have changed:
+
+    - The entries of a resource ('get_by_id' and 'get_members' results) are dropped when it's written.
+    - Search results are dropped on any write to the store.
+    - Users embed their groups and groups embed their members, so writes also invalidate the affected
+      entries of the related store (see 'relate').
+
+    Searches for an equality on one of the 'unique_attributes' that find nothing are also remembered for
+    'negative_ttl' seconds (if positive), whatever the cached operations. Such a negative result is dropped as
+    soon as a resource with that value is written through this store.
+
+    Writes made by other processes (or other replicas) aren't seen until the entries expire, unless they're
+    reported to 'evict' (see the InvalidationBus).
+
+    If 'coalesce' is set, identical reads (cached or not) that run at the same time share a single call to the
+    wrapped store and its result. A read never shares the call of a read that started before a write.
+    """
+
+    def __init__(self, store: BaseStore, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL,
+                 operations: Iterable[str] = CACHEABLE_OPERATIONS, negative_ttl: float = 0,
+                 unique_attributes: Iterable[str] = ("id",), coalesce: bool = False):
+        unknown = set(operations) - set(CACHEABLE_OPERATIONS)
+        if unknown:
+            raise ValueError(f"Operations can't be cached: {', '.join(sorted(unknown))}")
+        self.store = store
+        self.operations = set(operations)
+        self.cache = LRUCache(max_size, ttl)
+        self.related: List["CachingStore"] = []
+        self.hits = {op: 0 for op in CACHEABLE_OPERATIONS}
+        self.misses = {op: 0 for op in CACHEABLE_OPERATIONS}
+        self.unique_attributes = {a.lower() for a in unique_attributes}
+        self.negative_cache = LRUCache(max_size, negative_ttl) if negative_ttl > 0 else None
+        self.negative_hits, self.negative_misses = 0, 0
+        self.coalesce = coalesce
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = {op: 0 for op in CACHEABLE_OPERATIONS}
+        # Bumped by every invalidation, so that a read that raced with a write doesn't cache what it read:
+        self.generation = 0
+        self.search_generation = 0
+
+    def __getattr__(self, name: str):
+        # Anything that isn't cached (e.g. a store's own attributes) is read from the wrapped store:
+        if name == "store":
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    @staticmethod
+    def relate(*stores: "CachingStore"):
+        """
+        Declares that writes to any of the stores may change the resources of the others.
+        """
+        for store in stores:
+            store.related = [s for s in stores if s is not store]
+
+    def stats(self) -> Dict:
+        """
+        :return: The number of cached resources, and the hits, misses and hit ratio of each cached operation, and
+                 the number of calls of each operation that were coalesced
+        """
+
+        def ratio(hits: int, misses: int) -> float:
+            return hits / (hits + misses) if hits + misses > 0 else 0.0
+
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        negative = {}
+        if self.negative_cache is not None:
+            negative["negative"] = {
+                "size": len(self.negative_cache),
+                "hits": self.negative_hits,
+                "misses": self.negative_misses,
+                "hit_ratio": ratio(self.negative_hits, self.negative_misses),
+            }
+        return {
+            "size": len(self.cache),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": ratio(hits, misses),
+            "coalesced": sum(self.coalesced.values()),
+            "operations": {
+                op: {
+                    "hits": self.hits[op],
+                    "misses": self.misses[op],
+                    "hit_ratio": ratio(self.hits[op], self.misses[op]),
+                    "coalesced": self.coalesced[op],
+                }
+                for op in sorted(CACHEABLE_OPERATIONS if self.coalesce else self.operations)
+            },
+            **negative,
+        }
+
+    async def _read(self, operation: str, entry_key: Hashable, variant: Hashable, read):
+        # Resource entries hold one result per variant of the read (e.g. per projection), so that all the
+        # results of a resource are invalidated at once:
+        if operation in self.operations:
+            entry = self.cache.get(entry_key)
+            if entry is not None and variant in entry:
+                self.hits[operation] += 1
+                return copy.deepcopy(entry[variant])
+            self.misses[operation] += 1
+        generation = self.generation
+        result = await self._single_flight(operation, (generation, entry_key, variant), read)
+        if operation in self.operations and generation == self.generation:
+            entry = self.cache.get(entry_key) or {}
+            entry[variant] = copy.deepcopy(result)
+            self.cache.put(entry_key, entry)
+        return result
+
+    async def _single_flight(self, operation: str, key: Hashable, read):
+        # The key includes the generation, so writes start new flights. Each caller awaits a shield, so that a
+        # cancelled caller doesn't cancel the call the others are waiting for:
+        if not self.coalesce:
+            return await read()
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced[operation] += 1
+            return copy.deepcopy(await asyncio.shield(flight))
+        flight = asyncio.ensure_future(read())
+        self.in_flight[key] = flight
+
+        def land(_):
+            if self.in_flight.get(key) is flight:
+                del self.in_flight[key]
+
+        flight.add_done_callback(land)
+        return await asyncio.shield(flight)
+
+    def _drop(self, resource_ids: Iterable[str]):
+        self.generation += 1
+        self.search_generation += 1
+        for resource_id in resource_ids:
+            self.cache.pop(("resource", resource_id))
+
+    def _invalidate(self, resource_ids: Iterable[str] = (), related_ids: Optional[Iterable[str]] = ()):
+        """
+        Drops the entries of the given resources, and every search result. The entries of the related stores
+        are dropped for 'related_ids', or all of them if 'related_ids' is None.
+        """
+        self._drop(resource_ids)
+        for store in self.related:
+            if related_ids is None:
+                store.clear()
+            else:
+                store._drop(related_ids)
+
+    def _negative_key(self, _filter: Optional[str]) -> Optional[Tuple[str, str]]:
+        match = EQ_FILTER.match(_filter or "")
+        if self.negative_cache is None or not match or match.group("attribute").lower() not in self.unique_attributes:
+            return None
+        # Values are compared case-insensitively, which can only drop more negative results than needed:
+        return match.group("attribute").lower(), match.group("value").lower()
+
+    def _forget_negatives(self, *resources: Optional[Dict]):
+        """
+        Drops the negative results that the written resources would now match.
+        """
+        if self.negative_cache is None:
+            return
+        self.generation += 1
+        for resource in resources:
+            # Attribute names are case-insensitive:
+            values = {k.lower(): v for k, v in (resource or {}).items()}
+            for attribute in self.unique_attributes:
+                value = values.get(attribute)
+                if value is not None:
+                    self.negative_cache.pop((attribute, str(value).lower()))
+
+    def evict(self, resource_id: Optional[str], member_ids: Optional[List[str]] = None):
+        """
+        Drops what a write made by another process may have changed: the entries of the written resource (or of
+        all resources if None) and every search result. A change of group memberships drops the entries of the
+        'member_ids' users; any other change drops all the negative results, and all the related entries.
+        """
+        if resource_id is None:
+            for store in [self, *self.related]:
+                store.clear()
+            return
+        if member_ids is None and self.negative_cache is not None:
+            self.negative_cache.clear()
+        self._invalidate([resource_id], related_ids=member_ids)
+
+    def clear(self):
+        self.generation += 1
+        self.cache.clear()
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None):
+        return await self._read(
+            "get_by_id",
+            ("resource", resource_id),
+            ("get_by_id", _attributes_key(attributes), _attributes_key(excluded_attributes)),
+            lambda: self.store.get_by_id(resource_id, attributes=attributes, excluded_attributes=excluded_attributes)
+        )
+
+    async def get_members(self, group_id: str, start_index: int = 1, count: int = 100) -> Tuple[List[Dict], int]:
+        return await self._read(
+            "get_members",
+            ("resource", group_id),
+            ("get_members", start_index, count),
+            lambda: self.store.get_members(group_id, start_index=start_index, count=count)
+        )
+
+    async def search(self, _filter: Optional[str] = None, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> Tuple[List[Dict], int]:
+        negative_key = self._negative_key(_filter)
+        if negative_key is not None:
+            if negative_key in self.negative_cache:
+                self.negative_hits += 1
+                return [], 0
+            self.negative_misses += 1
+        generation = self.generation
+        resources, total = await self._read(
+            "search",
+            ("search", self.search_generation, (_filter or "").strip() or None, start_index, count,
+             _attributes_key(attributes), _attributes_key(excluded_attributes)),
+            "search",
+            lambda: self.store.search(
+                _filter=_filter,
+                start_index=start_index,
+                count=count,
+                attributes=attributes,
+                excluded_attributes=excluded_attributes
+            )
+        )
+        if negative_key is not None and total == 0 and generation == self.generation:
+            self.negative_cache.put(negative_key, True)
+        return resources, total
+
+    async def get_version(self, resource_id: str) -> Optional[str]:
+        # Versions aren't cached, since preconditions must see the writes of other replicas:
+        return await self.store.get_version(resource_id)
+
+    async def search_members(self, _filter: str, group_id: str) -> List[Dict]:
+        return await self.store.search_members(_filter=_filter, group_id=group_id)
+
+    def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        return self.store.scan(batch_size=batch_size, after=after)
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
+        try:
+            return await self.store.update(resource_id, expected_version, **kwargs)
+        finally:
+            self._forget_negatives({**kwargs, "id": resource_id})
+            self._invalidate([resource_id], related_ids=None)
+
+    async def create(self, resource: Dict):
+        created = None
+        try:
+            created = await self.store.create(resource)
+            return created
+        finally:
+            self._forget_negatives(resource, created)
+            self._invalidate(related_ids=[m.get("value") for m in resource.get("members") or []])
+
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        created_ids = []
+        try:
+            created_ids = await self.store.bulk_create(resources)
+            return created_ids
+        finally:
+            self._forget_negatives(*resources, *[{"id": i} for i in created_ids])
+            self._invalidate(related_ids=[m.get("value") for r in resources for m in r.get("members") or []])
+
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
+        try:
+            return await self.store.delete(resource_id, expected_version)
+        finally:
+            self._invalidate([resource_id], related_ids=None)
+
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        try:
+            return await self.store.patch_group(
+                group_id, attributes, members_to_add, member_ids_to_remove, members, expected_version
+            )
+        finally:
+            self._forget_negatives(attributes)
+            # Replacing the members (or renaming the group) changes users that can't be told apart here:
+            related_ids = None if attributes or members is not None else \
+                [m.get("value") for m in members_to_add] + list(member_ids_to_remove)
+            self._invalidate([group_id], related_ids=related_ids)
+
+    async def remove_users_from_group(self, user_ids: List[str], group_id: str):
+        try:
+            return await self.store.remove_users_from_group(user_ids, group_id)
+        finally:
+            self._invalidate([group_id], related_ids=user_ids)
+
+    async def add_user_to_group(self, user_id: str, group_id: str):
+        try:
+            return await self.store.add_user_to_group(user_id, group_id)
+        finally:
+            self._invalidate([group_id], related_ids=[user_id])
+
+    async def add_users_to_group(self, user_ids: List[str], group_id: str):
+        try:
+            return await self.store.add_users_to_group(user_ids, group_id)
+        finally:
+            self._invalidate([group_id], related_ids=user_ids)
+
+    async def set_group_members(self, users: List[Dict], group_id: str):
+        try:
+            return await self.store.set_group_members(users, group_id)
+        finally:
+            self._invalidate([group_id], related_ids=None)
+
+    async def bulk_update_members(self, changes: Dict[str, Tuple[List[str], List[str]]]) -> int:
+        try:
+            return await self.store.bulk_update_members(changes)
+        finally:
+            self._invalidate(changes.keys(), related_ids=[
+                user_id for added, removed in changes.values() for user_id in added + removed
+            ])
+
+    def clean_up_store(self):
+        self.clear()
+        return self.store.clean_up_store()
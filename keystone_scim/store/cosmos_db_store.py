@@ -1,8 +1,11 @@
+import asyncio
 import logging
 import re
+import time
 import uuid
-from typing import Dict, Union
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
 
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, DatabaseProxy, exceptions, PartitionKey, ConsistencyLevel
 from azure.cosmos.aio import (
     CosmosClient as AsyncCosmosClient,
@@ -17,10 +20,16 @@ from scim2_filter_parser.queries import SQLQuery
 
 from keystone_scim.store import BaseStore
 from keystone_scim.util.config import Config
-from keystone_scim.util.exc import ResourceAlreadyExists
+from keystone_scim.util.etag import parse_etag
+from keystone_scim.util.exc import PreconditionFailed, ResourceAlreadyExists
+from keystone_scim.util.projection import Projection
 
 CONFIG = Config()
 LOGGER = logging.getLogger(__name__)
+CHANGES_QUERY = "SELECT c.id, c._ts FROM c WHERE c._ts >= @since ORDER BY c._ts"
+SCAN_QUERY = "SELECT * FROM c WHERE c.id > @after ORDER BY c.id"
+# The attempts of a conditional replacement of a document, which is retried while other writes land in between:
+MAX_REPLACE_ATTEMPTS = 5
 
 
 async def get_client_credentials(async_client: bool = True):
@@ -49,7 +58,52 @@ async def get_client_credentials(async_client: bool = True):
 
 
 async def remove_cosmos_metadata(resource: Dict):
-    return {k: resource[k] for k in resource.keys() if not k.startswith("_")}
+    cleaned = {k: resource[k] for k in resource.keys() if not k.startswith("_")}
+    # Cosmos DB changes the entity tag of a document with every write, which versions the resource:
+    if resource.get("_etag"):
+        cleaned["meta"] = {**(cleaned.get("meta") or {}), "version": f"W/{resource['_etag']}"}
+    return cleaned
+
+
+async def watch_changes(on_change: Callable[[Dict], None], on_ready: Callable[[], None], **kwargs):
+    """
+    Polls the users and groups containers for the documents modified since the last poll every
+    'store.cache.poll_interval' seconds, and calls 'on_change' with each of them, until cancelled or
+    disconnected. Deletions aren't reported: the entries of a resource deleted by another replica are only
+    dropped once they expire.
+    """
+    poll_interval = float(kwargs.get("poll_interval", CONFIG.get("store.cache.poll_interval", 1)))
+    client_creds = await get_client_credentials()
+    async with AsyncCosmosClient(CONFIG.get("store.cosmos.account_uri"), credential=client_creds) as client:
+        database = client.get_database_client(CONFIG.get("store.cosmos.db_name"))
+        containers = {rt: database.get_container_client(f"scim2{rt}") for rt in ("users", "groups")}
+        # Modification times are in seconds, so the documents of the last second are read again, and the ones
+        # that were already reported are skipped:
+        since = {rt: int(time.time()) for rt in containers.keys()}
+        reported = {rt: set() for rt in containers.keys()}
+        on_ready()
+        while True:
+            for resource_type, container in containers.items():
+                params = [{"name": "@since", "value": since[resource_type]}]
+                async for item in container.query_items(query=CHANGES_QUERY, parameters=params):
+                    if item["_ts"] > since[resource_type]:
+                        since[resource_type], reported[resource_type] = item["_ts"], set()
+                    if item["id"] not in reported[resource_type]:
+                        reported[resource_type].add(item["id"])
+                        on_change({"type": resource_type, "id": item["id"]})
+            await asyncio.sleep(poll_interval)
+
+
+def _select_list(projection: Projection) -> str:
+    # Only the requested top-level properties are read, when they can be referenced as identifiers (excluded
+    # attributes, and extension schema URNs, are removed from the documents after reading them):
+    names = {p.split(".")[0] for p in projection.included_paths} | {"id", "schemas"}
+    if projection.includes("meta"):
+        names.add("_etag")
+    names = sorted(names)
+    if not projection.included_paths or not all(re.fullmatch(r"[A-Za-z_]\w*", n) for n in names):
+        return "*"
+    return ", ".join(f"c.{n}" for n in names)
 
 
 class CosmosDbStore(BaseStore):
@@ -76,14 +130,15 @@ class CosmosDbStore(BaseStore):
         self.container_name = f"scim2{self.entity_name}"
         self.init_client()
 
-    async def get_by_id(self, resource_id: str):
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None):
         client_creds = await get_client_credentials()
         uri = self.account_uri
         async with AsyncCosmosClient(uri, credential=client_creds) as client:
             database = client.get_database_client(CONFIG.get("store.cosmos.db_name"))
             container = database.get_container_client(self.container_name)
             resource = await container.read_item(item=resource_id, partition_key=resource_id)
-        return await remove_cosmos_metadata(resource)
+        return Projection(attributes, excluded_attributes).apply(await remove_cosmos_metadata(resource))
 
     async def _get_query_count(self, query: str, params: Dict):
         # TODO: SDK bug https://github.com/Azure/azure-sdk-for-python/issues/25405
@@ -103,7 +158,10 @@ class CosmosDbStore(BaseStore):
         except exceptions.CosmosHttpResponseError:
             raise
 
-    async def search(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+    async def search(self, _filter: str, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> tuple[list[Dict], int]:
+        projection = Projection(attributes, excluded_attributes)
         params = [
             {"name": "@offset", "value": start_index - 1},
             {"name": "@limit", "value": count},
@@ -124,7 +182,7 @@ class CosmosDbStore(BaseStore):
 
         # Ignoring bandit SQL injection detection because a safe parameter interpolation
         # takes place by Cosmos DB.
-        query = f"SELECT * FROM c {where} OFFSET @offset LIMIT @limit"  # nosec B608
+        query = f"SELECT {_select_list(projection)} FROM c {where} OFFSET @offset LIMIT @limit"  # nosec B608
         client_creds = await get_client_credentials()
         uri = self.account_uri
         resources = []
@@ -134,7 +192,7 @@ class CosmosDbStore(BaseStore):
                 container = database.get_container_client(self.container_name)
                 iterator = container.query_items(query=query, parameters=params, populate_query_metrics=True)
                 async for resource in iterator:
-                    resources.append(await remove_cosmos_metadata(resource))
+                    resources.append(projection.apply(await remove_cosmos_metadata(resource)))
             except exceptions.CosmosHttpResponseError:
                 raise
 
@@ -146,21 +204,76 @@ class CosmosDbStore(BaseStore):
         )
         return resources, count
 
-    async def update(self, resource_id: str, **kwargs: Dict):
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        # A single query, ordered by ID and read one page at a time with continuation tokens (rather than with
+        # OFFSET, which makes Cosmos DB read and discard every previous page):
         client_creds = await get_client_credentials()
-        uri = self.account_uri
-        async with AsyncCosmosClient(uri, credential=client_creds) as client:
+        async with AsyncCosmosClient(self.account_uri, credential=client_creds) as client:
             database = client.get_database_client(CONFIG.get("store.cosmos.db_name"))
             container = database.get_container_client(self.container_name)
-            try:
-                resource = await remove_cosmos_metadata(
-                    await container.read_item(item=resource_id, partition_key=resource_id)
-                )
-            except exceptions.CosmosResourceNotFoundError:
-                raise
-            resource.update(await self._sanitize(kwargs))
-            await container.upsert_item(resource)
-        return await remove_cosmos_metadata(resource)
+            params = [{"name": "@after", "value": after or ""}]
+            pages = container.query_items(query=SCAN_QUERY, parameters=params, max_item_count=batch_size).by_page()
+            async for page in pages:
+                async for resource in page:
+                    yield await remove_cosmos_metadata(resource)
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
+        sanitized = await self._sanitize(kwargs)
+
+        async def updated(document: Dict) -> Dict:
+            return {**{k: v for k, v in document.items() if not k.startswith("_")}, **sanitized}
+
+        return await self._replace(resource_id, updated, expected_version)
+
+    async def _replace(self, resource_id: str, change: Callable[[Dict], Awaitable[Dict]],
+                       expected_version: Optional[str] = None) -> Dict:
+        """
+        Reads a document and replaces it with 'change(document)' in a single write, which only succeeds if the
+        document wasn't modified since it was read (i.e., if its entity tag still matches). A replacement of an
+        expected version isn't retried, since any other write in between changes the version.
+        """
+        resource_type = self.entity_name.rstrip("s").title()
+        client_creds = await get_client_credentials()
+        async with AsyncCosmosClient(self.account_uri, credential=client_creds) as client:
+            database = client.get_database_client(CONFIG.get("store.cosmos.db_name"))
+            container = database.get_container_client(self.container_name)
+            for attempt in range(1, MAX_REPLACE_ATTEMPTS + 1):
+                document = await container.read_item(item=resource_id, partition_key=resource_id)
+                if expected_version is not None and document["_etag"].strip('"') != parse_etag(expected_version):
+                    raise PreconditionFailed(resource_type, resource_id, f"W/{document['_etag']}")
+                try:
+                    replaced = await container.replace_item(
+                        item=resource_id,
+                        body=await change(document),
+                        etag=document["_etag"],
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                    return await remove_cosmos_metadata(replaced)
+                except exceptions.CosmosAccessConditionFailedError:
+                    if expected_version is not None:
+                        raise await self._precondition_failed(resource_type, resource_id)
+                    if attempt == MAX_REPLACE_ATTEMPTS:
+                        raise
+
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        # Members are stored in the group's document, so the whole patch is a single replacement of it:
+        async def patched(group: Dict) -> Dict:
+            current = (group.get("members") or []) if members is None else members
+            patched_members = {m.get("value"): m for m in current}
+            for member_id in member_ids_to_remove:
+                patched_members.pop(member_id, None)
+            for member in members_to_add:
+                patched_members.setdefault(member.get("value"), member)
+            return {
+                **group,
+                **(await self._sanitize(attributes)),
+                self.key_attr: group_id,
+                "members": list(patched_members.values()),
+            }
+
+        _ = await self._replace(group_id, patched, expected_version)
 
     async def create(self, resource: Dict) -> Dict:
         client_creds = await get_client_credentials()
@@ -188,20 +301,25 @@ class CosmosDbStore(BaseStore):
             except exceptions.CosmosResourceNotFoundError:
                 pass
             resource[self.key_attr] = resource_id
-            resource = await self._sanitize(resource)
-            await container.upsert_item(resource)
+            resource = await container.upsert_item(await self._sanitize(resource))
         return await remove_cosmos_metadata(resource)
 
-    async def delete(self, resource_id: str):
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
+        # The deletion of an expected version is conditioned on the document's entity tag, which includes quotes:
+        condition = {} if expected_version is None else {
+            "etag": f'"{parse_etag(expected_version)}"', "match_condition": MatchConditions.IfNotModified
+        }
         client_creds = await get_client_credentials()
         uri = self.account_uri
         async with AsyncCosmosClient(uri, credential=client_creds) as client:
             database = client.get_database_client(CONFIG.get("store.cosmos.db_name"))
             container = database.get_container_client(self.container_name)
             try:
-                _ = await container.delete_item(item=resource_id, partition_key=resource_id)
+                _ = await container.delete_item(item=resource_id, partition_key=resource_id, **condition)
             except exceptions.CosmosResourceNotFoundError:
                 pass
+            except exceptions.CosmosAccessConditionFailedError:
+                raise await self._precondition_failed(self.entity_name.rstrip("s").title(), resource_id)
         return
 
     def init_client(self):
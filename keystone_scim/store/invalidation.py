@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from keystone_scim.store.caching_store import CachingStore
+
+LOGGER = logging.getLogger(__name__)
+MAX_RETRY_DELAY_SEC = 60
+
+# A change, as reported by the 'watch_changes' function of a store module, e.g.
+#   {"type": "users", "id": "<user ID>"}                                    A user was written
+#   {"type": "groups", "id": "<group ID>", "members": ["<user ID>", ...]}   Members were added or removed
+#   {"type": "groups", "id": None}                                          Any group may have been written
+Change = Dict
+# Calls its first argument with each change, and its second one once it receives all the subsequent changes:
+WatchChanges = Callable[[Callable[[Change], None], Callable[[], None]], Awaitable]
+
+
+class InvalidationBus:
+    """
+    Evicts the resources written by other replicas from the caching stores, as the database reports the changes
+    (which includes the writes of this replica, whose entries were already dropped). Whatever changed while the
+    changes weren't received is unknown, so the caches are cleared every time the bus (re)connects.
+    """
+
+    def __init__(self, stores: Dict[str, CachingStore], watch_changes: WatchChanges):
+        self.stores = stores
+        self.watch_changes = watch_changes
+        self.task: Optional[asyncio.Task] = None
+        self.retry_delay = 1
+        self.changes = 0
+
+    def _on_change(self, change: Change):
+        store = self.stores.get(change.get("type"))
+        if store is not None:
+            self.changes += 1
+            store.evict(change.get("id"), change.get("members"))
+
+    def _on_ready(self):
+        LOGGER.info("Receiving the changes of other replicas")
+        self.retry_delay = 1
+        for store in self.stores.values():
+            store.clear()
+
+    async def run(self):
+        while True:
+            try:
+                await self.watch_changes(self._on_change, self._on_ready)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.warning("Lost the changes of other replicas (%s), retrying in %d seconds", e, self.retry_delay)
+            await asyncio.sleep(self.retry_delay)
+            self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY_SEC)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -1,6 +1,6 @@
 import sys
 import uuid
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List, Optional
 
 import asyncio
 from scim2_filter_parser import ast
@@ -10,7 +10,9 @@ from scim2_filter_parser.lexer import SCIMLexer
 
 from keystone_scim.store import BaseStore
 from keystone_scim.util.case_insensitive_dict import CaseInsensitiveDict
-from keystone_scim.util.exc import ResourceNotFound, ResourceAlreadyExists
+from keystone_scim.util.etag import etag_matches, make_etag
+from keystone_scim.util.exc import PreconditionFailed, ResourceNotFound, ResourceAlreadyExists
+from keystone_scim.util.projection import Projection
 
 
 def _norm_lst(lst: List, attr: str = "value") -> List:
@@ -82,50 +84,70 @@ class MemoryStore(BaseStore):
         self.key_attr = key_attr
         self.data_lock = asyncio.Lock()
         self.resource_db = self._index_resources(resources or [])
+        # The number of writes to the store, which versions the written resources:
+        self.version = 0
+
+    def _stamp(self, resource: Dict) -> Dict:
+        self.version += 1
+        resource["meta"] = {**(resource.get("meta") or {}), "version": make_etag(self.version)}
+        return resource
 
     def _index_resources(self, resources: List) -> Dict:
         return {r.get(self.key_attr): r for r in resources}
 
-    async def prep_resource_for_presentation(self, resource: Dict) -> Dict:
+    async def prep_resource_for_presentation(self, resource: Dict, projection: Projection = Projection()) -> Dict:
         if not self.nested_store_attr:
-            return resource
-        nested_store = resource[f"{self.nested_store_attr}_store"]
-        nested_members, _ = await nested_store.search(
-            _filter=None,
-            start_index=1,
-            count=sys.maxsize
-        )
-        resource_sc = {
-            **resource,
-            self.nested_store_attr: nested_members,
-        }
-        del resource_sc[f"{self.nested_store_attr}_store"]
-        return resource_sc
-
-    async def search(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+            return projection.apply(resource)
+        resource_sc = {**resource}
+        nested_store = resource_sc.pop(f"{self.nested_store_attr}_store")
+        # The nested resources are only listed when they're returned:
+        if projection.includes(self.nested_store_attr):
+            resource_sc[self.nested_store_attr], _ = await nested_store.search(
+                _filter=None,
+                start_index=1,
+                count=sys.maxsize
+            )
+        return projection.apply(resource_sc)
+
+    async def search(self, _filter: str, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> tuple[list[Dict], int]:
+        projection = Projection(attributes, excluded_attributes)
         async with self.data_lock:
             if not _filter:
-                res = await asyncio.gather(*[
-                    self.prep_resource_for_presentation(r)
-                    for r in list(self.resource_db.values())
-                ])
+                res = list(self.resource_db.values())
             else:
                 pf = await self.parse_filter_expression(_filter)
-                res = await asyncio.gather(*[
-                    self.prep_resource_for_presentation(r) for r in self.resource_db.values()
+                res = [
+                    r for r in self.resource_db.values()
                     if await self.evaluate_filter(pf, await CaseInsensitiveDict.build_deep(r))
-                ])
+                ]
             total_results = len(res)
-        paginated = res[start_index - 1: start_index - 1 + count:]
+            # Only the requested page is prepared for presentation:
+            page = res[start_index - 1: start_index - 1 + count:]
+            paginated = await asyncio.gather(*[self.prep_resource_for_presentation(r, projection) for r in page])
         return paginated, total_results
 
-    async def update(self, resource_id: str, **kwargs: Dict) -> Dict:
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        async with self.data_lock:
+            resources = [r for k, r in sorted(self.resource_db.items()) if after is None or k > after]
+        for resource in resources:
+            yield await self.prep_resource_for_presentation(await self._sanitize(resource))
+
+    def _check_version(self, resource_id: str, expected_version: Optional[str]):
+        version = (self.resource_db[resource_id].get("meta") or {}).get("version")
+        if expected_version is not None and not etag_matches(expected_version, version):
+            raise PreconditionFailed(self.resource_name, resource_id, version)
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict) -> Dict:
         async with self.data_lock:
             if resource_id not in self.resource_db:
                 raise ResourceNotFound(self.resource_name, resource_id)
+            self._check_version(resource_id, expected_version)
             resource = self.resource_db.get(resource_id)
             resource.update(await self._sanitize(kwargs))
-            if self.nested_store_attr and kwargs.get(self.nested_store_attr):
+            self._stamp(resource)
+            if self.nested_store_attr and self.nested_store_attr in kwargs:
                 resource[f"{self.nested_store_attr}_store"] = MemoryStore(
                     "Member",
                     resources=resource.get(self.nested_store_attr),
@@ -134,6 +156,31 @@ class MemoryStore(BaseStore):
             self.resource_db[resource_id] = resource
         return await self.prep_resource_for_presentation(resource)
 
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        # The members are netted against the stored ones under the lock, so concurrent patches don't overwrite
+        # each other's members:
+        async with self.data_lock:
+            if group_id not in self.resource_db:
+                raise ResourceNotFound(self.resource_name, group_id)
+            self._check_version(group_id, expected_version)
+            group = self.resource_db[group_id]
+            patched = {m.get("value"): m for m in (group.get("members") or [] if members is None else members)}
+            for member_id in member_ids_to_remove:
+                patched.pop(member_id, None)
+            for member in members_to_add:
+                patched.setdefault(member.get("value"), member)
+            group.update(await self._sanitize(attributes))
+            group["members"] = list(patched.values())
+            if self.nested_store_attr:
+                group[f"{self.nested_store_attr}_store"] = MemoryStore(
+                    "Member",
+                    resources=group.get(self.nested_store_attr),
+                    key_attr="value"
+                )
+            self._stamp(group)
+
     async def create(self, resource: Dict) -> Dict:
         resource_id = resource.get(self.key_attr)
         async with self.data_lock:
@@ -150,22 +197,48 @@ class MemoryStore(BaseStore):
                 )
             resource_id = resource_id or str(uuid.uuid4())
             resource[self.key_attr] = resource_id
-            self.resource_db[resource_id] = await self._sanitize(resource)
+            self.resource_db[resource_id] = await self._sanitize(self._stamp(resource))
         return await self.prep_resource_for_presentation(resource)
 
-    async def delete(self, resource_id: str) -> None:
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        created = []
+        async with self.data_lock:
+            names = {r.get("displayName") for r in self.resource_db.values()} if self.name_uniqueness else set()
+            for resource in resources:
+                resource_id = resource.get(self.key_attr) or str(uuid.uuid4())
+                if resource_id in self.resource_db or resource.get("displayName") in names:
+                    created.append(None)
+                    continue
+                if self.name_uniqueness:
+                    names.add(resource.get("displayName"))
+                resource = await self._sanitize(resource)
+                if self.nested_store_attr:
+                    resource[f"{self.nested_store_attr}_store"] = MemoryStore(
+                        "Member",
+                        resources=resource.get(self.nested_store_attr),
+                        key_attr="value"
+                    )
+                resource[self.key_attr] = resource_id
+                self.resource_db[resource_id] = self._stamp(resource)
+                created.append(resource_id)
+        return created
+
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None) -> None:
         async with self.data_lock:
             if resource_id not in self.resource_db:
                 raise ResourceNotFound(self.resource_name, resource_id)
+            self._check_version(resource_id, expected_version)
             del self.resource_db[resource_id]
         return
 
-    async def get_by_id(self, resource_id: str) -> Dict:
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None) -> Dict:
         async with self.data_lock:
             if resource_id not in self.resource_db:
                 raise ResourceNotFound(self.resource_name, resource_id)
             return await self.prep_resource_for_presentation(
-                await self._sanitize(self.resource_db.get(resource_id))
+                await self._sanitize(self.resource_db.get(resource_id)),
+                Projection(attributes, excluded_attributes)
             )
 
     async def parse_filter_expression(self, expr: str) -> Dict:
@@ -1,20 +1,53 @@
 import asyncio
+import re
+import time
 import urllib.parse
-from typing import Dict, List
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 from bson.objectid import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 from pymongo.collation import Collation
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo.errors import BulkWriteError
 from scim2_filter_parser import ast
 from scim2_filter_parser.ast import LogExpr, Filter, AttrExpr, CompValue, AttrPath, AST
 from scim2_filter_parser.lexer import SCIMLexer
 from scim2_filter_parser.parser import SCIMParser
 
+from keystone_scim.models.group import Group
+from keystone_scim.models.user import User
 from keystone_scim.store import DocumentStore
 from keystone_scim.util.config import Config
+from keystone_scim.util.etag import make_etag, version_number
 from keystone_scim.util.exc import ResourceNotFound
+from keystone_scim.util.projection import Projection
 
 CONFIG = Config()
+# Field names are case-sensitive in MongoDB, so projected attributes are mapped to their canonical names:
+CANONICAL_ATTRIBUTES = {
+    (f.attribute or name).lower(): f.attribute or name
+    for schema in (User(), Group()) for name, f in schema.fields.items()
+}
+
+# Attributes of group members, mapped to the user attributes they're read from:
+MEMBER_ATTRIBUTES = {"value": "id", "display": "userName"}
+# Lower-case shadow fields, which serve case-insensitive filters with plain (collation-less) indexes, including
+# anchored prefix regexes for the 'sw' operator. Collation-aware indexes can't bound a regex:
+SHADOW_FIELDS = {
+    "username": "userName_lc",
+    "displayname": "displayName_lc",
+    "emails": "emails.value_lc",
+    "emails.value": "emails.value_lc",
+}
+SHADOW_SUFFIX = "_lc"
+# The version of each document, which is incremented by every write and exposed as 'meta.version':
+VERSION_FIELD = "_version"
+NEXT_VERSION = {"$add": [{"$ifNull": [f"${VERSION_FIELD}", 0]}, 1]}
+CASE_INSENSITIVE_COLLATION = {"locale": "en", "strength": 2}
+COUNT_CACHE_SIZE = 1024
+# The clients of the process, per DSN and client options:
+CLIENTS: Dict[Tuple, AsyncIOMotorClient] = {}
 
 
 def build_dsn(**kwargs):
@@ -22,26 +55,60 @@ def build_dsn(**kwargs):
     if dsn:
         return dsn
     host = kwargs.get("host", CONFIG.get("store.mongo.host"))
-    port = kwargs.get("port", CONFIG.get("store.mongo.port", 5432))
+    port = kwargs.get("port", CONFIG.get("store.mongo.port", 27017))
     username = kwargs.get("username", CONFIG.get("store.mongo.username"))
     password = kwargs.get("password", CONFIG.get("store.mongo.password"))
     tls = kwargs.get("tls", CONFIG.get("store.mongo.tls", "true"))
     if type(tls) == bool:
         tls = "true" if tls is True else "false"
     replica_set = kwargs.get("replica_set", CONFIG.get("store.mongo.replica_set"))
-    cred = username
-    if password:
-        cred = f"{cred}:{urllib.parse.quote(password)}"
+    cred = ""
+    if username:
+        cred = urllib.parse.quote(username)
+        if password:
+            cred = f"{cred}:{urllib.parse.quote(password)}"
+        cred = f"{cred}@"
     query_params = {}
     if tls:
         query_params["tls"] = tls
     if replica_set:
         query_params["replicaSet"] = replica_set
-    return f"mongodb://{cred}@{host}:{port}/?tls={tls}"
+    return f"mongodb://{cred}{host}:{port}/?{urllib.parse.urlencode(query_params)}"
+
+
+def client_options(**kwargs) -> Dict:
+    """
+    :return: The connection pool, read preference, write concern and compression options of the client
+    """
+    options = {
+        "maxPoolSize": kwargs.get("max_pool_size", CONFIG.get("store.mongo.max_pool_size")),
+        "minPoolSize": kwargs.get("min_pool_size", CONFIG.get("store.mongo.min_pool_size")),
+        "readPreference": kwargs.get("read_preference", CONFIG.get("store.mongo.read_preference")),
+        "w": kwargs.get("w", CONFIG.get("store.mongo.w")),
+        "journal": kwargs.get("journal", CONFIG.get("store.mongo.journal")),
+        "compressors": kwargs.get("compressors", CONFIG.get("store.mongo.compressors")),
+    }
+    # Environment variables are strings, and a numeric 'w' is a number of nodes rather than a tag:
+    if isinstance(options["w"], str) and options["w"].isdigit():
+        options["w"] = int(options["w"])
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def get_client(**kwargs) -> AsyncIOMotorClient:
+    """
+    :return: The process' client for a deployment and set of options. Clients own a connection pool (and
+             monitoring threads), so they're shared by all the stores rather than created per store.
+    """
+    dsn = build_dsn(**kwargs)
+    options = client_options(**kwargs)
+    key = (dsn, tuple(sorted((k, str(v)) for k, v in options.items())))
+    if key not in CLIENTS:
+        CLIENTS[key] = AsyncIOMotorClient(dsn, **options)
+    return CLIENTS[key]
 
 
 async def set_up(**kwargs):
-    client = AsyncIOMotorClient(build_dsn(**kwargs))
+    client = get_client(**kwargs)
     db_name = kwargs.get("database", CONFIG.get("store.mongo.database"))
     users_collection = client[db_name]["users"]
     groups_collection = client[db_name]["groups"]
@@ -50,25 +117,207 @@ async def set_up(**kwargs):
     _ = await users_collection.create_index([("emails.value", 1)], collation=Collation(locale="en", strength=2))
     _ = await groups_collection.create_index([("displayName", 1)], unique=True,
                                              collation=Collation(locale="en", strength=2))
+    for field in ("userName_lc", "displayName_lc", "emails.value_lc"):
+        _ = await users_collection.create_index([(field, 1)])
+    _ = await groups_collection.create_index([("displayName_lc", 1)])
+    # Documents written before the shadow fields existed are backfilled:
+    _ = await users_collection.update_many({"userName_lc": {"$exists": False}}, [{"$set": {
+        "userName_lc": _lower_expression("$userName"),
+        "displayName_lc": _lower_expression("$displayName"),
+        "emails": {"$cond": [
+            {"$isArray": "$emails"},
+            {"$map": {
+                "input": "$emails",
+                "in": {"$mergeObjects": ["$$this", {"value_lc": _lower_expression("$$this.value")}]},
+            }},
+            "$$REMOVE",
+        ]},
+    }}])
+    _ = await groups_collection.update_many({"displayName_lc": {"$exists": False}}, [{"$set": {
+        "displayName_lc": _lower_expression("$displayName"),
+    }}])
+    # Finds the groups of a user, whose member entries are updated along with the user:
+    _ = await groups_collection.create_index([("members._id", 1)])
+    # Groups written before member entries were denormalized only list their members' IDs:
+    async for group in groups_collection.find({"members": {"$type": "objectId"}}, {"members": 1}):
+        _ = await groups_collection.update_one({"_id": group["_id"]}, {"$set": {
+            "members": await _member_entries(users_collection, [m for m in group["members"] if isinstance(m, ObjectId)])
+        }})
+
+
+async def watch_changes(on_change: Callable[[Dict], None], on_ready: Callable[[], None], **kwargs):
+    """
+    Calls 'on_change' with each change of the users and groups collections, read from a change stream (which
+    requires a replica set), until cancelled or disconnected.
+    """
+    client = get_client(**kwargs)
+    database = client[kwargs.get("database", CONFIG.get("store.mongo.database"))]
+    pipeline = [
+        {"$match": {"ns.coll": {"$in": ["users", "groups"]}}},
+        {"$project": {"operationType": 1, "ns": 1, "documentKey": 1}},
+    ]
+    async with database.watch(pipeline) as stream:
+        on_ready()
+        async for change in stream:
+            document_key = change.get("documentKey") or {}
+            # Dropping (or renaming) a collection changes all of its documents:
+            on_change({
+                "type": (change.get("ns") or {}).get("coll"),
+                "id": str(document_key["_id"]) if "_id" in document_key else None,
+            })
+
+
+async def _member_entries(users_collection, user_ids: List) -> List[Dict]:
+    """
+    Groups store a denormalized {_id, userName} entry per member, so that reading a group doesn't join the users
+    collection.
+
+    :return: The member entries of the existing users among 'user_ids', in order and without duplicates
+    """
+    object_ids = list(dict.fromkeys(ObjectId(user_id) for user_id in user_ids))
+    if len(object_ids) == 0:
+        return []
+    cursor = users_collection.find({"_id": {"$in": object_ids}}, {"userName": 1})
+    user_names = {u["_id"]: u.get("userName") async for u in cursor}
+    return [{"_id": oid, "userName": user_names[oid]} for oid in object_ids if oid in user_names]
+
+
+def _lower_expression(field: str) -> Dict:
+    return {"$cond": [{"$eq": [{"$type": field}, "string"]}, {"$toLower": field}, "$$REMOVE"]}
+
+
+def _with_shadow_fields(document: Dict) -> Dict:
+    """
+    Sets the lower-case shadow fields of a document (or of a '$set' of its attributes) in place.
+    """
+    for field in ("userName", "displayName"):
+        if field in document:
+            value = document[field]
+            document[f"{field}{SHADOW_SUFFIX}"] = value.lower() if isinstance(value, str) else None
+    if isinstance(document.get("emails"), list):
+        document["emails"] = [
+            {**e, f"value{SHADOW_SUFFIX}": e["value"].lower()}
+            if isinstance(e, dict) and isinstance(e.get("value"), str) else e
+            for e in document["emails"]
+        ]
+    return document
+
+
+def _without_shadow_fields(document: Dict) -> Dict:
+    document = {k: v for k, v in document.items() if not k.endswith(SHADOW_SUFFIX)}
+    if isinstance(document.get("emails"), list):
+        document["emails"] = [
+            {k: v for k, v in e.items() if k != f"value{SHADOW_SUFFIX}"} if isinstance(e, dict) else e
+            for e in document["emails"]
+        ]
+    return document
+
+
+def _regex(operator: str, value: str) -> str:
+    # Only the 'sw' regex is anchored at the start, which lets it use index bounds:
+    pattern = re.escape(value)
+    return {"sw": f"^{pattern}", "ew": f"{pattern}$"}.get(operator, pattern)
+
+
+def _needs_collation(query) -> bool:
+    """
+    :return: Whether a query compares fields other than IDs and shadow fields, which rely on a case-insensitive
+             collation. Indexes on shadow fields are only used by queries without a collation.
+    """
+    if isinstance(query, list):
+        return any(_needs_collation(q) for q in query)
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if not key.startswith("$") and key != "_id" and not key.endswith(SHADOW_SUFFIX):
+                return True
+            if key.startswith("$") and _needs_collation(value):
+                return True
+    return False
+
+
+def _find_projection(projection: Projection) -> Optional[Dict]:
+    """
+    :return: The 'find' projection document of a SCIM projection, or None to return whole documents
+    """
+    def field(path: str) -> str:
+        name, dot, sub_attribute = path.partition(".")
+        return f"{CANONICAL_ATTRIBUTES.get(name.lower(), name)}{dot}{sub_attribute}"
+
+    if projection.included_paths:
+        version = {VERSION_FIELD: 1} if projection.includes("meta") else {}
+        return {"schemas": 1, **version, **{field(p): 1 for p in projection.included_paths if p.lower() != "id"}}
+    excluded = {field(p): 0 for p in projection.excluded_paths if p.lower() not in ("id", "schemas")}
+    return excluded or None
+
+
+def _version_filter(resource_id: str, expected_version: Optional[str] = None) -> Dict:
+    """
+    :return: A filter of a resource's document, which only matches while the document has the expected version (if
+             any). Documents written before versioning have no version field, and are at version 0
+    """
+    doc_filter = {"_id": ObjectId(resource_id)}
+    if expected_version is not None:
+        version = version_number(expected_version)
+        doc_filter[VERSION_FIELD] = version if version != 0 else {"$in": [0, None]}
+    return doc_filter
+
+
+def _replacement_pipeline(document: Dict) -> List[Dict]:
+    """
+    :return: An update pipeline that replaces a document and increments its version atomically (a replacement
+             document can't refer to the replaced one)
+    """
+    return [{"$replaceWith": {"$mergeObjects": [
+        {"$literal": {k: v for k, v in document.items() if k != VERSION_FIELD}},
+        {"_id": "$_id", VERSION_FIELD: NEXT_VERSION},
+    ]}}]
+
+
+def _with_version(resource: Dict, item: Dict) -> Dict:
+    if VERSION_FIELD in item:
+        resource["meta"] = {**(resource.get("meta") or {}), "version": make_etag(item[VERSION_FIELD])}
+    return resource
+
+
+def _members_pipeline(entries_to_add: List[Dict], user_ids_to_remove: List[str]) -> List[Dict]:
+    """
+    :return: An update pipeline that removes and adds member entries atomically, without duplicating existing
+             members (a single update can't both '$pull' and '$addToSet' the same field, and '$addToSet' would
+             compare whole entries rather than their IDs)
+    """
+    if not entries_to_add and not user_ids_to_remove:
+        return []
+    to_remove = [ObjectId(user_id) for user_id in user_ids_to_remove]
+    return [{"$set": {"members": {"$let": {
+        "vars": {"kept": {"$filter": {
+            "input": {"$ifNull": ["$members", []]},
+            "cond": {"$not": [{"$in": ["$$this._id", {"$literal": to_remove}]}]},
+        }}},
+        "in": {"$concatArrays": ["$$kept", {"$filter": {
+            "input": {"$literal": entries_to_add},
+            "cond": {"$not": [{"$in": ["$$this._id", "$$kept._id"]}]},
+        }}]},
+    }}}}]
 
 
 async def _transform_user(item: Dict) -> Dict:
     item_id: ObjectId = item.get("_id")
-    user = {**item}
+    user = _without_shadow_fields(item)
+    user.pop(VERSION_FIELD, None)
     if item_id:
         user["id"] = str(item_id)
         del user["_id"]
-    return user
+    return _with_version(user, item)
 
 
 async def _transform_group(item: Dict) -> Dict:
-    return {
+    return _with_version({
         "id": str(item.get("_id")),
         "schemas": item.get("schemas"),
         "displayName": item.get("displayName"),
         "meta": item.get("meta"),
-        "members": [{"value": str(m.get("_id")), "display": m.get("userName")} for m in item.get("userMembers", [])]
-    }
+        "members": [{"value": str(m.get("_id")), "display": m.get("userName")} for m in item.get("members") or []]
+    }, item)
 
 
 class MongoDbStore(DocumentStore):
@@ -77,77 +326,149 @@ class MongoDbStore(DocumentStore):
 
     def __init__(self, entity_type: str, **conn_args):
         self.entity_type = entity_type
-        self.client = AsyncIOMotorClient(build_dsn(**conn_args))
+        self.client = get_client(**conn_args)
         self.db_name = conn_args.get("database", CONFIG.get("store.mongo.database"))
-
-    async def _get_group_by_id(self, group_id: ObjectId) -> Dict:
-        aggregate = [
-            {
-                "$match": {"_id": group_id},
-            },
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "members",
-                    "foreignField": "_id",
-                    "as": "userMembers",
-                }
-            }
-        ]
-        async for group in self.collection.aggregate(aggregate, collation={"locale": "en", "strength": 2}):
-            return await _transform_group(group)
-
+        # Search totals may be cached for a few seconds, since paging through results repeats the same count:
+        self.count_cache_ttl = float(conn_args.get("count_cache_ttl", CONFIG.get("store.mongo.count_cache_ttl", 0)))
+        self.count_cache: Dict[str, Tuple[float, int]] = {}
+        # Searches (i.e., the list endpoints) may read from secondaries, while reads by ID follow the client's
+        # read preference:
+        search_read_preference = conn_args.get(
+            "search_read_preference", CONFIG.get("store.mongo.search_read_preference")
+        )
+        self.search_read_preference = make_read_preference(
+            read_pref_mode_from_name(search_read_preference), None
+        ) if search_read_preference else None
+
+    async def _get_group_by_id(self, group_id: ObjectId, projection: Projection = Projection()) -> Dict:
+        # Member entries are only read when they're returned:
+        group = await self.collection.find_one(
+            {"_id": group_id}, None if projection.includes("members") else {"members": 0}
+        )
+        if group:
+            return projection.apply(await _transform_group(group))
         raise ResourceNotFound("group", str(group_id))
 
-    async def _get_user_by_id(self, user_id: ObjectId) -> Dict:
-        resource = await self.collection.find_one({"_id": user_id})
+    async def _get_user_by_id(self, user_id: ObjectId, projection: Projection = Projection()) -> Dict:
+        resource = await self.collection.find_one({"_id": user_id}, _find_projection(projection))
         if resource:
-            return await _transform_user(
+            return projection.apply(await _transform_user(
                 await self._sanitize(resource)
-            )
+            ))
         raise ResourceNotFound("User", str(user_id))
 
-    async def get_by_id(self, resource_id: str) -> Dict:
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None) -> Dict:
         _resource_id = ObjectId(resource_id)
+        projection = Projection(attributes, excluded_attributes)
         if self.entity_type == "users":
-            return await self._get_user_by_id(_resource_id)
-        return await self._get_group_by_id(_resource_id)
+            return await self._get_user_by_id(_resource_id, projection)
+        return await self._get_group_by_id(_resource_id, projection)
 
-    async def search(self, _filter: str = None, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
-        parsed_filter = {}
-        if _filter:
-            token_stream = SCIMLexer().tokenize(_filter)
-            ast_nodes = SCIMParser().parse(token_stream)
-            # We only need the root node, which contains all the references in the tree for traversal:
-            _, root = ast.flatten(ast_nodes)[0]
-            parsed_filter = await self.parse_scim_filter(root)
+    async def get_version(self, resource_id: str) -> Optional[str]:
+        document = await self.collection.find_one({"_id": ObjectId(resource_id)}, {VERSION_FIELD: 1})
+        if document is None:
+            raise ResourceNotFound(self.entity_type, resource_id)
+        return make_etag(document.get(VERSION_FIELD, 0))
+
+    async def get_members(self, group_id: str, start_index: int = 1, count: int = 100) -> Tuple[List[Dict], int]:
+        # Member entries are kept in insertion order, so they're sorted by ID on the server before the requested
+        # page is cut ('$sortArray' would need MongoDB 5.2). Only that page is returned:
+        page = [{"$unwind": "$members"}, {"$sort": {"members._id": 1}}, {"$skip": start_index - 1}]
+        # (unwound entries are never null, so an empty page matches nothing)
+        page += [{"$limit": count}] if count > 0 else [{"$match": {"members": None}}]
         aggregate = [
+            {"$match": {"_id": ObjectId(group_id)}},
             {"$facet": {
-                "data": [
-                    {"$match": parsed_filter},
-                    {"$skip": start_index - 1},
-                    {"$limit": count},
-                ],
-                "totalCount": [
-                    {"$match": parsed_filter},
-                    {"$count": "count"},
-                ]
-            }}
+                "group": [{"$project": {"total": {"$size": {"$ifNull": ["$members", []]}}}}],
+                "members": page + [{"$replaceWith": "$members"}],
+            }},
         ]
-        res = []
-        total = 0
-        async for resource in self.collection.aggregate(aggregate, collation={"locale": "en", "strength": 2}):
-            res = [await _transform_user(r) for r in resource.get("data")]
-            total = resource.get("totalCount")[0]["count"] if len(resource.get("totalCount")) > 0 else 0
-            break
-
+        async for result in self.collection.aggregate(aggregate):
+            if len(result["group"]) > 0:
+                members = (await _transform_group({"members": result["members"]})).get("members")
+                return members, result["group"][0]["total"]
+        raise ResourceNotFound("Group", group_id)
+
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        # A single cursor, fetching 'batch_size' documents per round trip:
+        query = {"_id": {"$gt": ObjectId(after)}} if after else {}
+        if self.entity_type == "users":
+            async for user in self.collection.find(query, batch_size=batch_size).sort("_id", 1):
+                yield await _transform_user(await self._sanitize(user))
+            return
+        async for group in self.collection.find(query, batch_size=batch_size).sort("_id", 1):
+            yield await _transform_group(group)
+
+    async def search(self, _filter: str = None, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> tuple[list[Dict], int]:
+        projection = Projection(attributes, excluded_attributes)
+        parsed_filter = {}
+        if _filter:
+            parsed_filter = await self._parse_filter(_filter)
+        collation = CASE_INSENSITIVE_COLLATION if _needs_collation(parsed_filter) else None
+        if self.entity_type == "users":
+            find_projection, transform = _find_projection(projection), _transform_user
+        else:
+            # Members are only returned in searches when they're explicitly requested:
+            find_projection = None if "members" in projection.attributes else {"members": 0}
+            transform = _transform_group
+        # The page and the total are read concurrently, and the page isn't limited to a single result document:
+        page, total = await asyncio.gather(
+            self._find_page(parsed_filter, find_projection, collation, start_index - 1, count),
+            self._count(parsed_filter, collation),
+        )
+        res = [projection.apply(await transform(r)) for r in page]
         return res, total
 
-    async def update(self, resource_id: str, **kwargs: Dict):
-        resource = await self.collection.find_one({"_id": ObjectId(resource_id)})
-        if not resource:
-            ResourceNotFound("User", resource_id)
-        _ = await self.collection.replace_one({"_id": ObjectId(resource_id)}, kwargs, True)
+    async def _find_page(self, parsed_filter: Dict, find_projection: Optional[Dict], collation: Optional[Dict],
+                         skip: int, limit: int) -> List[Dict]:
+        if limit <= 0:
+            # A limit of 0 means no limit to MongoDB:
+            return []
+        cursor = self.search_collection.find(
+            parsed_filter, find_projection, skip=skip, limit=limit, collation=collation
+        )
+        return await cursor.to_list(length=None)
+
+    async def _count(self, parsed_filter: Dict, collation: Optional[Dict]) -> int:
+        cache_key = repr(parsed_filter)
+        now = time.monotonic()
+        if self.count_cache_ttl > 0 and cache_key in self.count_cache:
+            expires_at, total = self.count_cache[cache_key]
+            if expires_at > now:
+                return total
+        if parsed_filter:
+            total = await self.search_collection.count_documents(parsed_filter, collation=collation)
+        else:
+            # Unfiltered totals are read from the collection's metadata, rather than counted:
+            total = await self.search_collection.estimated_document_count()
+        if self.count_cache_ttl > 0:
+            if len(self.count_cache) >= COUNT_CACHE_SIZE:
+                self.count_cache = {k: v for k, v in self.count_cache.items() if v[0] > now}
+            if len(self.count_cache) < COUNT_CACHE_SIZE:
+                self.count_cache[cache_key] = (now + self.count_cache_ttl, total)
+        return total
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
+        if self.entity_type == "groups":
+            return await self._update_group(resource_id, expected_version, **(await self._sanitize(kwargs)))
+        res = await self.collection.update_one(
+            _version_filter(resource_id, expected_version), _replacement_pipeline(_with_shadow_fields({**kwargs}))
+        )
+        if res.matched_count == 0:
+            if expected_version is not None:
+                raise await self._precondition_failed("User", resource_id)
+            raise ResourceNotFound("User", resource_id)
+        if "userName" in kwargs:
+            # The user's entry is updated in the groups it's a member of, whose versions are incremented (unless the
+            # entry already has the name):
+            _ = await self.groups_collection.update_many(
+                {"members": {"$elemMatch": {"_id": ObjectId(resource_id), "userName": {"$ne": kwargs["userName"]}}}},
+                {"$set": {"members.$[member].userName": kwargs["userName"]}, "$inc": {VERSION_FIELD: 1}},
+                array_filters=[{"member._id": ObjectId(resource_id)}],
+            )
         return await self.get_by_id(resource_id)
 
     async def create(self, resource: Dict):
@@ -161,70 +482,129 @@ class MongoDbStore(DocumentStore):
     def collection(self):
         return self.client[self.db_name][self.entity_type]
 
+    @property
+    def search_collection(self):
+        if self.search_read_preference is None:
+            return self.collection
+        return self.collection.with_options(read_preference=self.search_read_preference)
+
+    @property
+    def users_collection(self):
+        return self.client[self.db_name]["users"]
+
+    @property
+    def groups_collection(self):
+        return self.client[self.db_name]["groups"]
+
     async def _create_user(self, user: Dict):
-        inserted_id = (await self.collection.insert_one(user)).inserted_id
+        user[VERSION_FIELD] = 1
+        inserted_id = (await self.collection.insert_one(_with_shadow_fields(user))).inserted_id
         inserted_user = await self.collection.find_one(inserted_id)
         return await _transform_user(inserted_user)
 
     async def _create_group(self, group: Dict):
-        group["members"] = [ObjectId(m.get("value")) for m in group.get("members", [])]
-        inserted_id = (await self.collection.insert_one(group)).inserted_id
+        group["members"] = await _member_entries(
+            self.users_collection, [m.get("value") for m in group.get("members", [])]
+        )
+        group[VERSION_FIELD] = 1
+        inserted_id = (await self.collection.insert_one(_with_shadow_fields(group))).inserted_id
         inserted_group = await self.collection.find_one(inserted_id)
         return await _transform_group(inserted_group)
 
-    async def delete(self, resource_id: str):
-        resource = await self.collection.find_one({"_id": ObjectId(resource_id)})
-        if not resource:
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        documents = []
+        member_entries = {}
+        if self.entity_type == "groups":
+            # The member entries of all the groups are read at once:
+            member_entries = {e["_id"]: e for e in await _member_entries(
+                self.users_collection, [m.get("value") for r in resources for m in r.get("members") or []]
+            )}
+        for resource in resources:
+            document = await self._sanitize(resource)
+            resource_id = document.pop("id", None)
+            # IDs are preserved when they're valid ObjectIds (e.g., when importing an export of a MongoDB store):
+            if resource_id and ObjectId.is_valid(resource_id):
+                document["_id"] = ObjectId(resource_id)
+            if self.entity_type == "groups":
+                member_ids = dict.fromkeys(ObjectId(m.get("value")) for m in document.get("members") or [])
+                document["members"] = [member_entries[oid] for oid in member_ids if oid in member_entries]
+            document[VERSION_FIELD] = 1
+            documents.append(_with_shadow_fields(document))
+        if len(documents) == 0:
+            return []
+        failed = set()
+        try:
+            # An unordered insert continues past duplicates, so an interrupted import can simply be re-run:
+            _ = await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            non_duplicates = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if len(non_duplicates) > 0:
+                raise
+            failed = {err.get("index") for err in e.details.get("writeErrors", [])}
+        # The driver assigns the generated '_id' of each document in place:
+        return [None if i in failed else str(d["_id"]) for i, d in enumerate(documents)]
+
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
+        res = await self.collection.delete_one(_version_filter(resource_id, expected_version))
+        if res.deleted_count == 0:
+            if expected_version is not None:
+                raise await self._precondition_failed(self.entity_type, resource_id)
             raise ResourceNotFound(self.entity_type, resource_id)
-        _ = await self.collection.delete_one({"_id": ObjectId(resource_id)})
+        if self.entity_type == "users":
+            _ = await self.groups_collection.update_many(
+                {"members._id": ObjectId(resource_id)},
+                {"$pull": {"members": {"_id": ObjectId(resource_id)}}, "$inc": {VERSION_FIELD: 1}},
+            )
         return {}
 
     async def clean_up_store(self):
         return await self.collection.drop()
 
-    async def parse_scim_filter(self, node: AST, namespace: str = None) -> Dict:
+    async def _parse_filter(self, _filter: str, attr_map: Dict[str, str] = None) -> Dict:
+        token_stream = SCIMLexer().tokenize(_filter)
+        ast_nodes = SCIMParser().parse(token_stream)
+        # We only need the root node, which contains all the references in the tree for traversal:
+        _, root = ast.flatten(ast_nodes)[0]
+        return await self.parse_scim_filter(root, attr_map=attr_map)
+
+    async def parse_scim_filter(self, node: AST, namespace: str = None, attr_map: Dict[str, str] = None) -> Dict:
         if isinstance(node, Filter):
             ns = node.namespace.attr_name if node.namespace else None
-            expr = await self.parse_scim_filter(node.expr, ns or namespace)
+            expr = await self.parse_scim_filter(node.expr, ns or namespace, attr_map)
             return {"$not": expr} if node.negated else expr
         if isinstance(node, AttrExpr):
             # Parse an atomic comparison operation:
             operator = node.value.lower()
             attr_path: AttrPath = node.attr_path
-            attr = attr_path.attr_name
+            attr = (attr_map or {}).get(attr_path.attr_name.lower(), attr_path.attr_name)
             if attr_path.sub_attr:
                 sub_attr = attr_path.sub_attr.value
                 attr = f"{attr}.{sub_attr}"
             comp_value: CompValue = node.comp_value
             value = comp_value.value if comp_value else None
-            if value:
-                if operator.lower() == "eq" and attr == "id":
-                    return {
-                        "_id": ObjectId(value)
-                    }
-                if operator.lower() == "co" and attr.endswith("emails"):
-                    return {
-                        "emails.value": value
-                    }
-                if operator.lower() == "sw":
-                    operator = "regex"
-                    value = f"^{value}"
-                elif operator.lower() == "ew":
-                    operator = "regex"
-                    value = f"{value}$"
-                elif operator.lower() == "co":
-                    operator = "regex"
-                    value = f"{value}"
+            if value and operator == "eq" and attr == "id":
+                return {
+                    "_id": ObjectId(value)
+                }
             if namespace:
                 attr = f"{namespace}.{attr}"
+            shadow_field = SHADOW_FIELDS.get(attr.lower())
+            if isinstance(value, str) and shadow_field and operator in ("eq", "ne", "sw", "ew", "co"):
+                value = value.lower()
+                if operator in ("eq", "ne"):
+                    return {shadow_field: {f"${operator}": value}}
+                return {shadow_field: {"$regex": _regex(operator, value)}}
+            if isinstance(value, str) and operator in ("sw", "ew", "co"):
+                # Regexes ignore collations, so they're case-insensitive through their own option:
+                return {attr: {"$regex": _regex(operator, value), "$options": "i"}}
             return {
                 attr: {f"${operator}": value}
             }
         if isinstance(node, LogExpr):
             # Parse a logical expression:
             operator = node.op.lower()
-            l_exp = await self.parse_scim_filter(node.expr1, namespace)
-            r_exp = await self.parse_scim_filter(node.expr2, namespace)
+            l_exp = await self.parse_scim_filter(node.expr1, namespace, attr_map)
+            r_exp = await self.parse_scim_filter(node.expr2, namespace, attr_map)
             return {
                 f"${operator}": [
                     l_exp,
@@ -232,41 +612,117 @@ class MongoDbStore(DocumentStore):
                 ]
             }
 
-    async def _update_group(self, group_id: str, **kwargs) -> Dict:
-        group = await self.collection.find_one({"_id": ObjectId(group_id)})
-        if not group:
-            raise ResourceNotFound("group", group_id)
-        _ = await self.collection.replace_one(
-            {"_id": ObjectId(group_id)},
-            kwargs,
-            True
-        )
-        return await _transform_group(await self.collection.find_one({"_id": ObjectId(group_id)}))
+    async def _update_group(self, group_id: str, expected_version: Optional[str] = None, **kwargs) -> Dict:
+        kwargs = {k: v for k, v in kwargs.items() if k not in ("id", "_id", VERSION_FIELD)}
+        if "members" in kwargs:
+            kwargs["members"] = await _member_entries(
+                self.users_collection, [m.get("value") for m in kwargs["members"] or []]
+            )
+        if kwargs or expected_version is not None:
+            changes = {"$set": _with_shadow_fields(kwargs)} if kwargs else {}
+            res = await self.collection.update_one(
+                _version_filter(group_id, expected_version), {**changes, "$inc": {VERSION_FIELD: 1}}
+            )
+            if res.matched_count == 0:
+                if expected_version is not None:
+                    raise await self._precondition_failed("group", group_id)
+                raise ResourceNotFound("group", group_id)
+        return await self._get_group_by_id(ObjectId(group_id))
 
     async def remove_users_from_group(self, user_ids: List[str], group_id: str):
-        group = await self.collection.find_one({"_id": ObjectId(group_id)})
-        if not group:
-            raise ResourceNotFound("group", group_id)
-        _ = await self.collection.update_one(
+        res = await self.collection.update_one(
             {"_id": ObjectId(group_id)},
-            {"$pull": {"members": {"$in": [ObjectId(user_id) for user_id in user_ids]}}},
+            {
+                "$pull": {"members": {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}},
+                "$inc": {VERSION_FIELD: 1},
+            },
         )
+        if res.matched_count == 0:
+            raise ResourceNotFound("group", group_id)
 
     async def add_user_to_group(self, user_id: str, group_id: str):
-        group = await self.collection.find_one({"_id": ObjectId(group_id)})
-        if not group:
+        return await self.add_users_to_group([user_id], group_id)
+
+    async def add_users_to_group(self, user_ids: List[str], group_id: str):
+        entries = await _member_entries(self.users_collection, user_ids)
+        _ = await self._update_group_document(group_id, _members_pipeline(entries, []))
+
+    async def _update_group_document(self, group_id: str, pipeline: List[Dict], expected_version: Optional[str] = None):
+        doc_filter = _version_filter(group_id, expected_version)
+        if pipeline:
+            found = (await self.collection.update_one(
+                doc_filter, pipeline + [{"$set": {VERSION_FIELD: NEXT_VERSION}}]
+            )).matched_count > 0
+        else:
+            found = await self.collection.find_one(doc_filter, {"_id": 1}) is not None
+        if not found:
+            if expected_version is not None:
+                raise await self._precondition_failed("group", group_id)
             raise ResourceNotFound("group", group_id)
-        members = {str(g): None for g in group.get("members", [])}
-        if True or user_id not in members:
-            _ = await self.collection.update_one({"_id": ObjectId(group_id)},
-                                                 {"$push": {"members": ObjectId(user_id)}})
 
     async def set_group_members(self, user_ids: List[str], group_id: str):
-        group = await self.collection.find_one({"_id": ObjectId(group_id)})
-        if not group:
-            raise ResourceNotFound("group", group_id)
-        _ = await self.collection.replace_one(
+        res = await self.collection.update_one(
             {"_id": ObjectId(group_id)},
-            {"members": [ObjectId(user_id) for user_id in user_ids]},
-            True
+            {"$set": {"members": await _member_entries(self.users_collection, user_ids)}, "$inc": {VERSION_FIELD: 1}},
+        )
+        if res.matched_count == 0:
+            raise ResourceNotFound("group", group_id)
+
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        attributes = _with_shadow_fields({
+            k: v for k, v in (await self._sanitize(attributes)).items() if k not in ("id", "_id", VERSION_FIELD)
+        })
+        # The entries of the added members, and of the replacing ones, are read at once:
+        entries = {e["_id"]: e for e in await _member_entries(
+            self.users_collection, [m.get("value") for m in (members or []) + members_to_add]
+        )}
+        if members is not None:
+            attributes["members"] = [
+                entries[oid] for oid in dict.fromkeys(ObjectId(m.get("value")) for m in members) if oid in entries
+            ]
+        # Values are literals in an update pipeline, rather than expressions (e.g., "$name" isn't a field path):
+        pipeline = [{"$set": {k: {"$literal": v} for k, v in attributes.items()}}] if attributes else []
+        pipeline += _members_pipeline(
+            [entries[ObjectId(m.get("value"))] for m in members_to_add if ObjectId(m.get("value")) in entries],
+            member_ids_to_remove,
+        )
+        # The whole patch is a single atomic update (of the expected version, if any):
+        _ = await self._update_group_document(group_id, pipeline, expected_version)
+
+    async def bulk_update_members(self, changes: Dict[str, Tuple[List[str], List[str]]]) -> int:
+        """
+        Adds and removes the members of several groups with a single bulk write.
+
+        :param changes: The IDs of the users to add and the IDs of the users to remove, per group ID
+        :return:        The number of groups that were found
+        """
+        entries = {e["_id"]: e for e in await _member_entries(
+            self.users_collection, [user_id for add_ids, _ in changes.values() for user_id in add_ids]
+        )}
+        pipelines = {
+            group_id: _members_pipeline([entries[ObjectId(u)] for u in add_ids if ObjectId(u) in entries], remove_ids)
+            for group_id, (add_ids, remove_ids) in changes.items()
+        }
+        updates = [
+            UpdateOne({"_id": ObjectId(group_id)}, p + [{"$set": {VERSION_FIELD: NEXT_VERSION}}])
+            for group_id, p in pipelines.items() if p
+        ]
+        if len(updates) == 0:
+            return 0
+        return (await self.collection.bulk_write(updates, ordered=False)).matched_count
+
+    async def search_members(self, _filter: str, group_id: str) -> List[Dict]:
+        # The filter is matched against the group's members only, which are looked up by their '_id' (through the
+        # users' primary index), rather than against the whole users collection:
+        group = await self.collection.find_one({"_id": ObjectId(group_id)}, {"members._id": 1})
+        if not group:
+            raise ResourceNotFound("Group", group_id)
+        member_filter = await self._parse_filter(_filter, MEMBER_ATTRIBUTES)
+        collation = CASE_INSENSITIVE_COLLATION if _needs_collation(member_filter) else None
+        member_ids = [m["_id"] for m in group.get("members") or []]
+        users = self.users_collection.find(
+            {"$and": [{"_id": {"$in": member_ids}}, member_filter]}, {"_id": 1}, collation=collation
         )
+        return [{"value": str(u.get("_id"))} async for u in users]
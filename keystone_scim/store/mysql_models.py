@@ -19,14 +19,16 @@ users = sa.Table(
     sa.Column("userName", sa.VARCHAR, nullable=False),
     sa.Column("displayName", sa.VARCHAR, nullable=False),
     sa.Column("active", sa.Boolean, default=True),
-    sa.Column("customAttributes", JSON)
+    sa.Column("customAttributes", JSON),
+    sa.Column("version", sa.BigInteger, nullable=False, default=1)
 )
 
 groups = sa.Table(
     "groups", metadata,
     sa.Column("id", sa.VARCHAR, primary_key=True),
     sa.Column("displayName", sa.VARCHAR, nullable=False),
-    sa.Column("schemas", JSON, nullable=False)
+    sa.Column("schemas", JSON, nullable=False),
+    sa.Column("version", sa.BigInteger, nullable=False, default=1)
 )
 
 users_groups = sa.Table(
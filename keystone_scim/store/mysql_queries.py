@@ -43,4 +43,97 @@ user_emails_tbl = """
     );
 """
 
-ddl_queries = [users_tbl, groups_tbl, users_groups_tbl, user_emails_tbl]
+schema_version_tbl = """
+    CREATE TABLE IF NOT EXISTS `schema_version` (
+        `version` INTEGER PRIMARY KEY,
+        `appliedAt` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Change log, which lets other replicas evict the written users and groups from their caches (see
+# 'store/invalidation.py'). MySQL can't notify listeners, so the triggers (only installed while
+# 'store.cache.invalidation' is enabled) append to a table that every replica polls:
+changes_tbl = """
+    CREATE TABLE IF NOT EXISTS `changes` (
+        `seq` BIGINT AUTO_INCREMENT PRIMARY KEY,
+        `resourceType` VARCHAR(16) NOT NULL,
+        `resourceId` VARCHAR(256) NOT NULL,
+        `memberId` VARCHAR(256),
+        `changedAt` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX USING BTREE (`changedAt`)
+    );
+"""
+
+ddl_queries = [users_tbl, groups_tbl, users_groups_tbl, user_emails_tbl, schema_version_tbl, changes_tbl]
+
+# Schema migrations, applied in order (and only once) by 'set_up_schema' on top of the DDL above.
+# Changes to existing tables must be added here, rather than to the DDL, so that they also reach
+# existing deployments:
+schema_migration_lock = "SELECT GET_LOCK('keystone_scim_schema_migration', 300);"
+schema_migration_unlock = "SELECT RELEASE_LOCK('keystone_scim_schema_migration');"
+select_schema_version = "SELECT COALESCE(MAX(`version`), 0) AS `version` FROM `schema_version`;"
+insert_schema_version = "INSERT INTO `schema_version` (`version`) VALUES (%s);"
+
+users_groups_group_id_idx = """
+    CREATE INDEX `users_groups_groupid_index` USING BTREE ON `users_groups` (`groupId`);
+"""
+user_emails_user_id_idx = """
+    CREATE INDEX `user_emails_userid_index` USING BTREE ON `user_emails` (`userId`);
+"""
+
+# The version of each user and group, which is incremented by every write and exposed as 'meta.version' (i.e.,
+# as the resource's entity tag):
+users_version_col = "ALTER TABLE `users` ADD COLUMN `version` BIGINT NOT NULL DEFAULT 1;"
+groups_version_col = "ALTER TABLE `groups` ADD COLUMN `version` BIGINT NOT NULL DEFAULT 1;"
+
+# MySQL has no 'IF NOT EXISTS' for these statements, and they're committed one by one, so each of them is paired with
+# a query of the object it creates (and its arguments), and skipped if the object exists. A migration that failed
+# halfway can then be retried:
+index_exists = """
+    SELECT 1 FROM information_schema.`STATISTICS`
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s AND `INDEX_NAME` = %s LIMIT 1;
+"""
+column_exists = """
+    SELECT 1 FROM information_schema.`COLUMNS`
+    WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s AND `COLUMN_NAME` = %s LIMIT 1;
+"""
+
+migrations = [
+    (1, [
+        (index_exists, ("users_groups", "users_groups_groupid_index"), users_groups_group_id_idx),
+        (index_exists, ("user_emails", "user_emails_userid_index"), user_emails_user_id_idx),
+    ]),
+    (2, [
+        (column_exists, ("users", "version"), users_version_col),
+        (column_exists, ("groups", "version"), groups_version_col),
+    ]),
+]
+
+# The resource type, resource ID column and member ID column of the changes of each table:
+change_trigger_tables = {
+    "users": ("users", "`id`", None),
+    "groups": ("groups", "`id`", None),
+    "users_groups": ("groups", "`groupId`", "`userId`"),
+    "user_emails": ("users", "`userId`", None),
+}
+change_trigger_events = ["INSERT", "UPDATE", "DELETE"]
+# The changes that are logged, per table and event (all of them by default). Bumps of a group's version alone come
+# with changes of its members, which are logged by the 'users_groups' triggers:
+change_trigger_conditions = {
+    ("groups", "UPDATE"): "NOT (NEW.`displayName` <=> OLD.`displayName` AND NEW.`schemas` <=> OLD.`schemas`)",
+}
+select_change_triggers = """
+    SELECT `TRIGGER_NAME` AS `name` FROM information_schema.`TRIGGERS`
+    WHERE `TRIGGER_SCHEMA` = DATABASE() AND `TRIGGER_NAME` LIKE '%_change';
+"""
+create_change_trigger = """
+    CREATE TRIGGER `{name}` AFTER {event} ON `{table}` FOR EACH ROW
+        INSERT INTO `changes` (`resourceType`, `resourceId`, `memberId`)
+        SELECT '{resource_type}', {resource_id}, {member_id} FROM DUAL WHERE {condition};
+"""
+drop_change_trigger = "DROP TRIGGER IF EXISTS `{name}`;"
+select_last_change = "SELECT COALESCE(MAX(`seq`), 0) AS `seq` FROM `changes`;"
+select_changes = """
+    SELECT `seq`, `resourceType`, `resourceId`, `memberId` FROM `changes` WHERE `seq` > %s ORDER BY `seq` LIMIT 1000;
+"""
+prune_changes = "DELETE FROM `changes` WHERE `changedAt` < NOW() - INTERVAL 1 HOUR;"
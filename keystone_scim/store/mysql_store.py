@@ -1,28 +1,37 @@
-import json
+import asyncio
 import logging
+import re
 import uuid
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 import aiomysql
 import pymysql.cursors
 from aiomysql.sa import create_engine
 from aiomysql.sa.result import RowProxy
 from scim2_filter_parser.queries import SQLQuery
-from sqlalchemy import delete, insert, select, text, update, and_, or_
+from sqlalchemy import delete, func, insert, literal_column, null, select, text, update, and_, or_
+from sqlalchemy.dialects.mysql import Insert as MySqlInsert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.sql.base import ImmutableColumnCollection
-from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.dml import Update
+from sqlalchemy.sql.elements import ColumnElement, TextClause
 
 from keystone_scim.models.user import DEFAULT_USER_SCHEMA
 from keystone_scim.store import mysql_models as tbl
 from keystone_scim.store import RDBMSStore
-from keystone_scim.store.mysql_queries import ddl_queries
+from keystone_scim.store import mysql_queries as sql
+from keystone_scim.util import json_codec
 from keystone_scim.util.config import Config
-from keystone_scim.util.exc import ResourceNotFound
+from keystone_scim.util.etag import make_etag, version_number
+from keystone_scim.util.exc import PreconditionFailed, ResourceNotFound
+from keystone_scim.util.projection import Projection
 
 CONFIG = Config()
 LOGGER = logging.getLogger(__name__)
 CONN_REFRESH_INTERVAL_SEC = 1 * 60 * 60
+# Every replica prunes the change log every so many polls:
+CHANGES_PRUNE_INTERVAL_POLLS = 600
 
 
 def get_conn_args(**kwargs):
@@ -37,20 +46,221 @@ def get_conn_args(**kwargs):
     return conn_args
 
 
+def get_async_conn_args(**kwargs):
+    """
+    :return: The connection arguments of aiomysql, which differ from pymysql's
+    """
+    conn_args = get_conn_args(**kwargs)
+    conn_args["db"] = conn_args.get("database")
+    if conn_args.get("ssl_disabled") is not None:
+        del conn_args["ssl_disabled"]
+    del conn_args["database"]
+    return conn_args
+
+
 def set_up_schema(**kwargs):
+    change_notifications = kwargs.pop("change_notifications", CONFIG.get("store.cache.invalidation", False))
     conn_args = get_conn_args(**kwargs)
     conn = pymysql.connect(cursorclass=pymysql.cursors.DictCursor, **conn_args)
     with conn:
         with conn.cursor() as cursor:
-            for q in ddl_queries:
+            for q in sql.ddl_queries:
                 cursor.execute(q)
         conn.commit()
+        migrate_schema(conn)
+        set_up_change_notifications(conn, str(change_notifications).lower() == "true")
+
+
+def migrate_schema(conn) -> int:
+    """
+    :param conn: An open pymysql connection (with a dict cursor)
+    :return:     The schema version after applying all pending migrations
+    """
+    with conn.cursor() as cursor:
+        # DDL statements are committed implicitly in MySQL, so concurrent migrations (e.g., several replicas
+        # starting at once) are serialized with a named lock instead of a transaction:
+        cursor.execute(sql.schema_migration_lock)
+        try:
+            cursor.execute(sql.select_schema_version)
+            version = cursor.fetchone()["version"]
+            for migration_version, queries in sql.migrations:
+                if migration_version <= version:
+                    continue
+                LOGGER.info("Applying MySQL schema migration %d", migration_version)
+                for exists_query, exists_args, q in queries:
+                    cursor.execute(exists_query, exists_args)
+                    if cursor.fetchone() is None:
+                        cursor.execute(q)
+                cursor.execute(sql.insert_schema_version, (migration_version,))
+                conn.commit()
+                version = migration_version
+        finally:
+            cursor.execute(sql.schema_migration_unlock)
+    return version
+
+
+def set_up_change_notifications(conn, enabled: bool):
+    """
+    Installs the triggers that log the changes of users and groups (see 'watch_changes') if enabled, and removes
+    them otherwise.
+
+    :param conn:    An open pymysql connection (with a dict cursor)
+    :param enabled: Whether changes are logged
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(sql.schema_migration_lock)
+        try:
+            cursor.execute(sql.select_change_triggers)
+            installed = {row["name"] for row in cursor.fetchall()}
+            for table, (resource_type, resource_id, member_id) in sql.change_trigger_tables.items():
+                for event in sql.change_trigger_events:
+                    name = f"{table}_{event.lower()}_change"
+                    row = "OLD" if event == "DELETE" else "NEW"
+                    if enabled and name not in installed:
+                        cursor.execute(sql.create_change_trigger.format(
+                            name=name,
+                            event=event,
+                            table=table,
+                            resource_type=resource_type,
+                            resource_id=f"{row}.{resource_id}",
+                            member_id=f"{row}.{member_id}" if member_id else "NULL",
+                            condition=sql.change_trigger_conditions.get((table, event), "TRUE"),
+                        ))
+                    elif not enabled and name in installed:
+                        cursor.execute(sql.drop_change_trigger.format(name=name))
+        finally:
+            cursor.execute(sql.schema_migration_unlock)
+
+
+async def watch_changes(on_change: Callable[[Dict], None], on_ready: Callable[[], None], **kwargs):
+    """
+    Polls the change log written by the triggers installed by 'set_up_schema' every 'store.cache.poll_interval'
+    seconds, and calls 'on_change' with each new change, until cancelled or disconnected. Changes are read in
+    the order of their sequence numbers, which concurrent transactions may commit out of order: a change that
+    commits after a later one was read is missed (and its entries are only dropped once they expire).
+    """
+    poll_interval = float(kwargs.pop("poll_interval", CONFIG.get("store.cache.poll_interval", 1)))
+    conn = await aiomysql.connect(autocommit=True, cursorclass=aiomysql.DictCursor, **get_async_conn_args(**kwargs))
+    try:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql.select_last_change)
+            seq = (await cursor.fetchone())["seq"]
+            on_ready()
+            polls = 0
+            while True:
+                await cursor.execute(sql.select_changes, (seq,))
+                for row in await cursor.fetchall():
+                    seq = row["seq"]
+                    change = {"type": row["resourceType"], "id": row["resourceId"]}
+                    if row["memberId"] is not None:
+                        change["members"] = [row["memberId"]]
+                    on_change(change)
+                polls += 1
+                if polls % CHANGES_PRUNE_INTERVAL_POLLS == 0:
+                    await cursor.execute(sql.prune_changes)
+                await asyncio.sleep(poll_interval)
+    finally:
+        conn.close()
+
+
+def _user_aggregates(projection: Projection = Projection()) -> List:
+    # Emails and groups are aggregated in correlated sub-queries (rather than by joining and grouping), so
+    # that only the selected users are aggregated and multiple emails don't multiply the group rows.
+    # Attributes that aren't returned aren't aggregated at all:
+    em_agg = select([func.JSON_ARRAYAGG(func.JSON_OBJECT(
+        literal_column("'value'"), tbl.user_emails.c.value,
+        literal_column("'primary'"), literal_column("CAST(`user_emails`.`primary` is true as JSON)"),
+        literal_column("'type'"), tbl.user_emails.c.type,
+    ))]).where(tbl.user_emails.c.userId == tbl.users.c.id).scalar_subquery().label("emails") \
+        if projection.includes("emails") else null().label("emails")
+    gr_agg = select([func.JSON_ARRAYAGG(func.JSON_OBJECT(
+        literal_column("'displayName'"), tbl.groups.c.displayName,
+    ))]).select_from(
+        tbl.users_groups.join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId)
+    ).where(tbl.users_groups.c.userId == tbl.users.c.id).scalar_subquery().label("groups") \
+        if projection.includes("groups") else null().label("groups")
+    return [em_agg, gr_agg]
+
+
+def _user_row(user_id: str, resource: Dict) -> Dict:
+    custom_schemas = {
+        schema: resource.get(schema, {})
+        for schema in resource["schemas"] if schema != DEFAULT_USER_SCHEMA
+    }
+    return {
+        "id": user_id,
+        "externalId": resource.get("externalId"),
+        "locale": resource.get("locale"),
+        "name": resource.get("name"),
+        "schemas": resource.get("schemas"),
+        "userName": resource.get("userName"),
+        "displayName": resource.get("displayName"),
+        "active": resource.get("active"),
+        "customAttributes": custom_schemas,
+    }
+
+
+def _members_agg() -> ColumnElement:
+    return select([func.JSON_ARRAYAGG(func.JSON_OBJECT(
+        literal_column("'display'"), tbl.users.c.userName,
+        literal_column("'value'"), tbl.users.c.id,
+    ))]).select_from(
+        tbl.users_groups.join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId)
+    ).where(tbl.users_groups.c.groupId == tbl.groups.c.id).scalar_subquery().label("members")
+
+
+def _email_rows(user_id: str, emails: List[Dict]) -> List[Dict]:
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "userId": user_id,
+            "primary": email.get("primary", True),
+            "value": email.get("value"),
+            "type": email.get("type")
+        } for email in emails
+    ]
+
+
+def _bump_group_versions(where: ColumnElement) -> Update:
+    # Groups are versioned as a whole, so changes of their members increment their version too:
+    return update(tbl.groups).where(where).values(version=tbl.groups.c.version + 1)
+
+
+async def _lock_version(conn, table, resource_type: str, resource_id: str, expected_version: Optional[str]) -> int:
+    # Locks the resource's row for the rest of the transaction, so that the write that follows applies to the version
+    # it returns, which must be the expected one (if any):
+    res = await conn.execute(select([table.c.version]).where(table.c.id == resource_id).with_for_update())
+    row = await res.first()
+    if row is None:
+        raise ResourceNotFound(resource_type, resource_id)
+    if expected_version is not None and row.version != version_number(expected_version):
+        raise PreconditionFailed(resource_type, resource_id, make_etag(row.version))
+    return row.version
+
+
+def _semi_join_user_predicates(where: str) -> TextClause:
+    # Each predicate on a user's emails or memberships is evaluated in a correlated EXISTS over them, so that users
+    # are filtered without joining (and grouping back) their emails, and users without emails still match the
+    # other predicates of the filter:
+    for table in (tbl.user_emails, tbl.users_groups):
+        predicate = re.compile(rf"(`{table.name}`\.\S+\s+(?:IS NOT NULL|\S+\s+:\w+))")
+        where = predicate.sub(
+            rf"EXISTS (SELECT 1 FROM `{table.name}` WHERE `{table.name}`.`userId` = `users`.`id` AND \1)", where
+        )
+    return text(where)
+
+
+def _insert_memberships(rows: List[Dict]) -> MySqlInsert:
+    # Memberships that already exist are left as they are. Unlike INSERT IGNORE, this doesn't turn the other errors
+    # of the insert (e.g., truncated values) into warnings:
+    q = mysql_insert(tbl.users_groups).values(rows)
+    return q.on_duplicate_key_update(userId=tbl.users_groups.c.userId)
 
 
 async def _transform_group(group_record: RowProxy) -> Dict:
     members = []
     if group_record.members:
-        members = json.loads(group_record.members)
+        members = json_codec.loads(group_record.members)
         if len(members) > 0 and not isinstance(members[0], dict):
             members = []
 
@@ -58,16 +268,17 @@ async def _transform_group(group_record: RowProxy) -> Dict:
         "id": group_record.id,
         "displayName": group_record.displayName,
         "members": [m for m in members if m.get("value")],
+        "meta": {"version": make_etag(group_record.version)},
     }
 
 
 async def _transform_user(user_record: RowProxy) -> Dict:
     groups = []
     if user_record.groups:
-        groups = json.loads(user_record.groups)
+        groups = json_codec.loads(user_record.groups)
         if len(groups) > 0 and not isinstance(groups[0], dict):
             groups = []
-    emails = json.loads(user_record.emails)
+    emails = json_codec.loads(user_record.emails) if user_record.emails else []
     return {
         "id": user_record.id,
         "userName": user_record.userName,
@@ -79,7 +290,8 @@ async def _transform_user(user_record: RowProxy) -> Dict:
         "active": user_record.active,
         "emails": emails,
         "groups": [g for g in groups if g.get("displayName")],
-        **(user_record.customAttributes or {})
+        **(user_record.customAttributes or {}),
+        "meta": {"version": make_etag(user_record.version)},
     }
 
 
@@ -117,12 +329,7 @@ class MySqlStore(RDBMSStore):
         if not self.engine or not self.last_conn or (
                 datetime.now() - self.last_conn).total_seconds() > CONN_REFRESH_INTERVAL_SEC:
             self.last_conn = datetime.now()
-            conn_args = get_conn_args(**self.conn_args)
-            conn_args["db"] = conn_args.get("database")
-            if conn_args.get("ssl_disabled") is not None:
-                del conn_args["ssl_disabled"]
-            del conn_args["database"]
-            self.engine = await create_engine(**conn_args)
+            self.engine = await create_engine(**get_async_conn_args(**self.conn_args))
         return self.engine
 
     async def term_connection(self):
@@ -131,25 +338,10 @@ class MySqlStore(RDBMSStore):
             engine.close()
             return await engine.wait_closed()
 
-    async def _get_user_by_id(self, user_id: str) -> Dict:
-        em_agg = text("""
-                    JSON_ARRAYAGG(JSON_OBJECT(
-                        'value', `user_emails`.`value`,
-                        'primary', CAST(`user_emails`.`primary` is true as JSON),
-                        'type', `user_emails`.`type`
-                    )) as `emails`
-                """)
-        gr_agg = text("""
-                    JSON_ARRAYAGG(JSON_OBJECT('displayName', `groups`.`displayName`)) as `groups`
-                """)
+    async def _get_user_by_id(self, user_id: str, projection: Projection = Projection()) -> Dict:
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            q = select([tbl.users, em_agg, gr_agg]). \
-                join(tbl.user_emails, tbl.users.c.id == tbl.user_emails.c.userId, isouter=True). \
-                join(tbl.users_groups, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-                join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
-                where(tbl.users.c.id == user_id). \
-                group_by(text("1,2,3,4,5,6,7,8,9"))
+            q = select([tbl.users, *_user_aggregates(projection)]).where(tbl.users.c.id == user_id)
             entity_record = None
             async for row in conn.execute(q):
                 entity_record = row
@@ -157,20 +349,11 @@ class MySqlStore(RDBMSStore):
             if not entity_record:
                 raise ResourceNotFound("User", user_id)
 
-        return await _transform_user(entity_record)
+        return projection.apply(await _transform_user(entity_record))
 
-    async def _get_group_by_id(self, group_id: str):
-        mem_agg = text("""
-                    JSON_ARRAYAGG(JSON_OBJECT(
-                        'display', `users`.`userName`,
-                        'value', `users`.`id`
-                    )) as `members`
-                """)
-        q = select([tbl.groups, mem_agg]). \
-            join(tbl.users_groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
-            join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-            where(tbl.groups.c.id == group_id). \
-            group_by(text("1,2,3"))
+    async def _get_group_by_id(self, group_id: str, projection: Projection = Projection()):
+        mem_agg = _members_agg() if projection.includes("members") else null().label("members")
+        q = select([tbl.groups, mem_agg]).where(tbl.groups.c.id == group_id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
@@ -181,13 +364,24 @@ class MySqlStore(RDBMSStore):
                 if not entity_record:
                     raise ResourceNotFound("Group", group_id)
                 await transaction.commit()
-        return await _transform_group(entity_record)
+        return projection.apply(await _transform_group(entity_record))
 
-    async def get_by_id(self, resource_id: str):
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None):
+        projection = Projection(attributes, excluded_attributes)
         if self.entity_type == "users":
-            return await self._get_user_by_id(resource_id)
+            return await self._get_user_by_id(resource_id, projection)
         if self.entity_type == "groups":
-            return await self._get_group_by_id(resource_id)
+            return await self._get_group_by_id(resource_id, projection)
+
+    async def get_version(self, resource_id: str) -> Optional[str]:
+        table = tbl.users if self.entity_type == "users" else tbl.groups
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            row = await (await conn.execute(select([table.c.version]).where(table.c.id == resource_id))).first()
+        if row is None:
+            raise ResourceNotFound(self.entity_type.rstrip("s").title(), resource_id)
+        return make_etag(row.version)
 
     async def _get_where_clause_from_filter(self, _filter: str, attr_map: Dict)\
             -> Tuple[Optional[TextClause], Dict]:
@@ -200,73 +394,112 @@ class MySqlStore(RDBMSStore):
         for k in parsed_params.keys():
             sqla_params[f"param_{k}"] = parsed_params[k]
             where = where.replace(f"{{{k}}}", f":param_{k}")
-        return text(where), sqla_params
+        return text(f"({where})"), sqla_params
 
-    async def _search_users(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+    async def _search_users(self, _filter: str, start_index: int, count: int,
+                            projection: Projection) -> tuple[list[Dict], int]:
         where_clause, sqla_params = await self._get_where_clause_from_filter(_filter, self.user_attr_map)
-        em_agg = text("""
-                    JSON_ARRAYAGG(JSON_OBJECT(
-                        'value', `user_emails`.`value`,
-                        'primary', CAST(`user_emails`.`primary` is true as JSON),
-                        'type', `user_emails`.`type`
-                    )) as `emails`
-        """)
-        gr_agg = text("""
-            JSON_ARRAYAGG(JSON_OBJECT('displayName', `groups`.`displayName`)) as `groups`
-        """)
-        ct = text("count(*) OVER() as `total`")
+        # First, select the requested page of user IDs, with the filter applied to the users table directly
+        # and to the emails and memberships tables through semi-joins:
+        page_q = select([tbl.users.c.id, func.count().over().label("total")])
+        if where_clause is not None:
+            page_q = page_q.where(_semi_join_user_predicates(where_clause.text))
+        page = page_q.order_by(tbl.users.c.id).offset(start_index - 1).limit(count).cte("page")
+        # Then, aggregate emails and groups only for the users in that page:
+        q = select([tbl.users, *_user_aggregates(projection), page.c.total]). \
+            select_from(page.join(tbl.users, tbl.users.c.id == page.c.id)). \
+            order_by(tbl.users.c.id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            q = select([tbl.users, em_agg, gr_agg, ct]). \
-                join(tbl.user_emails, tbl.users.c.id == tbl.user_emails.c.userId, isouter=True). \
-                join(tbl.users_groups, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-                join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True)
-            if where_clause is not None:
-                q = q.where(where_clause)
-            q = q.group_by(text("1,2,3,4,5,6,7,8,9")).offset(start_index - 1).limit(count)
             users = []
             total = 0
             async for row in conn.execute(q, **sqla_params):
-                users.append(await _transform_user(row))
+                users.append(projection.apply(await _transform_user(row)))
                 total = row.total
 
         return users, total
 
-    async def _search_groups(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+    async def _search_groups(self, _filter: str, start_index: int, count: int,
+                             projection: Projection) -> tuple[list[Dict], int]:
         where_clause, sqla_params = await self._get_where_clause_from_filter(_filter, self.group_attr_map)
         ct = text("count(*) OVER() as `total`")
-        q = select([tbl.groups, text("CAST('[]' AS JSON) as members"), ct]). \
+        # Members are only aggregated in searches when they're explicitly requested:
+        top_level_attributes = projection.top_level_attributes() or set()
+        mem_agg = _members_agg() if "members" in top_level_attributes else text("CAST('[]' AS JSON) as members")
+        q = select([tbl.groups, mem_agg, ct]). \
             join(tbl.users_groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
             join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True)
 
         if where_clause is not None:
             q = q.where(where_clause)
-        q = q.group_by(text("1,2,3,4")).offset(start_index - 1).limit(count)
+        q = q.group_by(text("1,2,3")).offset(start_index - 1).limit(count)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             groups = []
             total = 0
             async for row in conn.execute(q, **sqla_params):
-                groups.append(await _transform_group(row))
+                groups.append(projection.apply(await _transform_group(row)))
                 total = row.total
         return groups, total
 
-    async def search(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+    async def search(self, _filter: str, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> tuple[list[Dict], int]:
+        projection = Projection(attributes, excluded_attributes)
         if self.entity_type == "users":
-            return await self._search_users(_filter, start_index, count)
+            return await self._search_users(_filter, start_index, count, projection)
         if self.entity_type == "groups":
-            return await self._search_groups(_filter, start_index, count)
-
-    async def update(self, resource_id: str, **kwargs: Dict):
+            return await self._search_groups(_filter, start_index, count, projection)
+
+    async def get_members(self, group_id: str, start_index: int = 1, count: int = 100) -> Tuple[List[Dict], int]:
+        # The page is read from the "groupId" index (whose entries are ordered by the primary key, i.e. by
+        # "userId"), so its cost doesn't depend on the group size (besides the offset):
+        total_q = select([func.count()]).select_from(tbl.users_groups). \
+            where(tbl.users_groups.c.groupId == group_id).scalar_subquery()
+        group_q = select([tbl.groups.c.id, total_q.label("total")]).where(tbl.groups.c.id == group_id)
+        page_q = select([tbl.users.c.id, tbl.users.c.userName]). \
+            select_from(tbl.users_groups.join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId)). \
+            where(tbl.users_groups.c.groupId == group_id). \
+            order_by(tbl.users_groups.c.userId).offset(start_index - 1).limit(count)
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            groups = [row async for row in conn.execute(group_q)]
+            if len(groups) == 0:
+                raise ResourceNotFound("Group", group_id)
+            members = [{"display": row.userName, "value": row.id} async for row in conn.execute(page_q)]
+        return members, groups[0].total
+
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        # Keyset pagination: every batch is an index range scan starting after the last ID of the previous
+        # batch, so reading the whole store takes linear time (unlike offset-based pages):
+        if self.entity_type == "users":
+            table, columns, transform = tbl.users, [tbl.users, *_user_aggregates()], _transform_user
+        else:
+            table, columns, transform = tbl.groups, [tbl.groups, _members_agg()], _transform_group
+        engine = await self.get_engine()
+        last_id = after
+        while True:
+            q = select(columns).order_by(table.c.id).limit(batch_size)
+            if last_id is not None:
+                q = q.where(table.c.id > last_id)
+            async with engine.acquire() as conn:
+                rows = [row async for row in conn.execute(q)]
+            for row in rows:
+                yield await transform(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].id
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
         sanitized = await self._sanitize(kwargs)
         if self.entity_type == "users":
-            return await self._update_user(resource_id, **sanitized)
+            return await self._update_user(resource_id, expected_version, **sanitized)
         if self.entity_type == "groups":
-            return await self._update_group(resource_id, **sanitized)
+            return await self._update_group(resource_id, expected_version, **sanitized)
 
-    async def _update_user(self, user_id: str, **kwargs: Dict) -> Dict:
-        # "id" is immutable, and "groups" are updated through the groups API:
-        immutable_cols = ["id", "groups"]
+    async def _update_user(self, user_id: str, expected_version: Optional[str] = None, **kwargs: Dict) -> Dict:
+        # "id" is immutable, "groups" are updated through the groups API, and the version is incremented:
+        immutable_cols = ["id", "groups", "version"]
         for immutable_col in immutable_cols:
             if immutable_col in kwargs:
                 del kwargs[immutable_col]
@@ -282,37 +515,43 @@ class MySqlStore(RDBMSStore):
             attr: kwargs[attr] for attr in kwargs.keys()
             if attr in user_cols
         }
-        q = update(tbl.users).where(tbl.users.c.id == user_id).values(**clean_attributes)
+        # MySQL supports neither RETURNING nor data-modifying CTEs, so the user update, the emails
+        # replacement and the read of the updated user share a single connection and transaction:
+        sel_q = select([tbl.users, *_user_aggregates()]).where(tbl.users.c.id == user_id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
-                _ = await conn.execute(q)
+                _ = await _lock_version(conn, tbl.users, "User", user_id, expected_version)
+                if "userName" in clean_attributes:
+                    # The user's name is the display of its memberships, so renaming it changes its groups:
+                    res = await conn.execute(select([tbl.users.c.userName]).where(tbl.users.c.id == user_id))
+                    if (await res.first()).userName != clean_attributes["userName"]:
+                        _ = await conn.execute(_bump_group_versions(tbl.groups.c.id.in_(
+                            select([tbl.users_groups.c.groupId]).where(tbl.users_groups.c.userId == user_id)
+                        )))
+                _ = await conn.execute(
+                    update(tbl.users).where(tbl.users.c.id == user_id).
+                    values(**clean_attributes, version=tbl.users.c.version + 1)
+                )
+                if update_emails:
+                    _ = await conn.execute(delete(tbl.user_emails).where(tbl.user_emails.c.userId == user_id))
+                entity_record = None
+                if update_emails and len(emails) > 0:
+                    _ = await conn.execute(insert(tbl.user_emails).values(_email_rows(user_id, emails)))
+                async for row in conn.execute(sel_q):
+                    entity_record = row
                 await transaction.commit()
-        if update_emails:
-            del_emails_q = delete(tbl.user_emails).where(tbl.users.c.id == user_id)
-            ins_emails_q = insert(tbl.user_emails).values([
-                {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    "primary": email.get("primary", True),
-                    "value": email.get("value"),
-                    "type": email.get("type")
-                } for email in emails
-            ])
-            async with engine.acquire() as conn:
-                async with conn.begin() as transaction:
-                    _ = await conn.execute(del_emails_q)
-                    _ = await conn.execute(ins_emails_q)
-                    await transaction.commit()
-        return await self._get_user_by_id(user_id)
-
-    async def _update_group(self, group_id: str, **kwargs: Dict) -> Dict:
-        if "id" in kwargs:
-            del kwargs["id"]
-        q = update(tbl.groups).where(tbl.groups.c.id == group_id).values(**kwargs)
+        return await _transform_user(entity_record)
+
+    async def _update_group(self, group_id: str, expected_version: Optional[str] = None, **kwargs: Dict) -> Dict:
+        for immutable_col in ("id", "version"):
+            if immutable_col in kwargs:
+                del kwargs[immutable_col]
+        q = update(tbl.groups).where(tbl.groups.c.id == group_id).values(**kwargs, version=tbl.groups.c.version + 1)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
+                _ = await _lock_version(conn, tbl.groups, "Group", group_id, expected_version)
                 _ = await conn.execute(q)
                 await transaction.commit()
         return await self._get_group_by_id(group_id)
@@ -348,110 +587,154 @@ class MySqlStore(RDBMSStore):
         return await self._get_group_by_id(group_id)
 
     async def _create_user(self, resource: Dict):
-        custom_schemas = {
-            schema: resource.get(schema, {})
-            for schema in resource["schemas"] if schema != DEFAULT_USER_SCHEMA
-        }
         user_id = resource.get("id") or str(uuid.uuid4())
-        insert_user = insert(tbl.users).values(
-            id=user_id,
-            externalId=resource.get("externalId"),
-            locale=resource.get("locale"),
-            name=resource.get("name"),
-            schemas=resource.get("schemas"),
-            userName=resource.get("userName"),
-            displayName=resource.get("displayName"),
-            active=resource.get("active"),
-            customAttributes=custom_schemas
-        ).returning()
+        insert_user = insert(tbl.users).values(**_user_row(user_id, resource))
         emails = resource.get("emails", [{"primary": True, "value": resource.get("userName"), "type": "work"}])
-        insert_emails = insert(tbl.user_emails).values([
-            {
-                "id": str(uuid.uuid4()),
-                "userId": user_id,
-                "primary": email.get("primary", True),
-                "value": email.get("value"),
-                "type": email.get("type")
-            } for email in emails
-        ])
+        insert_emails = insert(tbl.user_emails).values(_email_rows(user_id, emails))
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
                 _ = await conn.execute(insert_user)
-                _ = await conn.execute(insert_emails)
+                if len(emails) > 0:
+                    _ = await conn.execute(insert_emails)
                 await transaction.commit()
-        return {**resource, "id": user_id}
+        return {**resource, "id": user_id, "meta": {"version": make_etag(1)}}
 
-    async def delete(self, resource_id: str):
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        if len(resources) == 0:
+            return []
+        sanitized = [{**(await self._sanitize(r)), "id": r.get("id") or str(uuid.uuid4())} for r in resources]
         if self.entity_type == "users":
-            return await self._delete_user(resource_id)
+            return await self._bulk_create_users(sanitized)
         if self.entity_type == "groups":
-            return await self._delete_group(resource_id)
+            return await self._bulk_create_groups(sanitized)
+
+    async def _bulk_create_users(self, resources: List[Dict]) -> List[Optional[str]]:
+        # MySQL has no RETURNING, so users that already exist (by ID or userName) are looked up first and
+        # skipped, so that an interrupted import can simply be re-run:
+        existing_q = select([tbl.users.c.id, tbl.users.c.userName]).where(or_(
+            tbl.users.c.id.in_([r["id"] for r in resources]),
+            tbl.users.c.userName.in_([r.get("userName") for r in resources]),
+        ))
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin() as transaction:
+                taken = set()
+                async for row in conn.execute(existing_q):
+                    taken.update([("id", row.id.lower()), ("userName", row.userName.lower())])
+                new_users, created = [], []
+                for r in resources:
+                    keys = {("id", r["id"].lower()), ("userName", str(r.get("userName")).lower())}
+                    if taken.isdisjoint(keys):
+                        new_users.append(r)
+                        taken.update(keys)
+                        created.append(r["id"])
+                    else:
+                        created.append(None)
+                email_rows = []
+                for r in new_users:
+                    emails = r.get("emails", [{"primary": True, "value": r.get("userName"), "type": "work"}])
+                    email_rows.extend(_email_rows(r["id"], emails))
+                if len(new_users) > 0:
+                    _ = await conn.execute(insert(tbl.users).values([_user_row(r["id"], r) for r in new_users]))
+                if len(email_rows) > 0:
+                    _ = await conn.execute(insert(tbl.user_emails).values(email_rows))
+                await transaction.commit()
+        return created
+
+    async def _bulk_create_groups(self, resources: List[Dict]) -> List[Optional[str]]:
+        existing_q = select([tbl.groups.c.id, tbl.groups.c.displayName]).where(or_(
+            tbl.groups.c.id.in_([r["id"] for r in resources]),
+            tbl.groups.c.displayName.in_([r.get("displayName") for r in resources]),
+        ))
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin() as transaction:
+                taken = set()
+                async for row in conn.execute(existing_q):
+                    taken.update([("id", row.id.lower()), ("displayName", row.displayName.lower())])
+                new_groups, created = [], []
+                for r in resources:
+                    keys = {("id", r["id"].lower()), ("displayName", str(r.get("displayName")).lower())}
+                    if taken.isdisjoint(keys):
+                        new_groups.append(r)
+                        taken.update(keys)
+                        created.append(r["id"])
+                    else:
+                        created.append(None)
+                member_rows = [
+                    {"userId": m.get("value"), "groupId": r["id"]} for r in new_groups for m in r.get("members", [])
+                ]
+                if len(new_groups) > 0:
+                    _ = await conn.execute(insert(tbl.groups).values([
+                        {"id": r["id"], "schemas": r.get("schemas"), "displayName": r.get("displayName")}
+                        for r in new_groups
+                    ]))
+                if len(member_rows) > 0:
+                    _ = await conn.execute(_insert_memberships(member_rows))
+                await transaction.commit()
+        return created
 
-    async def _delete_user(self, user_id: str):
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
+        if self.entity_type == "users":
+            return await self._delete_user(resource_id, expected_version)
+        if self.entity_type == "groups":
+            return await self._delete_group(resource_id, expected_version)
+
+    async def _delete_user(self, user_id: str, expected_version: Optional[str] = None):
         del_q = [
             delete(tbl.user_emails).where(tbl.user_emails.c.userId == user_id),
+            _bump_group_versions(tbl.groups.c.id.in_(
+                select([tbl.users_groups.c.groupId]).where(tbl.users_groups.c.userId == user_id)
+            )),
             delete(tbl.users_groups).where(tbl.users_groups.c.userId == user_id),
             delete(tbl.users).where(tbl.users.c.id == user_id),
         ]
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
-                sel_q = select(tbl.users).where(tbl.users.c.id == user_id)
-                user = None
-                async for row in conn.execute(sel_q):
-                    user = row
-                    break
-                if not user:
-                    raise ResourceNotFound("User", user_id)
+                _ = await _lock_version(conn, tbl.users, "User", user_id, expected_version)
                 for q in del_q:
                     _ = await conn.execute(q)
                 transaction.commit()
         return {}
 
-    async def _delete_group(self, group_id: str):
+    async def _delete_group(self, group_id: str, expected_version: Optional[str] = None):
         del_q = delete(tbl.groups).where(tbl.groups.c.id == group_id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
-                sel_q = select(tbl.groups).where(tbl.groups.c.id == group_id)
-                group = None
-                async for row in conn.execute(sel_q):
-                    group = row
-                    break
-                if not group:
-                    raise ResourceNotFound("Group", group_id)
+                _ = await _lock_version(conn, tbl.groups, "Group", group_id, expected_version)
                 _ = await conn.execute(del_q)
                 await transaction.commit()
         return {}
 
     async def remove_users_from_group(self, user_ids: List[str], group_id: str):
-        user_id_conditions = []
-        for user_id in user_ids:
-            user_id_conditions.append(tbl.users_groups.c.userId == user_id)
         q = delete(tbl.users_groups).where(
             and_(
                 tbl.users_groups.c.groupId == group_id,
-                or_(*user_id_conditions)
+                tbl.users_groups.c.userId.in_(user_ids)
             )
         )
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
                 _ = await conn.execute(q)
                 await transaction.commit()
         return
 
     async def add_user_to_group(self, user_id: str, group_id: str):
-        check_q = select(tbl.users_groups).where(
-            and_(tbl.users_groups.c.userId == user_id, tbl.users_groups.c.groupId == group_id)
-        )
-        insert_q = insert(tbl.users_groups).values(userId=user_id, groupId=group_id)
+        return await self.add_users_to_group([user_id], group_id)
+
+    async def add_users_to_group(self, user_ids: List[str], group_id: str):
+        if len(user_ids) == 0:
+            return
+        insert_q = _insert_memberships([{"userId": uid, "groupId": group_id} for uid in user_ids])
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
-                async for row in await conn.execute(check_q):
-                    return
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
                 _ = await conn.execute(insert_q)
                 await transaction.commit()
         return
@@ -464,11 +747,46 @@ class MySqlStore(RDBMSStore):
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             async with conn.begin() as transaction:
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
                 _ = await conn.execute(delete_q)
-                _ = await conn.execute(insert_q)
+                if len(user_ids) > 0:
+                    _ = await conn.execute(insert_q)
                 await transaction.commit()
         return
 
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        # The patch is applied in a single transaction. The group's row, locked for update (and checked against the
+        # expected version, if any), serializes concurrent patches of the same group:
+        group_values = {
+            k: v for k, v in (await self._sanitize(attributes)).items()
+            if k not in ("id", "version") and k in tbl.groups.c
+        }
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin() as transaction:
+                _ = await _lock_version(conn, tbl.groups, "Group", group_id, expected_version)
+                _ = await conn.execute(
+                    update(tbl.groups).where(tbl.groups.c.id == group_id).
+                    values(**group_values, version=tbl.groups.c.version + 1)
+                )
+                user_ids = []
+                if members is not None:
+                    _ = await conn.execute(delete(tbl.users_groups).where(tbl.users_groups.c.groupId == group_id))
+                    user_ids = [m.get("value") for m in members]
+                if member_ids_to_remove:
+                    _ = await conn.execute(delete(tbl.users_groups).where(and_(
+                        tbl.users_groups.c.groupId == group_id,
+                        tbl.users_groups.c.userId.in_(member_ids_to_remove)
+                    )))
+                user_ids += [m.get("value") for m in members_to_add]
+                if user_ids:
+                    _ = await conn.execute(_insert_memberships(
+                        [{"userId": uid, "groupId": group_id} for uid in user_ids]
+                    ))
+                await transaction.commit()
+
     async def search_members(self, _filter: str, group_id: str):
         parsed_q = SQLQuery(_filter, "users_groups", self.user_attr_map)
         where = parsed_q.where_sql
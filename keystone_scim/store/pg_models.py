@@ -20,6 +20,7 @@ users = sa.Table(
     sa.Column("displayName", sa.Text, nullable=False),
     sa.Column("active", sa.Boolean, default=True),
     sa.Column("customAttributes", JSONB),
+    sa.Column("version", sa.BigInteger, nullable=False, default=1),
     schema=_schema
 )
 
@@ -28,6 +29,7 @@ groups = sa.Table(
     sa.Column("id", sa.Text, primary_key=True),
     sa.Column("displayName", sa.Text, nullable=False),
     sa.Column("schemas", JSONB, nullable=False),
+    sa.Column("version", sa.BigInteger, nullable=False, default=1),
     schema=_schema
 )
 
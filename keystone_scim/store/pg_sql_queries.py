@@ -50,5 +50,116 @@ user_emails_idx = """
     CREATE INDEX IF NOT EXISTS user_emails_value_index ON "{}".user_emails("value");
 """
 
+schema_version_tbl = """
+    CREATE TABLE IF NOT EXISTS "{}".schema_version (
+        "version" INTEGER PRIMARY KEY,
+        "appliedAt" TIMESTAMP NOT NULL DEFAULT now()
+    );
+"""
+
 ddl_queries = [scim_schema, citext_extension, users_tbl, users_idx, groups_tbl, groups_idx, users_groups_tbl,
-               user_emails_tbl, user_emails_idx]
+               user_emails_tbl, user_emails_idx, schema_version_tbl]
+
+# Schema migrations, applied in order (and only once) by 'set_up_schema' on top of the DDL above.
+# Changes to existing tables must be added here, rather than to the DDL, so that they also reach
+# existing deployments:
+schema_migration_lock = "SELECT pg_advisory_xact_lock(hashtext('keystone_scim_schema_migration'));"
+select_schema_version = "SELECT COALESCE(MAX(\"version\"), 0) FROM \"{}\".schema_version;"
+insert_schema_version = "INSERT INTO \"{}\".schema_version (\"version\") VALUES (%s);"
+
+users_groups_group_id_idx = """
+    CREATE INDEX IF NOT EXISTS users_groups_groupid_index ON "{}".users_groups("groupId");
+"""
+user_emails_user_id_idx = """
+    CREATE INDEX IF NOT EXISTS user_emails_userid_index ON "{}".user_emails("userId");
+"""
+# Serves member pages (ordered by "userId") of a group, and supersedes the "groupId" index:
+users_groups_group_id_user_id_idx = """
+    CREATE INDEX IF NOT EXISTS users_groups_groupid_userid_index ON "{}".users_groups("groupId", "userId");
+"""
+drop_users_groups_group_id_idx = """
+    DROP INDEX IF EXISTS "{}".users_groups_groupid_index;
+"""
+
+# The version of each user and group, which is incremented by every write and exposed as 'meta.version' (i.e.,
+# as the resource's entity tag). Adding a column with a constant default doesn't rewrite the table:
+users_version_col = """
+    ALTER TABLE "{0}".users ADD COLUMN IF NOT EXISTS "version" BIGINT NOT NULL DEFAULT 1;
+"""
+groups_version_col = """
+    ALTER TABLE "{0}".groups ADD COLUMN IF NOT EXISTS "version" BIGINT NOT NULL DEFAULT 1;
+"""
+
+migrations = [
+    (1, [users_groups_group_id_idx, user_emails_user_id_idx]),
+    (2, [users_groups_group_id_user_id_idx, drop_users_groups_group_id_idx]),
+    (3, [users_version_col, groups_version_col]),
+]
+
+# Change notifications, which let other replicas evict the written users and groups from their caches (see
+# 'store/invalidation.py'). The triggers are only installed while 'store.cache.invalidation' is enabled:
+changes_channel = "keystone_scim_changes"
+listen_changes = f"LISTEN {changes_channel};"
+notify_change_fn = """
+    CREATE OR REPLACE FUNCTION "{0}".notify_scim_change() RETURNS trigger AS $$
+    DECLARE
+        changed RECORD;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := OLD;
+        ELSE
+            changed := NEW;
+        END IF;
+        IF TG_TABLE_NAME = 'users_groups' THEN
+            PERFORM pg_notify('keystone_scim_changes', json_build_object(
+                'type', 'groups', 'id', changed."groupId", 'members', json_build_array(changed."userId")
+            )::text);
+        ELSIF TG_TABLE_NAME = 'user_emails' THEN
+            PERFORM pg_notify('keystone_scim_changes', json_build_object(
+                'type', 'users', 'id', changed."userId"
+            )::text);
+        ELSIF TG_TABLE_NAME = 'groups' AND TG_OP = 'UPDATE'
+                AND to_jsonb(NEW) - 'version' = to_jsonb(OLD) - 'version' THEN
+            -- Bumps of a group's version alone come with changes of its members, which are notified above
+            NULL;
+        ELSE
+            PERFORM pg_notify('keystone_scim_changes', json_build_object(
+                'type', TG_TABLE_NAME, 'id', changed."id"
+            )::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+change_trigger_tables = ["users", "groups", "users_groups", "user_emails"]
+select_change_triggers = """
+    SELECT t.tgname FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s AND t.tgname LIKE '%%_notify_change';
+"""
+create_change_trigger = """
+    CREATE TRIGGER "{1}_notify_change" AFTER INSERT OR UPDATE OR DELETE ON "{0}"."{1}"
+        FOR EACH ROW EXECUTE PROCEDURE "{0}".notify_scim_change();
+"""
+drop_change_trigger = "DROP TRIGGER IF EXISTS \"{1}_notify_change\" ON \"{0}\".\"{1}\";"
+
+# Optional trigram indexes, which serve the 'co', 'sw' and 'ew' filter operators (translated to
+# '"column"::text ILIKE ...'); the indexed expressions must therefore match those predicates exactly:
+trgm_extension = "CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA \"{0}\";"
+users_trgm_idx = """
+    CREATE INDEX IF NOT EXISTS users_username_trgm_index ON "{0}".users
+        USING GIN (("userName"::text) "{0}".gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS users_displayname_trgm_index ON "{0}".users
+        USING GIN (("displayName"::text) "{0}".gin_trgm_ops);
+"""
+groups_trgm_idx = """
+    CREATE INDEX IF NOT EXISTS groups_displayname_trgm_index ON "{0}".groups
+        USING GIN (("displayName"::text) "{0}".gin_trgm_ops);
+"""
+user_emails_trgm_idx = """
+    CREATE INDEX IF NOT EXISTS user_emails_value_trgm_index ON "{0}".user_emails
+        USING GIN ((value::text) "{0}".gin_trgm_ops);
+"""
+
+trgm_ddl_queries = [trgm_extension, users_trgm_idx, groups_trgm_idx, user_emails_trgm_idx]
@@ -1,29 +1,50 @@
 import re
 from datetime import datetime
+import functools
 import logging
 import urllib.parse
 import uuid
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 import aiopg
 import psycopg2
+import psycopg2.extras
 from aiopg.sa import create_engine
+from aiopg.sa.engine import get_dialect
 from aiopg.sa.result import RowProxy
 from scim2_filter_parser.queries import SQLQuery
-from sqlalchemy import delete, insert, select, text, update, and_, or_
+from sqlalchemy import Table, Text, bindparam, cast, delete, func, insert, literal_column, null, select, text, true, \
+    update, values, and_, column
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.sql.base import ImmutableColumnCollection
-from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.dml import Insert, Update
+from sqlalchemy.sql.elements import ColumnElement, TextClause
 
 from keystone_scim.models.user import DEFAULT_USER_SCHEMA
 from keystone_scim.store import RDBMSStore
-from keystone_scim.store.pg_sql_queries import ddl_queries
+from keystone_scim.store import pg_sql_queries as sql
 from keystone_scim.store import pg_models as tbl
+from keystone_scim.util import json_codec
 from keystone_scim.util.config import Config
-from keystone_scim.util.exc import ResourceNotFound
+from keystone_scim.util.etag import make_etag, version_number
+from keystone_scim.util.exc import PreconditionFailed, ResourceNotFound
+from keystone_scim.util.projection import Projection
 
 CONFIG = Config()
 LOGGER = logging.getLogger(__name__)
 CONN_REFRESH_INTERVAL_SEC = 1 * 60 * 60
+WHERE_CLAUSE_CACHE_SIZE = 256
+# JSON parameters are encoded by SQLAlchemy with the JSON codec of the process (see '_register_json_codec'):
+DIALECT = get_dialect(json_serializer=lambda obj: json_codec.dumps(obj))
+
+
+async def _register_json_codec(conn: aiopg.Connection):
+    # JSON values (including the aggregated emails, groups and members) are decoded by psycopg2 with the JSON codec
+    # of the process. The codec is registered on the store's own connections only, rather than globally, which
+    # would change the decoding of every other psycopg2 connection of the process:
+    psycopg2.extras.register_default_json(conn.raw, loads=lambda s: json_codec.loads(s))
+    psycopg2.extras.register_default_jsonb(conn.raw, loads=lambda s: json_codec.loads(s))
 
 
 def build_dsn(**kwargs):
@@ -44,18 +65,201 @@ def set_up_schema(**kwargs):
         dsn=build_dsn(**kwargs)
     )
     schema = CONFIG.get("store.pg.schema", "public")
+    trigram_indexes = kwargs.get("trigram_indexes", CONFIG.get("store.pg.trigram_indexes", False))
+    queries = sql.ddl_queries
+    if str(trigram_indexes).lower() == "true":
+        queries = queries + sql.trgm_ddl_queries
     cursor = conn.cursor()
-    for q in ddl_queries:
+    for q in queries:
         cursor.execute(q.format(schema))
         conn.commit()
+    migrate_schema(conn, schema)
+    change_notifications = kwargs.get("change_notifications", CONFIG.get("store.cache.invalidation", False))
+    set_up_change_notifications(conn, schema, str(change_notifications).lower() == "true")
     conn.close()
 
 
+def migrate_schema(conn, schema: str) -> int:
+    """
+    :param conn:   An open psycopg2 connection
+    :param schema: The schema to migrate
+    :return:       The schema version after applying all pending migrations
+    """
+    cursor = conn.cursor()
+    # The lock serializes concurrent migrations (e.g., several replicas starting at once) until commit:
+    cursor.execute(sql.schema_migration_lock)
+    cursor.execute(sql.select_schema_version.format(schema))
+    version = cursor.fetchone()[0]
+    for migration_version, queries in sql.migrations:
+        if migration_version <= version:
+            continue
+        LOGGER.info("Applying PostgreSQL schema migration %d", migration_version)
+        for q in queries:
+            cursor.execute(q.format(schema))
+        cursor.execute(sql.insert_schema_version.format(schema), (migration_version,))
+        version = migration_version
+    conn.commit()
+    return version
+
+
+def set_up_change_notifications(conn, schema: str, enabled: bool):
+    """
+    Installs the triggers that notify the changes of users and groups (see 'watch_changes') if enabled, and
+    removes them otherwise.
+
+    :param conn:    An open psycopg2 connection
+    :param schema:  The schema of the tables
+    :param enabled: Whether changes are notified
+    """
+    cursor = conn.cursor()
+    cursor.execute(sql.schema_migration_lock)
+    cursor.execute(sql.select_change_triggers, (schema,))
+    installed = {row[0] for row in cursor.fetchall()}
+    if enabled:
+        cursor.execute(sql.notify_change_fn.format(schema))
+    for table in sql.change_trigger_tables:
+        if enabled and f"{table}_notify_change" not in installed:
+            cursor.execute(sql.create_change_trigger.format(schema, table))
+        elif not enabled and f"{table}_notify_change" in installed:
+            cursor.execute(sql.drop_change_trigger.format(schema, table))
+    conn.commit()
+
+
+async def watch_changes(on_change: Callable[[Dict], None], on_ready: Callable[[], None], **kwargs):
+    """
+    Calls 'on_change' with each change notified by the triggers installed by 'set_up_schema', until cancelled
+    or disconnected. Notifications are only delivered once their transaction commits.
+    """
+    async with aiopg.connect(dsn=build_dsn(**kwargs)) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql.listen_changes)
+        on_ready()
+        while True:
+            notification = await conn.notifies.get()
+            on_change(json_codec.loads(notification.payload))
+
+
+@functools.lru_cache(maxsize=WHERE_CLAUSE_CACHE_SIZE)
+def _compile_where_clause(where: str) -> TextClause:
+    # The where clause template only contains bind parameter placeholders, so it is identical for every
+    # filter of the same shape (e.g., 'userName eq "..."') and can be compiled once and reused. It is
+    # wrapped in parentheses so that it can be safely combined with other conditions.
+    # LIKE predicates ('co', 'sw' and 'ew') are rewritten as case-insensitive matches on the column's text
+    # value, which is the form served by the (optional) trigram indexes:
+    insensitive_like = re.compile(r"(\S+)\s+LIKE\s+", re.IGNORECASE)
+    where = insensitive_like.sub(r"\1::text ILIKE ", where)
+    return text(f"({where})")
+
+
+@functools.lru_cache(maxsize=WHERE_CLAUSE_CACHE_SIZE)
+def _semi_join_user_predicates(where: str) -> TextClause:
+    # Each predicate on a user's emails or memberships is evaluated in a correlated EXISTS over them, so that users
+    # are filtered without joining (and grouping back) their emails, and users without emails still match the
+    # other predicates of the filter:
+    for table in (tbl.user_emails, tbl.users_groups):
+        predicate = re.compile(rf"({table.name}\.\S+\s+(?:IS NOT NULL|\S+\s+:\w+))")
+        where = predicate.sub(
+            rf'EXISTS (SELECT 1 FROM "{table.schema}".{table.name} WHERE {table.name}."userId" = users.id AND \1)',
+            where
+        )
+    return text(where)
+
+
+def _emails_agg(emails) -> ColumnElement:
+    return func.json_agg(func.json_build_object(
+        literal_column("'value'"), emails.c.value,
+        literal_column("'primary'"), emails.c.primary,
+        literal_column("'type'"), emails.c.type,
+    ))
+
+
+def _user_aggregates(user_id: ColumnElement = tbl.users.c.id, projection: Projection = Projection()) -> List:
+    # Emails and groups are aggregated in correlated sub-queries (rather than by joining and grouping), so
+    # that only the selected users are aggregated and multiple emails don't multiply the group rows.
+    # Attributes that aren't returned aren't aggregated at all:
+    em_agg = select([_emails_agg(tbl.user_emails)]). \
+        where(tbl.user_emails.c.userId == user_id).scalar_subquery().label("emails") \
+        if projection.includes("emails") else null().label("emails")
+    gr_agg = select([func.json_agg(func.json_build_object(
+        literal_column("'displayName'"), tbl.groups.c.displayName,
+    ))]).select_from(
+        tbl.users_groups.join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId)
+    ).where(tbl.users_groups.c.userId == user_id).scalar_subquery().label("groups") \
+        if projection.includes("groups") else null().label("groups")
+    return [em_agg, gr_agg]
+
+
+def _members_agg(group_id: ColumnElement = tbl.groups.c.id) -> ColumnElement:
+    return select([func.json_agg(func.json_build_object(
+        literal_column("'display'"), tbl.users.c.userName,
+        literal_column("'value'"), tbl.users.c.id,
+    ))]).select_from(
+        tbl.users_groups.join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId)
+    ).where(tbl.users_groups.c.groupId == group_id).scalar_subquery().label("members")
+
+
+def _email_rows(user_id: str, emails: List[Dict]) -> List[Dict]:
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "userId": user_id,
+            "primary": email.get("primary", True),
+            "value": email.get("value"),
+            "type": email.get("type")
+        } for email in emails
+    ]
+
+
+def _user_row(user_id: str, resource: Dict) -> Dict:
+    custom_schemas = {
+        schema: resource.get(schema, {})
+        for schema in resource["schemas"] if schema != DEFAULT_USER_SCHEMA
+    }
+    return {
+        "id": user_id,
+        "externalId": resource.get("externalId"),
+        "locale": resource.get("locale"),
+        "name": resource.get("name"),
+        "schemas": resource.get("schemas"),
+        "userName": resource.get("userName"),
+        "displayName": resource.get("displayName"),
+        "active": resource.get("active"),
+        "customAttributes": custom_schemas,
+    }
+
+
+def _recordset_insert(table: Table, rows: List[Dict]) -> Insert:
+    # COPY isn't available on asynchronous psycopg2 connections, so bulk inserts send the whole batch as a
+    # single JSON parameter, which is expanded into rows on the server. Unlike a multi-row VALUES clause,
+    # the statement is the same for every batch size and doesn't bind a parameter per value. Columns that
+    # aren't in the rows keep their defaults:
+    names = [c.name for c in table.c if c.name in rows[0]]
+    recordset = func.jsonb_populate_recordset(
+        literal_column(f'NULL::"{table.schema}".{table.name}'),
+        cast(bindparam("rows", json_codec.dumps(rows)), JSONB),
+    ).table_valued(*names)
+    return pg_insert(table).from_select(names, select([recordset.c[n] for n in names]))
+
+
+def _bump_group_versions(where: ColumnElement) -> Update:
+    # Groups are versioned as a whole, so changes of their members increment their version too:
+    return update(tbl.groups).where(where).values(version=tbl.groups.c.version + 1)
+
+
+def _version_condition(table: Table, resource_id: str, expected_version: Optional[str]) -> ColumnElement:
+    # A write conditioned on a version only matches the resource's row while the row has that version:
+    condition = table.c.id == resource_id
+    if expected_version is not None:
+        condition = and_(condition, table.c.version == version_number(expected_version))
+    return condition
+
+
 async def _transform_group(group_record: RowProxy) -> Dict:
     return {
         "id": group_record.id,
         "displayName": group_record.displayName,
-        "members": [m for m in group_record.members if m.get("value")],
+        "members": [m for m in (group_record.members or []) if m.get("value")],
+        "meta": {"version": make_etag(group_record.version)},
     }
 
 
@@ -69,9 +273,10 @@ async def _transform_user(user_record: RowProxy) -> Dict:
         "name": user_record.name,
         "displayName": user_record.displayName,
         "active": user_record.active,
-        "emails": user_record.emails,
-        "groups": [g for g in user_record.groups if g.get("displayName")],
-        **(user_record.customAttributes or {})
+        "emails": user_record.emails or [],
+        "groups": [g for g in (user_record.groups or []) if g.get("displayName")],
+        **(user_record.customAttributes or {}),
+        "meta": {"version": make_etag(user_record.version)},
     }
 
 
@@ -113,7 +318,9 @@ class PostgresqlStore(RDBMSStore):
                 datetime.now() - self.last_conn).total_seconds() > CONN_REFRESH_INTERVAL_SEC:
             LOGGER.debug("Establishing new PostgreSQL connection")
             self.last_conn = datetime.now()
-            self.engine = await create_engine(dsn=build_dsn(**self.conn_args))
+            self.engine = await create_engine(
+                dsn=build_dsn(**self.conn_args), dialect=DIALECT, on_connect=_register_json_codec
+            )
             LOGGER.debug("Established new PostgreSQL connection")
         return self.engine
 
@@ -123,25 +330,10 @@ class PostgresqlStore(RDBMSStore):
             engine.close()
             return await engine.wait_closed()
 
-    async def _get_user_by_id(self, user_id: str) -> Dict:
-        em_agg = text("""
-            array_agg(json_build_object(
-                'value', user_emails.value,
-                'primary', user_emails.primary,
-                'type', user_emails.type
-            )) as emails
-        """)
-        gr_agg = text("""
-            array_agg(json_build_object('displayName', groups."displayName")) as groups
-        """)
+    async def _get_user_by_id(self, user_id: str, projection: Projection = Projection()) -> Dict:
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            q = select([tbl.users, em_agg, gr_agg]). \
-                join(tbl.user_emails, tbl.users.c.id == tbl.user_emails.c.userId, isouter=True). \
-                join(tbl.users_groups, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-                join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
-                where(tbl.users.c.id == user_id). \
-                group_by(text("1,2,3,4,5,6,7,8,9"))
+            q = select([tbl.users, *_user_aggregates(projection=projection)]).where(tbl.users.c.id == user_id)
             entity_record = None
             async for row in conn.execute(q):
                 entity_record = row
@@ -149,20 +341,11 @@ class PostgresqlStore(RDBMSStore):
             if not entity_record:
                 raise ResourceNotFound("User", user_id)
 
-        return await _transform_user(entity_record)
+        return projection.apply(await _transform_user(entity_record))
 
-    async def _get_group_by_id(self, group_id: str):
-        mem_agg = text("""
-            array_agg(json_build_object(
-                'display', users."userName",
-                'value', users."id"
-            )) as members
-        """)
-        q = select([tbl.groups, mem_agg]). \
-            join(tbl.users_groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
-            join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-            where(tbl.groups.c.id == group_id). \
-            group_by(text("1,2,3"))
+    async def _get_group_by_id(self, group_id: str, projection: Projection = Projection()):
+        mem_agg = _members_agg() if projection.includes("members") else null().label("members")
+        q = select([tbl.groups, mem_agg]).where(tbl.groups.c.id == group_id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             entity_record = None
@@ -171,92 +354,144 @@ class PostgresqlStore(RDBMSStore):
                 break
             if not entity_record:
                 raise ResourceNotFound("Group", group_id)
-        return await _transform_group(entity_record)
+        return projection.apply(await _transform_group(entity_record))
 
-    async def get_by_id(self, resource_id: str):
+    async def get_by_id(self, resource_id: str, attributes: Optional[List[str]] = None,
+                        excluded_attributes: Optional[List[str]] = None):
+        projection = Projection(attributes, excluded_attributes)
         if self.entity_type == "users":
-            return await self._get_user_by_id(resource_id)
+            return await self._get_user_by_id(resource_id, projection)
         if self.entity_type == "groups":
-            return await self._get_group_by_id(resource_id)
+            return await self._get_group_by_id(resource_id, projection)
 
-    async def _get_where_clause_from_filter(self, _filter: str, attr_map: Dict) -> Optional[TextClause]:
+    async def get_version(self, resource_id: str) -> Optional[str]:
+        table = tbl.users if self.entity_type == "users" else tbl.groups
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            row = await (await conn.execute(select([table.c.version]).where(table.c.id == resource_id))).first()
+        if row is None:
+            raise ResourceNotFound(self.entity_type.rstrip("s").title(), resource_id)
+        return make_etag(row.version)
+
+    async def _get_where_clause_from_filter(self, _filter: str, attr_map: Dict) \
+            -> Tuple[Optional[TextClause], Dict]:
         if not _filter:
-            return None
+            return None, {}
         parsed_q = SQLQuery(_filter, self.entity_type, attr_map)
         where = parsed_q.where_sql
+        if len(where) == 0:
+            return None, {}
         parsed_params = parsed_q.params_dict
+        sqla_params = {}
         for k in parsed_params.keys():
-            where = where.replace(f"{{{k}}}", f"'{parsed_params[k]}'")
-        if len(where) > 0:
-            insensitive_like = re.compile(re.escape(" LIKE "), re.IGNORECASE)
-            where = insensitive_like.sub(" ILIKE ", where)
-        return text(where)
-
-    async def _search_users(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
-        where_clause = await self._get_where_clause_from_filter(_filter, self.user_attr_map)
-        em_agg = text("""
-                    array_agg(json_build_object(
-                        'value', user_emails.value,
-                        'primary', user_emails.primary,
-                        'type', user_emails.type
-                    )) as emails
-                """)
-        gr_agg = text("""
-                    array_agg(json_build_object('displayName', groups."displayName")) as groups
-                """)
-        ct = text("count(*) OVER() as total")
-        q = select([tbl.users, em_agg, gr_agg, ct]). \
-            join(tbl.user_emails, tbl.users.c.id == tbl.user_emails.c.userId, isouter=True). \
-            join(tbl.users_groups, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True). \
-            join(tbl.groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True)
+            sqla_params[f"param_{k}"] = parsed_params[k]
+            where = where.replace(f"{{{k}}}", f":param_{k}")
+        return _compile_where_clause(where), sqla_params
+
+    async def _search_users(self, _filter: str, start_index: int, count: int,
+                            projection: Projection) -> tuple[list[Dict], int]:
+        where_clause, sqla_params = await self._get_where_clause_from_filter(_filter, self.user_attr_map)
+        # First, select the requested page of user IDs, with the filter applied to the users table directly
+        # and to the emails and memberships tables through semi-joins:
+        page_q = select([tbl.users.c.id, func.count().over().label("total")])
         if where_clause is not None:
-            q = q.where(where_clause)
-        q = q.group_by(text("1,2,3,4,5,6,7,8,9")).offset(start_index - 1).fetch(count)
+            page_q = page_q.where(_semi_join_user_predicates(where_clause.text))
+        page = page_q.order_by(tbl.users.c.id).offset(start_index - 1).fetch(count).cte("page")
+        # Then, aggregate emails and groups only for the users in that page:
+        q = select([tbl.users, *_user_aggregates(projection=projection), page.c.total]). \
+            select_from(page.join(tbl.users, tbl.users.c.id == page.c.id)). \
+            order_by(tbl.users.c.id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             users = []
             total = 0
-            async for row in conn.execute(q):
-                users.append(await _transform_user(row))
+            async for row in conn.execute(q, **sqla_params):
+                users.append(projection.apply(await _transform_user(row)))
                 total = row.total
 
         return users, total
 
-    async def _search_groups(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
-        where_clause = await self._get_where_clause_from_filter(_filter, self.group_attr_map)
+    async def _search_groups(self, _filter: str, start_index: int, count: int,
+                             projection: Projection) -> tuple[list[Dict], int]:
+        where_clause, sqla_params = await self._get_where_clause_from_filter(_filter, self.group_attr_map)
         ct = text("count(*) OVER() as total")
-        q = select([tbl.groups, text("'[]'::jsonb as members"), ct]). \
+        # Members are only aggregated in searches when they're explicitly requested:
+        top_level_attributes = projection.top_level_attributes() or set()
+        mem_agg = _members_agg() if "members" in top_level_attributes else text("'[]'::jsonb as members")
+        q = select([tbl.groups, mem_agg, ct]). \
             join(tbl.users_groups, tbl.groups.c.id == tbl.users_groups.c.groupId, isouter=True). \
             join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId, isouter=True)
 
         if where_clause is not None:
             q = q.where(where_clause)
-        q = q.group_by(text("1,2,3,4")).offset(start_index - 1).fetch(count)
+        q = q.group_by(text("1,2,3")).offset(start_index - 1).fetch(count)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
             groups = []
             total = 0
-            async for row in conn.execute(q):
-                groups.append(await _transform_group(row))
+            async for row in conn.execute(q, **sqla_params):
+                groups.append(projection.apply(await _transform_group(row)))
                 total = row.total
         return groups, total
 
-    async def search(self, _filter: str, start_index: int = 1, count: int = 100) -> tuple[list[Dict], int]:
+    async def search(self, _filter: str, start_index: int = 1, count: int = 100,
+                     attributes: Optional[List[str]] = None,
+                     excluded_attributes: Optional[List[str]] = None) -> tuple[list[Dict], int]:
+        projection = Projection(attributes, excluded_attributes)
         if self.entity_type == "users":
-            return await self._search_users(_filter, start_index, count)
+            return await self._search_users(_filter, start_index, count, projection)
         if self.entity_type == "groups":
-            return await self._search_groups(_filter, start_index, count)
+            return await self._search_groups(_filter, start_index, count, projection)
+
+    async def get_members(self, group_id: str, start_index: int = 1, count: int = 100) -> Tuple[List[Dict], int]:
+        # The page is read from the ("groupId", "userId") index, so its cost doesn't depend on the group size
+        # (besides the offset):
+        total_q = select([func.count()]).select_from(tbl.users_groups). \
+            where(tbl.users_groups.c.groupId == group_id).scalar_subquery()
+        group_q = select([tbl.groups.c.id, total_q.label("total")]).where(tbl.groups.c.id == group_id)
+        page_q = select([tbl.users.c.id, tbl.users.c.userName]). \
+            select_from(tbl.users_groups.join(tbl.users, tbl.users.c.id == tbl.users_groups.c.userId)). \
+            where(tbl.users_groups.c.groupId == group_id). \
+            order_by(tbl.users_groups.c.userId).offset(start_index - 1).limit(count)
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            groups = [row async for row in conn.execute(group_q)]
+            if len(groups) == 0:
+                raise ResourceNotFound("Group", group_id)
+            members = [{"display": row.userName, "value": row.id} async for row in conn.execute(page_q)]
+        return members, groups[0].total
 
-    async def update(self, resource_id: str, **kwargs: Dict):
+    async def scan(self, batch_size: int = 1000, after: Optional[str] = None) -> AsyncIterator[Dict]:
+        # Keyset pagination: every batch is an index range scan starting after the last ID of the previous
+        # batch, so reading the whole store takes linear time (unlike offset-based pages):
+        if self.entity_type == "users":
+            table, columns, transform = tbl.users, [tbl.users, *_user_aggregates()], _transform_user
+        else:
+            table, columns, transform = tbl.groups, [tbl.groups, _members_agg()], _transform_group
+        engine = await self.get_engine()
+        last_id = after
+        while True:
+            q = select(columns).order_by(table.c.id).limit(batch_size)
+            if last_id is not None:
+                q = q.where(table.c.id > last_id)
+            async with engine.acquire() as conn:
+                rows = [row async for row in conn.execute(q)]
+            for row in rows:
+                yield await transform(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].id
+
+    async def update(self, resource_id: str, expected_version: Optional[str] = None, **kwargs: Dict):
         sanitized = await self._sanitize(kwargs)
         if self.entity_type == "users":
-            return await self._update_user(resource_id, **sanitized)
+            return await self._update_user(resource_id, expected_version, **sanitized)
         if self.entity_type == "groups":
-            return await self._update_group(resource_id, **sanitized)
+            return await self._update_group(resource_id, expected_version, **sanitized)
 
-    async def _update_user(self, user_id: str, **kwargs: Dict) -> Dict:
-        # "id" is immutable, and "groups" are updated through the groups API:
-        immutable_cols = ["id", "groups"]
+    async def _update_user(self, user_id: str, expected_version: Optional[str] = None, **kwargs: Dict) -> Dict:
+        # "id" is immutable, "groups" are updated through the groups API, and the version is incremented:
+        immutable_cols = ["id", "groups", "version"]
         for immutable_col in immutable_cols:
             if immutable_col in kwargs:
                 del kwargs[immutable_col]
@@ -272,33 +507,67 @@ class PostgresqlStore(RDBMSStore):
             attr: kwargs[attr] for attr in kwargs.keys()
             if attr in user_cols
         }
-        q = update(tbl.users).where(tbl.users.c.id == user_id).values(**clean_attributes)
+        # The user update, the emails replacement and the read of the updated user are sent as a single
+        # statement. Reads in a statement don't see the effects of its data-modifying CTEs, so the
+        # updated user and emails are read from the CTEs' RETURNING clauses:
+        updated_user = update(tbl.users).where(_version_condition(tbl.users, user_id, expected_version)). \
+            values(**clean_attributes, version=tbl.users.c.version + 1). \
+            returning(*tbl.users.c).cte("updated_user")
+        em_agg, gr_agg = _user_aggregates(updated_user.c.id)
+        ctes = []
+        if "userName" in clean_attributes:
+            # The user's name is the display of its memberships, so renaming it changes its groups, whose versions
+            # are incremented. The users table is read as of before the statement, i.e. with the former name, which
+            # is compared case-sensitively (the column is case-insensitive):
+            renamed_memberships = select([tbl.users_groups.c.groupId]).select_from(
+                updated_user.join(tbl.users, tbl.users.c.id == updated_user.c.id).
+                join(tbl.users_groups, tbl.users_groups.c.userId == updated_user.c.id)
+            ).where(cast(tbl.users.c.userName, Text) != cast(updated_user.c.userName, Text))
+            ctes.append(_bump_group_versions(tbl.groups.c.id.in_(renamed_memberships)).
+                        returning(tbl.groups.c.id).cte("renamed_groups"))
+        if update_emails:
+            ctes.append(delete(tbl.user_emails).
+                        where(tbl.user_emails.c.userId.in_(select([updated_user.c.id]))).
+                        returning(tbl.user_emails.c.id).cte("deleted_emails"))
+            em_agg = literal_column("NULL").label("emails")
+        if update_emails and len(emails) > 0:
+            new_emails = values(
+                column("id"), column("primary"), column("value"), column("type"), name="new_emails"
+            ).data([(e["id"], e["primary"], e["value"], e["type"]) for e in _email_rows(user_id, emails)])
+            inserted_emails = insert(tbl.user_emails).from_select(
+                ["id", "userId", "primary", "value", "type"],
+                select([
+                    new_emails.c.id, updated_user.c.id, new_emails.c.primary, new_emails.c.value, new_emails.c.type
+                ]).select_from(updated_user.join(new_emails, true()))
+            ).returning(*tbl.user_emails.c).cte("inserted_emails")
+            ctes.append(inserted_emails)
+            em_agg = select([_emails_agg(inserted_emails)]).scalar_subquery().label("emails")
+        q = select([updated_user, em_agg, gr_agg])
+        for cte in ctes:
+            q = q.add_cte(cte)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            _ = await conn.execute(q)
-        if update_emails:
-            del_emails_q = delete(tbl.user_emails).where(tbl.users.c.id == user_id)
-            ins_emails_q = insert(tbl.user_emails).values([
-                {
-                    "id": str(uuid.uuid4()),
-                    "userId": user_id,
-                    "primary": email.get("primary", True),
-                    "value": email.get("value"),
-                    "type": email.get("type")
-                } for email in emails
-            ])
-            async with engine.acquire() as conn:
-                _ = await conn.execute(del_emails_q)
-                _ = await conn.execute(ins_emails_q)
-        return await self._get_user_by_id(user_id)
-
-    async def _update_group(self, group_id: str, **kwargs: Dict) -> Dict:
-        if "id" in kwargs:
-            del kwargs["id"]
-        q = update(tbl.groups).where(tbl.groups.c.id == group_id).values(**kwargs)
+            entity_record = None
+            async for row in conn.execute(q):
+                entity_record = row
+                break
+        if not entity_record:
+            if expected_version is not None:
+                raise await self._precondition_failed("User", user_id)
+            raise ResourceNotFound("User", user_id)
+        return await _transform_user(entity_record)
+
+    async def _update_group(self, group_id: str, expected_version: Optional[str] = None, **kwargs: Dict) -> Dict:
+        for immutable_col in ("id", "version"):
+            if immutable_col in kwargs:
+                del kwargs[immutable_col]
+        q = update(tbl.groups).where(_version_condition(tbl.groups, group_id, expected_version)). \
+            values(**kwargs, version=tbl.groups.c.version + 1).returning(tbl.groups.c.id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            _ = await conn.execute(q)
+            updated = await (await conn.execute(q)).first()
+        if updated is None and expected_version is not None:
+            raise await self._precondition_failed("Group", group_id)
         return await self._get_group_by_id(group_id)
 
     async def create(self, resource: Dict):
@@ -330,102 +599,135 @@ class PostgresqlStore(RDBMSStore):
         return await self._get_group_by_id(group_id)
 
     async def _create_user(self, resource: Dict):
-        custom_schemas = {
-            schema: resource.get(schema, {})
-            for schema in resource["schemas"] if schema != DEFAULT_USER_SCHEMA
-        }
         user_id = resource.get("id") or str(uuid.uuid4())
-        insert_user = insert(tbl.users).values(
-            id=user_id,
-            externalId=resource.get("externalId"),
-            locale=resource.get("locale"),
-            name=resource.get("name"),
-            schemas=resource.get("schemas"),
-            userName=resource.get("userName"),
-            displayName=resource.get("displayName"),
-            active=resource.get("active"),
-            customAttributes=custom_schemas
-        ).returning()
+        insert_user = insert(tbl.users).values(**_user_row(user_id, resource)).returning(tbl.users.c.id)
         emails = resource.get("emails", [{"primary": True, "value": resource.get("userName"), "type": "work"}])
-        insert_emails = insert(tbl.user_emails).values([
-            {
-                "id": str(uuid.uuid4()),
-                "userId": user_id,
-                "primary": email.get("primary", True),
-                "value": email.get("value"),
-                "type": email.get("type")
-            } for email in emails
-        ])
+        # The user and emails inserts are sent as a single (atomic) statement:
+        q = insert_user
+        if len(emails) > 0:
+            q = insert(tbl.user_emails).values(_email_rows(user_id, emails)).add_cte(insert_user.cte("new_user"))
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            _ = await conn.execute(insert_user)
-            _ = await conn.execute(insert_emails)
-        return {**resource, "id": user_id}
+            _ = await conn.execute(q)
+        return {**resource, "id": user_id, "meta": {"version": make_etag(1)}}
 
-    async def delete(self, resource_id: str):
+    async def bulk_create(self, resources: List[Dict]) -> List[Optional[str]]:
+        if len(resources) == 0:
+            return []
+        sanitized = [{**(await self._sanitize(r)), "id": r.get("id") or str(uuid.uuid4())} for r in resources]
         if self.entity_type == "users":
-            return await self._delete_user(resource_id)
+            return await self._bulk_create_users(sanitized)
         if self.entity_type == "groups":
-            return await self._delete_group(resource_id)
+            return await self._bulk_create_groups(sanitized)
 
-    async def _delete_user(self, user_id: str):
+    async def _bulk_create_users(self, resources: List[Dict]) -> List[Optional[str]]:
+        # Users that already exist (by ID or userName) are skipped, and only the emails of the users that
+        # were actually inserted are inserted, so that an interrupted import can simply be re-run:
+        insert_users = _recordset_insert(tbl.users, [_user_row(r["id"], r) for r in resources]). \
+            on_conflict_do_nothing().returning(tbl.users.c.id)
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin():
+                inserted_ids = {row.id async for row in conn.execute(insert_users)}
+                email_rows = []
+                for r in resources:
+                    if r["id"] in inserted_ids:
+                        emails = r.get("emails", [{"primary": True, "value": r.get("userName"), "type": "work"}])
+                        email_rows.extend(_email_rows(r["id"], emails))
+                if len(email_rows) > 0:
+                    _ = await conn.execute(_recordset_insert(tbl.user_emails, email_rows))
+        return [r["id"] if r["id"] in inserted_ids else None for r in resources]
+
+    async def _bulk_create_groups(self, resources: List[Dict]) -> List[Optional[str]]:
+        insert_groups = _recordset_insert(tbl.groups, [
+            {"id": r["id"], "schemas": r.get("schemas"), "displayName": r.get("displayName")} for r in resources
+        ]).on_conflict_do_nothing().returning(tbl.groups.c.id)
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin():
+                inserted_ids = {row.id async for row in conn.execute(insert_groups)}
+                member_rows = [
+                    {"userId": m.get("value"), "groupId": r["id"]}
+                    for r in resources if r["id"] in inserted_ids
+                    for m in r.get("members", [])
+                ]
+                if len(member_rows) > 0:
+                    _ = await conn.execute(_recordset_insert(tbl.users_groups, member_rows).on_conflict_do_nothing())
+        return [r["id"] if r["id"] in inserted_ids else None for r in resources]
+
+    async def delete(self, resource_id: str, expected_version: Optional[str] = None):
+        if self.entity_type == "users":
+            return await self._delete_user(resource_id, expected_version)
+        if self.entity_type == "groups":
+            return await self._delete_group(resource_id, expected_version)
+
+    async def _lock_for_delete(self, conn, table: Table, resource_type: str, resource_id: str,
+                               expected_version: Optional[str]):
+        """
+        Locks the row of a resource for the rest of the transaction, so that it's deleted as of the version it
+        has now, and checks that version (if expected).
+        """
+        q = select([table.c.version]).where(table.c.id == resource_id).with_for_update()
+        row = await (await conn.execute(q)).first()
+        if row is None:
+            raise ResourceNotFound(resource_type, resource_id)
+        if expected_version is not None and row.version != version_number(expected_version):
+            raise PreconditionFailed(resource_type, resource_id, make_etag(row.version))
+
+    async def _delete_user(self, user_id: str, expected_version: Optional[str] = None):
         del_q = [
             delete(tbl.user_emails).where(tbl.user_emails.c.userId == user_id),
+            _bump_group_versions(tbl.groups.c.id.in_(
+                select([tbl.users_groups.c.groupId]).where(tbl.users_groups.c.userId == user_id)
+            )),
             delete(tbl.users_groups).where(tbl.users_groups.c.userId == user_id),
             delete(tbl.users).where(tbl.users.c.id == user_id),
         ]
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            sel_q = select(tbl.users).where(tbl.users.c.id == user_id)
-            user = None
-            async for row in conn.execute(sel_q):
-                user = row
-                break
-            if not user:
-                raise ResourceNotFound("User", user_id)
-            for q in del_q:
-                _ = await conn.execute(q)
+            async with conn.begin():
+                _ = await self._lock_for_delete(conn, tbl.users, "User", user_id, expected_version)
+                for q in del_q:
+                    _ = await conn.execute(q)
         return {}
 
-    async def _delete_group(self, group_id: str):
+    async def _delete_group(self, group_id: str, expected_version: Optional[str] = None):
         del_q = delete(tbl.groups).where(tbl.groups.c.id == group_id)
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            sel_q = select(tbl.groups).where(tbl.groups.c.id == group_id)
-            group = None
-            async for row in conn.execute(sel_q):
-                group = row
-                break
-            if not group:
-                raise ResourceNotFound("Group", group_id)
-            _ = await conn.execute(del_q)
+            async with conn.begin():
+                _ = await self._lock_for_delete(conn, tbl.groups, "Group", group_id, expected_version)
+                _ = await conn.execute(del_q)
         return {}
 
     async def remove_users_from_group(self, user_ids: List[str], group_id: str):
-        user_id_conditions = []
-        for user_id in user_ids:
-            user_id_conditions.append(tbl.users_groups.c.userId == user_id)
         q = delete(tbl.users_groups).where(
             and_(
                 tbl.users_groups.c.groupId == group_id,
-                or_(*user_id_conditions)
+                tbl.users_groups.c.userId.in_(user_ids)
             )
         )
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            _ = await conn.execute(q)
+            async with conn.begin():
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
+                _ = await conn.execute(q)
         return
 
     async def add_user_to_group(self, user_id: str, group_id: str):
-        check_q = select(tbl.users_groups).where(
-            and_(tbl.users_groups.c.userId == user_id, tbl.users_groups.c.groupId == group_id)
-        )
-        insert_q = insert(tbl.users_groups).values(userId=user_id, groupId=group_id)
+        return await self.add_users_to_group([user_id], group_id)
+
+    async def add_users_to_group(self, user_ids: List[str], group_id: str):
+        if len(user_ids) == 0:
+            return
+        insert_q = pg_insert(tbl.users_groups).values(
+            [{"userId": uid, "groupId": group_id} for uid in user_ids]
+        ).on_conflict_do_nothing()
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            async for row in await conn.execute(check_q):
-                return
-            _ = await conn.execute(insert_q)
+            async with conn.begin():
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
+                _ = await conn.execute(insert_q)
         return
 
     async def set_group_members(self, user_ids: List[str], group_id: str):
@@ -435,10 +737,49 @@ class PostgresqlStore(RDBMSStore):
         )
         engine = await self.get_engine()
         async with engine.acquire() as conn:
-            _ = await conn.execute(delete_q)
-            _ = await conn.execute(insert_q)
+            async with conn.begin():
+                _ = await conn.execute(_bump_group_versions(tbl.groups.c.id == group_id))
+                _ = await conn.execute(delete_q)
+                if len(user_ids) > 0:
+                    _ = await conn.execute(insert_q)
         return
 
+    async def patch_group(self, group_id: str, attributes: Dict, members_to_add: List[Dict],
+                          member_ids_to_remove: List[str], members: Optional[List[Dict]] = None,
+                          expected_version: Optional[str] = None):
+        # The patch is applied in a single transaction. The group's row, locked by the update (which is
+        # conditioned on the expected version, if any), serializes concurrent patches of the same group:
+        group_values = {
+            k: v for k, v in (await self._sanitize(attributes)).items()
+            if k not in ("id", "version") and k in tbl.groups.c
+        }
+        engine = await self.get_engine()
+        async with engine.acquire() as conn:
+            async with conn.begin():
+                res = await conn.execute(
+                    update(tbl.groups).where(_version_condition(tbl.groups, group_id, expected_version))
+                    .values(**group_values, version=tbl.groups.c.version + 1)
+                    .returning(tbl.groups.c.id)
+                )
+                if await res.first() is None:
+                    if expected_version is not None:
+                        raise await self._precondition_failed("Group", group_id)
+                    raise ResourceNotFound("Group", group_id)
+                user_ids = []
+                if members is not None:
+                    _ = await conn.execute(delete(tbl.users_groups).where(tbl.users_groups.c.groupId == group_id))
+                    user_ids = [m.get("value") for m in members]
+                if member_ids_to_remove:
+                    _ = await conn.execute(delete(tbl.users_groups).where(and_(
+                        tbl.users_groups.c.groupId == group_id,
+                        tbl.users_groups.c.userId.in_(member_ids_to_remove)
+                    )))
+                user_ids += [m.get("value") for m in members_to_add]
+                if user_ids:
+                    _ = await conn.execute(pg_insert(tbl.users_groups).values(
+                        [{"userId": uid, "groupId": group_id} for uid in user_ids]
+                    ).on_conflict_do_nothing())
+
     async def search_members(self, _filter: str, group_id: str):
         parsed_q = SQLQuery(_filter, "users_groups", self.user_attr_map)
         where = parsed_q.where_sql
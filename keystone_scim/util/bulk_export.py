@@ -0,0 +1,46 @@
+from typing import Awaitable, Callable, Dict, Iterable
+
+from keystone_scim.models.group import DEFAULT_GROUP_SCHEMA
+from keystone_scim.models.user import DEFAULT_USER_SCHEMA
+from keystone_scim.store import BaseStore
+from keystone_scim.util import json_codec
+
+DEFAULT_BATCH_SIZE = 1000
+RESOURCE_TYPES = ("users", "groups")
+_DEFAULT_SCHEMAS = {"users": [DEFAULT_USER_SCHEMA], "groups": [DEFAULT_GROUP_SCHEMA]}
+
+
+async def export_resources(user_store: BaseStore,
+                           group_store: BaseStore,
+                           write: Callable[[bytes], Awaitable],
+                           resource_types: Iterable[str] = RESOURCE_TYPES,
+                           batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Streams every resource of the stores as newline-delimited JSON, in the format read by the bulk import.
+    Resources are written in chunks of 'batch_size' lines, as they're read from the stores' 'scan'.
+
+    :param user_store:     The store users are exported from
+    :param group_store:    The store groups are exported from
+    :param write:          A coroutine function writing a chunk of output (e.g., 'StreamResponse.write')
+    :param resource_types: The resource types to export ("users" and/or "groups")
+    :param batch_size:     The number of resources read and written at a time
+    :return:               The number of resources exported per resource type
+    """
+    stores = {"users": user_store, "groups": group_store}
+    exported = {}
+    for rt in resource_types:
+        exported[rt] = 0
+        lines = []
+        async for resource in stores[rt].scan(batch_size=batch_size):
+            # Not every store keeps the core schema of a resource, which the import relies on:
+            if not resource.get("schemas"):
+                resource = {**resource, "schemas": _DEFAULT_SCHEMAS[rt]}
+            lines.append(json_codec.dumpb(resource))
+            if len(lines) >= batch_size:
+                await write(b"\n".join(lines) + b"\n")
+                exported[rt] += len(lines)
+                lines = []
+        if len(lines) > 0:
+            await write(b"\n".join(lines) + b"\n")
+            exported[rt] += len(lines)
+    return exported
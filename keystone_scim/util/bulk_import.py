@@ -0,0 +1,127 @@
+import csv
+import json
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO
+
+from keystone_scim.models.group import DEFAULT_GROUP_SCHEMA
+from keystone_scim.store import BaseStore
+from keystone_scim.util import json_codec
+
+DEFAULT_BATCH_SIZE = 1000
+# The attribute paths of CSV cells holding booleans. Sub-attributes of multi-valued attributes, such as the 'primary'
+# flag of 'emails', are typed by the JSON of their attribute's cell:
+CSV_BOOLEAN_ATTRIBUTES = {"active"}
+
+
+def read_ndjson(stream: TextIO) -> Iterator[Dict]:
+    """
+    Yields one SCIM resource per (non-empty) line of a newline-delimited JSON stream.
+    """
+    for line_no, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json_codec.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON on line {line_no}: {e.msg}")
+
+
+def _csv_value(path: str, value: str):
+    # Multi-valued and complex attributes (e.g., 'emails', 'members' or 'schemas') are JSON-encoded in their cell:
+    if value[:1] in ("[", "{"):
+        return json_codec.loads(value)
+    if path.lower() in CSV_BOOLEAN_ATTRIBUTES and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+def read_csv(stream: TextIO) -> Iterator[Dict]:
+    """
+    Yields one SCIM resource per CSV row. Column names are attribute paths, where sub-attributes are
+    separated by dots (e.g., 'name.givenName'), and empty cells are omitted from the resource.
+    """
+    for row in csv.DictReader(stream):
+        resource = {}
+        for path, value in row.items():
+            if path is None or value is None or value == "":
+                continue
+            node = resource
+            attrs = path.split(".")
+            for attr in attrs[:-1]:
+                node = node.setdefault(attr, {})
+            node[attrs[-1]] = _csv_value(path, value)
+        yield resource
+
+
+READERS: Dict[str, Callable[[TextIO], Iterator[Dict]]] = {
+    "ndjson": read_ndjson,
+    "csv": read_csv,
+}
+
+
+def resource_type(resource: Dict) -> str:
+    return "groups" if DEFAULT_GROUP_SCHEMA in resource.get("schemas", []) else "users"
+
+
+class ImportProgress:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.written = {"users": 0, "groups": 0}
+        self.created = {"users": 0, "groups": 0}
+
+    @property
+    def skipped(self) -> Dict[str, int]:
+        return {k: self.written[k] - self.created[k] for k in self.written}
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return sum(self.written.values()) / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return ", ".join(
+            f"{self.created[k]} {k} created ({self.skipped[k]} skipped)" for k in ("users", "groups")
+        ) + f", {self.rate:.0f} resources/s"
+
+
+async def import_resources(user_store: BaseStore,
+                           group_store: BaseStore,
+                           resources: Iterable[Dict],
+                           batch_size: int = DEFAULT_BATCH_SIZE,
+                           on_progress: Optional[Callable[[ImportProgress], None]] = None) -> ImportProgress:
+    """
+    Streams resources into the stores' bulk write paths, holding at most one batch of each resource type
+    in memory. Resources that already exist are skipped, so that an interrupted import can be re-run.
+
+    :param user_store:  The store users are imported into
+    :param group_store: The store groups are imported into
+    :param resources:   An iterable of SCIM users and/or groups (e.g., from 'read_ndjson' or 'read_csv')
+    :param batch_size:  The number of resources written per bulk write
+    :param on_progress: A callback invoked with the progress after each bulk write
+    :return:            The import progress after the last bulk write
+    """
+    progress = ImportProgress()
+    stores = {"users": user_store, "groups": group_store}
+    batches: Dict[str, List[Dict]] = {"users": [], "groups": []}
+
+    async def flush(rt: str):
+        if len(batches[rt]) == 0:
+            return
+        # Groups may reference users of the pending batch, so users are always written first:
+        if rt == "groups":
+            await flush("users")
+        progress.created[rt] += len([i for i in await stores[rt].bulk_create(batches[rt]) if i])
+        progress.written[rt] += len(batches[rt])
+        batches[rt] = []
+        if on_progress:
+            on_progress(progress)
+
+    for resource in resources:
+        rt = resource_type(resource)
+        batches[rt].append(resource)
+        if len(batches[rt]) >= batch_size:
+            await flush(rt)
+    await flush("groups")
+    await flush("users")
+    return progress
@@ -3,7 +3,7 @@ import os
 
 from keystone_scim.util import ThreadSafeSingleton
 
-from schema import Optional, Schema
+from schema import Optional, Or, Schema
 import yaml
 
 
@@ -27,6 +27,7 @@ SCHEMA = Schema({
             Optional("password"): str,
             Optional("database", default="postgres"): str,
             Optional("schema", default="public"): str,
+            Optional("trigram_indexes", default=False): bool,
         }),
         Optional("mysql", default=None): Schema({
             Optional("host"): str,
@@ -44,9 +45,28 @@ SCHEMA = Schema({
             Optional("password"): str,
             Optional("database", default="scim2Db"): str,
             Optional("tls", default=True): bool,
-            Optional("replica_set", default=True): str,
+            Optional("replica_set"): str,
             Optional("dsn"): str,
-        })
+            Optional("count_cache_ttl", default=0): int,
+            Optional("max_pool_size"): int,
+            Optional("min_pool_size"): int,
+            Optional("read_preference"): str,
+            Optional("search_read_preference"): str,
+            Optional("w"): Or(int, str),
+            Optional("journal"): bool,
+            Optional("compressors"): str,
+        }),
+        Optional("cache", default={}): Schema({
+            Optional("enabled", default=False): bool,
+            Optional("max_size", default=10000): int,
+            Optional("ttl", default=30): Or(int, float),
+            Optional("resource_types", default=["users", "groups"]): [str],
+            Optional("operations", default=["get_by_id", "get_members"]): [str],
+            Optional("negative_ttl", default=0): Or(int, float),
+            Optional("invalidation", default=False): bool,
+            Optional("poll_interval", default=1): Or(int, float),
+            Optional("coalesce", default=False): bool,
+        }),
     }),
     Optional("authentication", default={}): Schema({
         Optional("akv", default={}): Schema({
@@ -57,6 +77,16 @@ SCHEMA = Schema({
         }),
         Optional("secret"): str,
     }),
+    Optional("groups", default={}): Schema({
+        Optional("max_members", default=1000): int,
+    }),
+    Optional("bulk", default={}): Schema({
+        Optional("max_operations", default=1000): int,
+        Optional("max_payload_size", default=1048576): int,
+    }),
+    Optional("json", default={}): Schema({
+        Optional("codec", default="auto"): str,
+    }),
 })
 
 
@@ -0,0 +1,72 @@
+import re
+from typing import Dict, Mapping, Optional
+
+from keystone_scim.util.exc import PreconditionFailed
+
+ENTITY_TAG = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+
+def make_etag(version) -> str:
+    """
+    :param version: The version of a resource, as kept by its store (e.g., a counter)
+    :return:        The resource's (weak) entity tag, which is also its 'meta.version'
+    """
+    return f'W/"{version}"'
+
+
+def parse_etag(etag: str) -> str:
+    """
+    :return: The opaque tag of a (weak or strong) entity tag, e.g. '3' for 'W/"3"'
+    """
+    return etag.replace("W/", "", 1).strip('"')
+
+
+def version_number(etag: str) -> int:
+    """
+    :return: The counter of an entity tag made by 'make_etag' from a counter, or -1 (which no version is)
+    """
+    tag = parse_etag(etag)
+    return int(tag) if tag.isdigit() else -1
+
+
+def etag_matches(header: Optional[str], etag: Optional[str]) -> bool:
+    """
+    :param header: The value of an 'If-Match' or 'If-None-Match' header, i.e. "*" or a list of entity tags
+    :param etag:   The current entity tag of the resource
+    :return:       Whether the header lists the entity tag. Tags are compared weakly (RFC 7232, section 2.3.2),
+                   since versions only change with the resource's representation
+    """
+    if not header or not etag:
+        return False
+    tags = ENTITY_TAG.findall(header)
+    return "*" in tags or etag.replace("W/", "", 1) in {t.replace("W/", "", 1) for t in tags}
+
+
+def etag_headers(resource: Dict) -> Dict:
+    """
+    :return: The 'ETag' header of a response returning a resource, unless its version isn't returned
+    """
+    version = (resource.get("meta") or {}).get("version")
+    return {"ETag": version} if version else {}
+
+
+async def if_match_version(store, resource_type: str, resource_id: str, headers: Mapping) -> Optional[str]:
+    """
+    :return: The version a write must be conditioned on to honor its 'If-Match' header, or None if the write is
+             unconditional. Stores check the version atomically with the write (see 'BaseStore.update'). When the
+             header lists several entity tags, the current version is read, and the write is conditioned on it if
+             it's listed (and fails with a 'PreconditionFailed' error otherwise)
+    """
+    if_match = headers.get("If-Match")
+    if not if_match:
+        return None
+    tags = ENTITY_TAG.findall(if_match)
+    if "*" in tags:
+        # Any version matches, and writes of missing resources fail anyway:
+        return None
+    if len(tags) == 1:
+        return tags[0]
+    version = await store.get_version(resource_id)
+    if not etag_matches(if_match, version):
+        raise PreconditionFailed(resource_type, resource_id, version)
+    return version
@@ -18,5 +18,26 @@ class ResourceAlreadyExists(Exception):
         return f"{self.resource_type} {self.resource_id} already exists in the target SCIM tenant"
 
 
+class InvalidPatchOperation(Exception):
+    def __init__(self, operation, reason: str, *args):
+        super(InvalidPatchOperation, self).__init__(*args)
+        self.operation = operation
+        self.reason = reason
+
+    def __str__(self):
+        return f"Invalid PATCH operation {self.operation}: {self.reason}"
+
+
 class UnauthorizedRequest(Exception):
     pass
+
+
+class PreconditionFailed(Exception):
+    def __init__(self, resource_type: str, resource_id: str, version: str, *args):
+        super(PreconditionFailed, self).__init__(*args)
+        self.resource_type = resource_type
+        self.resource_id = resource_id
+        self.version = version
+
+    def __str__(self):
+        return f"{self.resource_type} {self.resource_id} was modified, its current version is {self.version}"
@@ -0,0 +1,96 @@
+import json
+import logging
+from typing import Any, Callable, Dict, NamedTuple, Optional, Union
+
+from aiohttp import web
+
+from keystone_scim.util.config import Config
+
+CONFIG = Config()
+LOGGER = logging.getLogger(__name__)
+JSON_CONTENT_TYPE = "application/json"
+
+
+class JsonCodec(NamedTuple):
+    name: str
+    dumps: Callable[[Any], str]
+    # Encodes straight to UTF-8, which is what responses and database parameters are sent as:
+    dumpb: Callable[[Any], bytes]
+    loads: Callable[[Union[str, bytes]], Any]
+
+
+def _json_codec() -> JsonCodec:
+    return JsonCodec(
+        name="json",
+        dumps=json.dumps,
+        dumpb=lambda obj: json.dumps(obj).encode("utf-8"),
+        loads=json.loads,
+    )
+
+
+def _orjson_codec() -> JsonCodec:
+    import orjson
+    # Like the json module, non-string keys are converted to strings rather than rejected:
+    option = orjson.OPT_NON_STR_KEYS
+    return JsonCodec(
+        name="orjson",
+        dumps=lambda obj: orjson.dumps(obj, option=option).decode("utf-8"),
+        dumpb=lambda obj: orjson.dumps(obj, option=option),
+        loads=orjson.loads,
+    )
+
+
+CODECS: Dict[str, Callable[[], JsonCodec]] = {
+    "json": _json_codec,
+    "orjson": _orjson_codec,
+}
+
+
+def get_codec(name: str = "auto") -> JsonCodec:
+    """
+    :param name: The name of a codec of 'CODECS', or "auto" for the fastest installed one (orjson is an optional
+                 dependency)
+    """
+    if name == "auto":
+        try:
+            return _orjson_codec()
+        except ImportError:
+            return _json_codec()
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+    return CODECS[name]()
+
+
+def set_codec(name: str) -> JsonCodec:
+    """
+    Selects the codec of 'dumps', 'dumpb' and 'loads' (and of the functions below), which are looked up as
+    attributes of this module by the REST layer and the stores.
+    """
+    global CODEC, dumps, dumpb, loads
+    CODEC = get_codec(name)
+    dumps, dumpb, loads = CODEC.dumps, CODEC.dumpb, CODEC.loads
+    LOGGER.debug("Using the '%s' JSON codec", CODEC.name)
+    return CODEC
+
+
+CODEC: JsonCodec
+dumps: Callable[[Any], str]
+dumpb: Callable[[Any], bytes]
+loads: Callable[[Union[str, bytes]], Any]
+set_codec(CONFIG.get("json.codec", "auto"))
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Dict] = None) -> web.Response:
+    """
+    The codec's counterpart of 'aiohttp.web.json_response', which encodes the body to bytes directly.
+    """
+    return web.Response(
+        body=dumpb(data), status=status, headers=headers, content_type=JSON_CONTENT_TYPE, charset="utf-8"
+    )
+
+
+async def read_json(request: web.Request) -> Any:
+    """
+    The codec's counterpart of 'aiohttp.web.Request.json', which decodes the body without decoding it to text first.
+    """
+    return loads(await request.read())
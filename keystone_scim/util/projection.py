@@ -0,0 +1,103 @@
+from typing import Dict, List, Optional, Set
+
+from keystone_scim.models.group import DEFAULT_GROUP_SCHEMA
+from keystone_scim.models.user import DEFAULT_USER_SCHEMA
+
+# Attributes with a "returned: always" characteristic, which projections can't remove:
+ALWAYS_RETURNED = {"id", "schemas"}
+CORE_SCHEMA_PREFIXES = tuple(f"{s.lower()}:" for s in (DEFAULT_USER_SCHEMA, DEFAULT_GROUP_SCHEMA))
+
+
+def parse_attribute_list(value: Optional[str]) -> Optional[List[str]]:
+    """
+    :param value: A comma-separated list of attribute names, e.g. the 'attributes' query parameter
+    :return:      The attribute names, or None if the list is empty
+    """
+    attributes = [a.strip() for a in (value or "").split(",") if a.strip()]
+    return attributes or None
+
+
+def _unqualified(attribute: str) -> str:
+    # Attributes of the core schemas may be fully qualified, e.g. 'urn:...:core:2.0:User:userName':
+    for prefix in CORE_SCHEMA_PREFIXES:
+        if attribute.lower().startswith(prefix):
+            return attribute[len(prefix):]
+    return attribute
+
+
+def _attribute_paths(attributes: Optional[List[str]]) -> Dict[str, Optional[Set[str]]]:
+    # Maps each (lower-case) top-level attribute to the set of its selected sub-attributes, or to None when
+    # the attribute is selected as a whole:
+    paths: Dict[str, Optional[Set[str]]] = {}
+    for attribute in attributes or []:
+        attribute = _unqualified(attribute).lower()
+        if attribute.startswith("urn:"):
+            paths[attribute] = None
+            continue
+        name, _, sub_attribute = attribute.partition(".")
+        if not sub_attribute or (name in paths and paths[name] is None):
+            paths[name] = None
+        else:
+            paths.setdefault(name, set()).add(sub_attribute)
+    return paths
+
+
+def _select(value, sub_attributes: Set[str], keep: bool):
+    if isinstance(value, list):
+        return [_select(v, sub_attributes, keep) for v in value]
+    if isinstance(value, dict):
+        return {k: v for k, v in value.items() if (k.lower() in sub_attributes) == keep}
+    return value
+
+
+class Projection:
+    """
+    The attributes to return in a resource, as requested with the 'attributes' or 'excludedAttributes'
+    parameters (RFC 7644, section 3.9). When both are given, 'attributes' takes precedence.
+    """
+
+    def __init__(self, attributes: Optional[List[str]] = None, excluded_attributes: Optional[List[str]] = None):
+        self.attributes = _attribute_paths(attributes)
+        self.excluded_attributes = _attribute_paths(excluded_attributes) if not self.attributes else {}
+        # The requested attribute paths, as given (but unqualified), for stores with a native projection:
+        self.included_paths = [_unqualified(a) for a in attributes or []]
+        self.excluded_paths = [_unqualified(a) for a in excluded_attributes or []] if not self.attributes else []
+
+    @property
+    def is_identity(self) -> bool:
+        return not self.attributes and not self.excluded_attributes
+
+    def includes(self, attribute: str) -> bool:
+        """
+        :return: Whether any part of a top-level attribute is returned
+        """
+        attribute = attribute.lower()
+        if attribute in ALWAYS_RETURNED:
+            return True
+        if self.attributes:
+            return attribute in self.attributes
+        return attribute not in self.excluded_attributes or self.excluded_attributes[attribute] is not None
+
+    def top_level_attributes(self) -> Optional[Set[str]]:
+        """
+        :return: The (lower-case) top-level attributes to return, or None if all but the excluded ones are
+        """
+        return set(self.attributes.keys()) | ALWAYS_RETURNED if self.attributes else None
+
+    def apply(self, resource: Dict) -> Dict:
+        if self.is_identity:
+            return resource
+        projected = {}
+        for key, value in resource.items():
+            name = key.lower()
+            if name in ALWAYS_RETURNED:
+                projected[key] = value
+            elif self.attributes:
+                if name in self.attributes:
+                    sub_attributes = self.attributes[name]
+                    projected[key] = value if sub_attributes is None else _select(value, sub_attributes, True)
+            elif name not in self.excluded_attributes:
+                projected[key] = value
+            elif self.excluded_attributes[name] is not None:
+                projected[key] = _select(value, self.excluded_attributes[name], False)
+        return projected
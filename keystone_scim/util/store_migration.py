@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import yaml
+from bson.objectid import ObjectId
+
+from keystone_scim.store import BaseStore
+from keystone_scim.store import mysql_store, postgresql_store
+from keystone_scim.store.memory_store import MemoryStore
+from keystone_scim.store.mongodb_store import MongoDbStore, set_up
+from keystone_scim.store.mysql_store import MySqlStore
+from keystone_scim.store.postgresql_store import PostgresqlStore
+from keystone_scim.util.config import SCHEMA, Config
+
+CONFIG = Config()
+LOGGER = logging.getLogger(__name__)
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+RESOURCE_TYPES = ("users", "groups")
+
+
+async def load_target_stores(config_file: str) -> Tuple[BaseStore, BaseStore]:
+    """
+    Builds (and sets up the schema of) the user and group stores described by the 'store' section of a
+    configuration file, which has the same format as the API's configuration file.
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        store_cfg = SCHEMA.validate(yaml.safe_load(f.read()) or {}).get("store", {})
+    if store_cfg.get("pg"):
+        # The PostgreSQL tables are bound to the schema of the API's configuration, which the target (e.g., in
+        # another database) must therefore share:
+        schema, source_schema = store_cfg["pg"].get("schema", "public"), CONFIG.get("store.pg.schema", "public")
+        if schema != source_schema:
+            raise ValueError(f"The target PostgreSQL schema ('{schema}') must be the configured schema "
+                             f"('{source_schema}')")
+        conn_args = {k: v for k, v in store_cfg["pg"].items() if k not in ("schema", "trigram_indexes")}
+        postgresql_store.set_up_schema(**conn_args)
+        return PostgresqlStore("users", **conn_args), PostgresqlStore("groups", **conn_args)
+    if store_cfg.get("mysql"):
+        conn_args = {k: v for k, v in store_cfg["mysql"].items() if k != "schema"}
+        mysql_store.set_up_schema(**conn_args)
+        return MySqlStore("users", **conn_args), MySqlStore("groups", **conn_args)
+    if store_cfg.get("mongo"):
+        conn_args = store_cfg["mongo"]
+        await set_up(**conn_args)
+        return MongoDbStore("users", **conn_args), MongoDbStore("groups", **conn_args)
+    if store_cfg.get("cosmos"):
+        raise ValueError("Cosmos DB is only supported as the migration source (i.e., the API's configured store)")
+    return MemoryStore("User"), MemoryStore("Group", name_uniqueness=True, nested_store_attr="members")
+
+
+def target_id(target: BaseStore, resource_id: Optional[str]) -> Optional[str]:
+    # MongoDB documents are keyed by ObjectIds. Other IDs are mapped to a deterministic ObjectId, so that
+    # group memberships (and re-runs) resolve to the same documents without keeping an ID map in memory:
+    if resource_id and isinstance(target, MongoDbStore) and not ObjectId.is_valid(resource_id):
+        return hashlib.sha1(resource_id.encode("utf-8")).hexdigest()[:24]
+    return resource_id
+
+
+def prepare_resource(target: BaseStore, resource_type: str, resource: Dict) -> Dict:
+    prepared = {k: v for k, v in resource.items() if k not in ("meta", "groups")}
+    prepared["id"] = target_id(target, resource.get("id"))
+    if resource_type == "groups":
+        prepared["members"] = [
+            {**m, "value": target_id(target, m.get("value"))} for m in resource.get("members", [])
+        ]
+    return prepared
+
+
+def resource_digest(resource_type: str, resource: Dict, target: BaseStore = None) -> int:
+    """
+    A digest of the attributes every store persists, normalized so that the same resource has the same digest
+    in any store (e.g., emails and members are sorted, and IDs are mapped for MongoDB targets).
+    """
+    if resource_type == "users":
+        canonical = {
+            "id": target_id(target, resource.get("id")),
+            "userName": str(resource.get("userName")).lower(),
+            "displayName": resource.get("displayName"),
+            "active": bool(resource.get("active")),
+            "emails": sorted([str(e.get("value")).lower() for e in resource.get("emails") or []]),
+        }
+    else:
+        canonical = {
+            "id": target_id(target, resource.get("id")),
+            "displayName": resource.get("displayName"),
+            "members": sorted([target_id(target, m.get("value")) for m in resource.get("members") or []]),
+        }
+    canonical["id"] = str(canonical["id"]).lower()
+    digest = hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class Checkpoint:
+    """
+    The (source) ID of the last resource of each type that was written to the target along with all the resources
+    before it, persisted to a JSON file. Scans are ordered by ID, so a resumed scan starts right after that ID,
+    regardless of the resources created or deleted in the source in the meantime.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.last_ids: Dict[str, Optional[str]] = {rt: None for rt in RESOURCE_TYPES}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.last_ids.update(json.load(f))
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.last_ids, f)
+        os.replace(tmp_path, self.path)
+
+
+async def _batches(resources: AsyncIterator[Dict], batch_size: int) -> AsyncIterator[List[Dict]]:
+    batch = []
+    async for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+async def migrate_resources(resource_type: str,
+                            source: BaseStore,
+                            target: BaseStore,
+                            checkpoint: Checkpoint,
+                            batch_size: int = DEFAULT_BATCH_SIZE,
+                            concurrency: int = DEFAULT_CONCURRENCY) -> int:
+    """
+    Streams the resources of one type from the source into the target's bulk write path, with up to
+    'concurrency' batches in flight. The checkpoint only advances past batches that were written along
+    with all the batches before them, so resuming never skips a resource.
+
+    :return: The number of resources created in the target
+    """
+    started_at = time.monotonic()
+    after = checkpoint.last_ids[resource_type]
+    if after is not None:
+        LOGGER.info("Resuming the migration of %s after ID %s", resource_type, after)
+    created, migrated = 0, 0
+    # The number of resources and the last ID of each completed batch, by sequence number:
+    completed: Dict[int, Tuple[int, str]] = {}
+    next_seq, next_checkpoint_seq = 0, 0
+    in_flight = set()
+
+    async def write(seq: int, batch: List[Dict]):
+        nonlocal created, migrated, next_checkpoint_seq
+        ids = await target.bulk_create([prepare_resource(target, resource_type, r) for r in batch])
+        created += len([i for i in ids if i])
+        completed[seq] = (len(batch), str(batch[-1].get("id")))
+        # Advance the checkpoint over the contiguous prefix of completed batches:
+        if next_checkpoint_seq not in completed:
+            return
+        while next_checkpoint_seq in completed:
+            count, checkpoint.last_ids[resource_type] = completed.pop(next_checkpoint_seq)
+            migrated += count
+            next_checkpoint_seq += 1
+        checkpoint.save()
+        elapsed = time.monotonic() - started_at
+        LOGGER.info("Migrated %d %s (%.0f/s)", migrated, resource_type, migrated / elapsed if elapsed > 0 else 0)
+
+    async for batch in _batches(source.scan(batch_size=batch_size, after=after), batch_size):
+        if len(in_flight) >= concurrency:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        in_flight.add(asyncio.ensure_future(write(next_seq, batch)))
+        next_seq += 1
+    if in_flight:
+        for task in (await asyncio.wait(in_flight))[0]:
+            task.result()
+    return created
+
+
+async def _summarize(store: BaseStore, resource_type: str, batch_size: int, target: BaseStore) -> Tuple[int, int]:
+    count, checksum = 0, 0
+    async for resource in store.scan(batch_size=batch_size):
+        count += 1
+        checksum = (checksum + resource_digest(resource_type, resource, target)) % (1 << 64)
+    return count, checksum
+
+
+async def verify(source: Tuple[BaseStore, BaseStore],
+                 target: Tuple[BaseStore, BaseStore],
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, Dict]:
+    """
+    Compares the number of resources and an order-independent checksum of their digests in both stores.
+
+    :return: The counts and checksums per resource type, and whether they match
+    """
+    report = {}
+    for index, rt in enumerate(RESOURCE_TYPES):
+        # Source digests map IDs the way they were mapped into the target; target IDs are already mapped:
+        (src_count, src_sum), (dst_count, dst_sum) = await asyncio.gather(
+            _summarize(source[index], rt, batch_size, target[index]),
+            _summarize(target[index], rt, batch_size, None),
+        )
+        report[rt] = {
+            "source": {"count": src_count, "checksum": f"{src_sum:016x}"},
+            "target": {"count": dst_count, "checksum": f"{dst_sum:016x}"},
+            "match": src_count == dst_count and src_sum == dst_sum,
+        }
+    return report
+
+
+async def migrate(source: Tuple[BaseStore, BaseStore],
+                  target: Tuple[BaseStore, BaseStore],
+                  checkpoint: Checkpoint,
+                  batch_size: int = DEFAULT_BATCH_SIZE,
+                  concurrency: int = DEFAULT_CONCURRENCY) -> Dict[str, int]:
+    """
+    Migrates users, then groups (which reference them), from the source stores to the target stores.
+
+    :return: The number of resources created in the target per resource type
+    """
+    created = {}
+    for index, rt in enumerate(RESOURCE_TYPES):
+        created[rt] = await migrate_resources(rt, source[index], target[index], checkpoint, batch_size, concurrency)
+    return created
@@ -1,7 +1,10 @@
 import logging
-from typing import Dict
+from typing import Dict, List, Optional
 
 from keystone_scim.store import BaseStore
+from keystone_scim.store import cosmos_db_store, mongodb_store, mysql_store, postgresql_store
+from keystone_scim.store.caching_store import CachingStore
+from keystone_scim.store.invalidation import InvalidationBus, WatchChanges
 from keystone_scim.store.memory_store import MemoryStore
 from keystone_scim.store.cosmos_db_store import CosmosDbStore
 from keystone_scim.store.mongodb_store import MongoDbStore
@@ -13,10 +16,13 @@ from keystone_scim.util.config import Config
 
 CONFIG = Config()
 LOGGER = logging.getLogger(__name__)
+# The attributes whose equality filters can be answered from the negative cache:
+UNIQUE_ATTRIBUTES = {"users": ("id", "userName"), "groups": ("id", "displayName")}
 
 
 class Stores(metaclass=ThreadSafeSingleton):
     impl: Dict[str, BaseStore] = {}
+    invalidation_bus: Optional[InvalidationBus] = None
 
     def __init__(self, **impl):
         for k in impl.keys():
@@ -26,46 +32,97 @@ class Stores(metaclass=ThreadSafeSingleton):
         return self.impl.get(store_name)
 
 
+def _config_list(key: str, default: List[str]) -> List[str]:
+    # Lists set in environment variables are comma-separated:
+    value = CONFIG.get(key, default)
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(",") if v.strip()]
+    return value
+
+
+def cache_stores(**impl: BaseStore) -> Dict[str, BaseStore]:
+    """
+    Wraps the stores in a read-through cache, if enabled in the 'store.cache' configuration section, and/or in
+    a negative cache of equality searches, if 'store.cache.negative_ttl' is positive, and/or in a layer that
+    coalesces identical concurrent reads, if 'store.cache.coalesce' is enabled. The caches of stores whose
+    resource type isn't cached still count as related, so that they invalidate the others.
+    """
+    enabled = str(CONFIG.get("store.cache.enabled", False)).lower() == "true"
+    negative_ttl = float(CONFIG.get("store.cache.negative_ttl", 0))
+    coalesce = str(CONFIG.get("store.cache.coalesce", False)).lower() == "true"
+    if not enabled and negative_ttl <= 0 and not coalesce:
+        return impl
+    resource_types = [rt.lower() for rt in _config_list("store.cache.resource_types", ["users", "groups"])]
+    operations = _config_list("store.cache.operations", ["get_by_id", "get_members"]) if enabled else []
+    cached = {
+        name: CachingStore(
+            store,
+            max_size=int(CONFIG.get("store.cache.max_size", 10000)),
+            ttl=float(CONFIG.get("store.cache.ttl", 30)),
+            operations=operations if name in resource_types else [],
+            negative_ttl=negative_ttl,
+            unique_attributes=UNIQUE_ATTRIBUTES.get(name, ("id",)),
+            coalesce=coalesce
+        )
+        for name, store in impl.items()
+    }
+    CachingStore.relate(*cached.values())
+    if enabled:
+        LOGGER.info("Caching %s of %s", ", ".join(operations), ", ".join(resource_types))
+    if negative_ttl > 0:
+        LOGGER.info("Caching empty equality searches for %s seconds", negative_ttl)
+    if coalesce:
+        LOGGER.info("Coalescing identical concurrent reads")
+    return cached
+
+
+def invalidation_bus(stores: Dict[str, BaseStore], watch_changes: Optional[WatchChanges]) -> Optional[InvalidationBus]:
+    """
+    :return: The bus that evicts the writes of other replicas from the caches, if 'store.cache.invalidation' is
+             enabled and the stores are cached
+    """
+    if str(CONFIG.get("store.cache.invalidation", False)).lower() != "true":
+        return None
+    cached = {name: store for name, store in stores.items() if isinstance(store, CachingStore)}
+    if not cached or watch_changes is None:
+        LOGGER.warning("Cache invalidation is enabled, but there's no cache to invalidate or changes to watch")
+        return None
+    return InvalidationBus(cached, watch_changes)
+
+
 def init_stores():
     store_impl: BaseStore
+    watch_changes: Optional[WatchChanges] = None
     if CONFIG.get("store.pg.host") is not None:
         store_type = "PostgreSQL"
         user_store = PostgresqlStore("users")
         group_store = PostgresqlStore("groups")
-        stores = Stores(
-            users=user_store,
-            groups=group_store
-        )
+        watch_changes = postgresql_store.watch_changes
     elif CONFIG.get("store.mysql.host") is not None:
         store_type = "MySQL"
         user_store = MySqlStore("users")
         group_store = MySqlStore("groups")
-        stores = Stores(
-            users=user_store,
-            groups=group_store
-        )
+        watch_changes = mysql_store.watch_changes
     elif CONFIG.get("store.cosmos.account_uri"):
         store_type = "Cosmos DB"
-        stores = Stores(
-            users=CosmosDbStore("users", unique_attribute="userName"),
-            groups=CosmosDbStore("groups", unique_attribute="displayName")
-        )
+        user_store = CosmosDbStore("users", unique_attribute="userName")
+        group_store = CosmosDbStore("groups", unique_attribute="displayName")
+        watch_changes = cosmos_db_store.watch_changes
     elif CONFIG.get("store.mongo.host") or CONFIG.get("store.mongo.dsn"):
         store_type = "MongoDB"
-        stores = Stores(
-            users=MongoDbStore("users"),
-            groups=MongoDbStore("groups")
-        )
+        user_store = MongoDbStore("users")
+        group_store = MongoDbStore("groups")
+        watch_changes = mongodb_store.watch_changes
     else:
         store_type = "In-Memory"
-        stores = Stores(
-            users=MemoryStore("User"),
-            groups=MemoryStore(
-                "Group",
-                name_uniqueness=True,
-                resources=None,
-                nested_store_attr="members"
-            )
+        user_store = MemoryStore("User")
+        group_store = MemoryStore(
+            "Group",
+            name_uniqueness=True,
+            resources=None,
+            nested_store_attr="members"
         )
+    stores = Stores(**cache_stores(users=user_store, groups=group_store))
+    stores.invalidation_bus = invalidation_bus(stores.impl, watch_changes)
     LOGGER.info("Using the %s data store", store_type)
     return stores
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compares the JSON codecs on the encoding of a page of a users list response (the bulk of the REST layer's
+encoding work), and on decoding it back:
+
+    CONFIG_PATH=./config/unit-tests.yaml python -m tests.benchmarks.bench_json_codec [--users 100] [--number 200]
+"""
+import argparse
+import timeit
+import uuid
+
+from keystone_scim.models import DEFAULT_LIST_SCHEMA
+from keystone_scim.models.user import DEFAULT_USER_SCHEMA
+from keystone_scim.util.json_codec import CODECS, get_codec
+
+
+def list_response(users: int) -> dict:
+    resources = []
+    for i in range(users):
+        resources.append({
+            "schemas": [DEFAULT_USER_SCHEMA],
+            "id": str(uuid.uuid4()),
+            "externalId": str(uuid.uuid4()),
+            "userName": f"user{i}@example.com",
+            "displayName": f"User Number {i}",
+            "name": {"formatted": f"User Number {i}", "givenName": "User", "familyName": f"Number {i}"},
+            "locale": "en-US",
+            "active": True,
+            "emails": [
+                {"value": f"user{i}@example.com", "type": "work", "primary": True},
+                {"value": f"user{i}@example.org", "type": "home", "primary": False},
+            ],
+            "groups": [{"value": str(uuid.uuid4()), "display": f"Group {g}"} for g in range(5)],
+            "meta": {"resourceType": "User", "version": f'W/"{i + 1}"'},
+        })
+    return {
+        "schemas": [DEFAULT_LIST_SCHEMA],
+        "totalResults": users,
+        "startIndex": 1,
+        "itemsPerPage": users,
+        "Resources": resources,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="The number of users of the list response")
+    parser.add_argument("--number", type=int, default=200, help="The number of encodings (and decodings) to time")
+    args = parser.parse_args()
+
+    data = list_response(args.users)
+    print(f"Encoding (and decoding) a list response of {args.users} users, {args.number} times:")
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            print(f"  {name:<8} not installed")
+            continue
+        body = codec.dumpb(data)
+        encode = min(timeit.repeat(lambda: codec.dumpb(data), number=args.number, repeat=3))
+        decode = min(timeit.repeat(lambda: codec.loads(body), number=args.number, repeat=3))
+        print(f"  {name:<8} encode: {encode / args.number * 1e6:9.1f} µs/op    "
+              f"decode: {decode / args.number * 1e6:9.1f} µs/op    ({len(body)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -165,16 +165,24 @@ def memory_store():
 @pytest.fixture
 def scim_api(aiohttp_client, event_loop, cfg):
     from keystone_scim.rest import get_error_handling_mw
+    from keystone_scim.rest.bulk import get_bulk_routes
+    from keystone_scim.rest.export import get_export_routes
     from keystone_scim.rest.group import get_group_routes
+    from keystone_scim.rest.service_provider_config import get_service_provider_config_routes
     from keystone_scim.rest.user import get_user_routes
-    scim_api = web.Application()
-    scim_api.add_routes(get_user_routes(MemoryStore("User")))
-    scim_api.add_routes(get_group_routes(MemoryStore(
+    user_store = MemoryStore("User")
+    group_store = MemoryStore(
         "Group",
         name_uniqueness=True,
         resources=None,
         nested_store_attr="members"
-    )))
+    )
+    scim_api = web.Application()
+    scim_api.add_routes(get_user_routes(user_store))
+    scim_api.add_routes(get_group_routes(group_store))
+    scim_api.add_routes(get_export_routes(user_store, group_store))
+    scim_api.add_routes(get_bulk_routes(user_store, group_store))
+    scim_api.add_routes(get_service_provider_config_routes())
     app = web.Application()
     app.add_subapp("/scim", scim_api)
     ehmw = event_loop.run_until_complete(get_error_handling_mw())
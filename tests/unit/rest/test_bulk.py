@@ -0,0 +1,115 @@
+import pytest
+
+
+class TestBulkRest:
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_create_with_bulk_id_references(scim_api, users, headers):
+        operations = [{
+            "method": "POST",
+            "path": "/Users",
+            "bulkId": f"user{i}",
+            "data": {k: v for k, v in u.items() if k != "id"},
+        } for i, u in enumerate(users)]
+        operations.append({
+            "method": "POST",
+            "path": "/Groups",
+            "bulkId": "group",
+            "data": {
+                "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Group"],
+                "displayName": "Bulk Group",
+                "members": [{"value": f"bulkId:user{i}"} for i in range(len(users))],
+            },
+        })
+        resp = await scim_api.post("/scim/Bulk", json={"Operations": operations}, headers=headers)
+        assert resp.status == 200
+        results = (await resp.json())["Operations"]
+        assert ["201"] * (len(users) + 1) == [r["status"] for r in results]
+        user_ids = {r["location"].rsplit("/", 1)[-1] for r in results[:-1]}
+
+        resp = await scim_api.get(f"/scim/Groups/{results[-1]['location'].rsplit('/', 1)[-1]}", headers=headers)
+        group = await resp.json()
+        assert user_ids == {m["value"] for m in group["members"]}
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_patch_and_delete(scim_api, users, single_group, headers):
+        created = [await (await scim_api.post("/scim/Users", json=u, headers=headers)).json() for u in users]
+        group = await (await scim_api.post("/scim/Groups", json=single_group, headers=headers)).json()
+        operations = [{
+            "method": "PATCH",
+            "path": f"/Groups/{group['id']}",
+            "data": {"Operations": [{"op": "add", "path": "members", "value": [{"value": u["id"]}]}]},
+        } for u in created]
+        operations.append({"method": "DELETE", "path": f"/Users/{created[0]['id']}"})
+        resp = await scim_api.post("/scim/Bulk", json={"Operations": operations}, headers=headers)
+        results = (await resp.json())["Operations"]
+        assert ["200"] * len(users) + ["204"] == [r["status"] for r in results]
+        assert len(users) == len(results[0]["response"]["members"])
+        resp = await scim_api.get(f"/scim/Users/{created[0]['id']}", headers=headers)
+        assert resp.status == 404
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_patch_failures_are_reported_per_operation(scim_api, users, single_group, headers):
+        created = [await (await scim_api.post("/scim/Users", json=u, headers=headers)).json() for u in users[:2]]
+        group = await (await scim_api.post("/scim/Groups", json=single_group, headers=headers)).json()
+        add = [{"op": "add", "path": "members", "value": [{"value": u["id"]}]} for u in created]
+        operations = [
+            {"method": "PATCH", "path": f"/Groups/{group['id']}", "data": {"Operations": ops}}
+            for ops in ([add[0]], [{"op": "move", "path": "members"}], [add[1]])
+        ]
+        resp = await scim_api.post("/scim/Bulk", json={"Operations": operations}, headers=headers)
+        results = (await resp.json())["Operations"]
+        assert ["200", "400", "200"] == [r["status"] for r in results]
+        assert "invalidValue" == results[1]["response"]["scimType"]
+        assert {u["id"] for u in created} == {m["value"] for m in results[-1]["response"]["members"]}
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_fail_on_errors(scim_api, single_user, rand_id, headers):
+        operations = [
+            {"method": "DELETE", "path": f"/Users/{rand_id}"},
+            {"method": "POST", "path": "/Users", "data": single_user},
+            {"method": "POST", "path": "/Users", "data": single_user},
+            {"method": "POST", "path": "/Groups", "data": {"members": [{"value": "bulkId:nope"}]}},
+        ]
+        resp = await scim_api.post("/scim/Bulk", json={"Operations": operations}, headers=headers)
+        results = (await resp.json())["Operations"]
+        assert ["404", "201", "409", "409"] == [r["status"] for r in results]
+        assert "invalidValue" == results[-1]["response"]["scimType"]
+
+        resp = await scim_api.post("/scim/Bulk", json={"failOnErrors": 1, "Operations": operations}, headers=headers)
+        results = (await resp.json())["Operations"]
+        assert ["404"] == [r["status"] for r in results]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_fail_on_errors_stops_within_run(scim_api, headers):
+        schemas = ["urn:ietf:params:scim:schemas:core:2.0:Group"]
+        _ = await scim_api.post("/scim/Groups", json={"schemas": schemas, "displayName": "Taken"}, headers=headers)
+        operations = [
+            {"method": "POST", "path": "/Groups", "data": {"schemas": schemas, "displayName": name}}
+            for name in ("First", "Taken", "Taken", "Last")
+        ]
+        resp = await scim_api.post("/scim/Bulk", json={"failOnErrors": 1, "Operations": operations}, headers=headers)
+        results = (await resp.json())["Operations"]
+        assert ["201", "409"] == [r["status"] for r in results]
+        resp = await scim_api.get("/scim/Groups", params={"filter": "displayName eq \"Last\""}, headers=headers)
+        assert 0 == (await resp.json())["totalResults"]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_bulk_limits(scim_api, headers, monkeypatch):
+        monkeypatch.setenv("BULK_MAX_OPERATIONS", "1")
+        operations = [{"method": "DELETE", "path": "/Users/a"}, {"method": "DELETE", "path": "/Users/b"}]
+        resp = await scim_api.post("/scim/Bulk", json={"Operations": operations}, headers=headers)
+        assert resp.status == 413
+        assert "413" == (await resp.json())["status"]
+
+        resp = await scim_api.get("/scim/ServiceProviderConfig", headers=headers)
+        assert resp.status == 200
+        spc = await resp.json()
+        assert spc["bulk"]["supported"]
+        assert 1 == spc["bulk"]["maxOperations"]
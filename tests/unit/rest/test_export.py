@@ -0,0 +1,38 @@
+import asyncio
+import json
+
+import pytest
+
+
+class TestExportRest:
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_export_users_and_groups(scim_api, users, groups, headers):
+        responses = await asyncio.gather(
+            *[scim_api.post("/scim/Users", json=u, headers=headers) for u in users],
+            *[scim_api.post("/scim/Groups", json=g, headers=headers) for g in groups],
+        )
+        assert all([r.status == 201 for r in responses])
+        resp = await scim_api.get("/scim/Export", headers=headers)
+        assert resp.status == 200
+        assert resp.content_type == "application/x-ndjson"
+        lines = [json.loads(ln) for ln in (await resp.text()).splitlines()]
+        assert len(users) + len(groups) == len(lines)
+        assert {u["id"] for u in users} == {ln["id"] for ln in lines[:len(users)]}
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_export_single_resource_type(scim_api, groups, headers):
+        responses = await asyncio.gather(*[scim_api.post("/scim/Groups", json=g, headers=headers) for g in groups])
+        assert all([r.status == 201 for r in responses])
+        resp = await scim_api.get("/scim/Export?resourceType=groups", headers=headers)
+        assert resp.status == 200
+        lines = [json.loads(ln) for ln in (await resp.text()).splitlines()]
+        assert {g["displayName"] for g in groups} == {ln["displayName"] for ln in lines}
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_export_invalid_resource_type_fails(scim_api, headers):
+        resp = await scim_api.get("/scim/Export?resourceType=devices", headers=headers)
+        assert resp.status == 400
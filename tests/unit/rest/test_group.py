@@ -229,3 +229,99 @@ class TestGroupRest:
         resp = await scim_api.get(search_url, headers=headers)
         assert resp.status == 200
         assert len((await resp.json())["Resources"]) == 1
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_large_group_members_are_paged(scim_api, single_group, users, headers, monkeypatch):
+        monkeypatch.setenv("GROUPS_MAX_MEMBERS", "2")
+        _ = await asyncio.gather(*[scim_api.post("/scim/Users", json=u, headers=headers) for u in users])
+        single_group["members"] = [{"value": u["id"], "display": u["userName"]} for u in users]
+        resp = await scim_api.post("/scim/Groups", json=single_group, headers=headers)
+        group_id = (await resp.json()).get("id")
+
+        resp = await scim_api.get(f"/scim/Groups/{group_id}", headers=headers)
+        assert resp.status == 200
+        assert 2 == len((await resp.json())["members"])
+        assert str(len(users)) == resp.headers["X-Total-Members"]
+        assert f"/scim/Groups/{group_id}/members?startIndex=3&count=2" in resp.headers["Link"]
+
+        resp = await scim_api.get(f"/scim/Groups/{group_id}/members?startIndex=3&count=10", headers=headers)
+        assert resp.status == 200
+        page = await resp.json()
+        assert len(users) == page["totalResults"]
+        assert len(users) - 2 == len(page["Resources"])
+
+        patch_payload = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+            "Operations": [{"op": "replace", "value": {"displayName": "Renamed"}}]
+        }
+        resp = await scim_api.patch(f"/scim/Groups/{group_id}", json=patch_payload,
+                                    headers={**headers, "Prefer": "return=minimal"})
+        assert resp.status == 204
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_patch_group_operations_are_coalesced(scim_api, single_group, users, headers):
+        single_group["members"] = [{"value": u["id"], "display": u["userName"]} for u in users[:2]]
+        resp = await scim_api.post("/scim/Groups", json=single_group, headers=headers)
+        group_id = (await resp.json()).get("id")
+        patch_payload = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+            "Operations": [
+                {"op": "add", "path": "members", "value": [{"value": users[2]["id"]}, {"value": users[3]["id"]}]},
+                {"op": "remove", "path": f"members[value eq \"{users[3]['id']}\"]"},
+                {"op": "Remove", "path": "members", "value": [{"value": users[0]["id"]}]},
+                {"op": "add", "path": "members", "value": [{"value": users[0]["id"]}]},
+                {"op": "remove", "path": "members", "value": [{"value": users[1]["id"]}]},
+                {"op": "replace", "path": "displayName", "value": "Renamed"},
+            ]
+        }
+        resp = await scim_api.patch(f"/scim/Groups/{group_id}", json=patch_payload, headers=headers)
+        assert resp.status == 200
+        group = await resp.json()
+        assert "Renamed" == group.get("displayName")
+        assert {users[0]["id"], users[2]["id"]} == {m["value"] for m in group["members"]}
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_patch_group_with_invalid_operation_fails(scim_api, single_group, users, headers):
+        resp = await scim_api.post("/scim/Groups", json=single_group, headers=headers)
+        group_id = (await resp.json()).get("id")
+        patch_payload = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+            "Operations": [
+                {"op": "add", "path": "members", "value": [{"value": users[0]["id"]}]},
+                {"op": "move", "path": "members", "value": [{"value": users[1]["id"]}]},
+            ]
+        }
+        resp = await scim_api.patch(f"/scim/Groups/{group_id}", json=patch_payload, headers=headers)
+        assert resp.status == 400
+        assert "invalidValue" == (await resp.json()).get("scimType")
+        # No operation is applied:
+        resp = await scim_api.get(f"/scim/Groups/{group_id}", headers=headers)
+        assert 0 == len((await resp.json())["members"])
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_conditional_requests(scim_api, single_group, users, headers):
+        resp = await scim_api.post("/scim/Groups", json=single_group, headers=headers)
+        assert resp.status == 201
+        group_id = (await resp.json()).get("id")
+        etag = resp.headers.get("ETag")
+        assert etag
+        resp = await scim_api.get(f"/scim/Groups/{group_id}", headers={**headers, "If-None-Match": etag})
+        assert resp.status == 304
+
+        # Changes of the members change the group's version:
+        patch_payload = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+            "Operations": [{"op": "add", "path": "members", "value": [{"value": users[0]["id"]}]}]
+        }
+        resp = await scim_api.patch(f"/scim/Groups/{group_id}", json=patch_payload,
+                                    headers={**headers, "If-Match": etag})
+        assert resp.status == 200 and etag != resp.headers.get("ETag")
+        resp = await scim_api.patch(f"/scim/Groups/{group_id}", json=patch_payload,
+                                    headers={**headers, "If-Match": etag})
+        assert resp.status == 412
+        resp = await scim_api.get(f"/scim/Groups/{group_id}", headers={**headers, "If-None-Match": etag})
+        assert resp.status == 200 and 1 == len((await resp.json())["members"])
@@ -124,3 +124,51 @@ class TestUserRest:
         resp = await scim_api.get(search_url, headers=headers)
         assert resp.status == 200
         assert len((await resp.json())["Resources"]) == 1
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_get_users_with_projection(scim_api, users, headers):
+        responses = await asyncio.gather(*[
+            scim_api.post("/scim/Users", json=u, headers=headers)
+            for u in users
+        ])
+        assert 201 * len(users) == sum([r.status for r in responses])
+        resp = await scim_api.get("/scim/Users?attributes=userName,name.givenName", headers=headers)
+        assert resp.status == 200
+        for user in (await resp.json())["Resources"]:
+            assert {"id", "schemas", "userName", "name"} == set(user.keys())
+            assert {"givenName"} == set(user["name"].keys())
+
+        user_id = users[0].get("id")
+        resp = await scim_api.get(f"/scim/Users/{user_id}?excludedAttributes=emails,name", headers=headers)
+        assert resp.status == 200
+        user = await resp.json()
+        assert "emails" not in user and "name" not in user and user_id == user["id"]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_conditional_requests(scim_api, single_user, headers):
+        resp = await scim_api.post("/scim/Users", json=single_user, headers=headers)
+        assert resp.status == 201
+        user_id = (await resp.json()).get("id")
+        resp = await scim_api.get(f"/scim/Users/{user_id}", headers=headers)
+        etag = resp.headers.get("ETag")
+        assert etag and etag == (await resp.json())["meta"]["version"]
+
+        # The current version isn't sent again:
+        resp = await scim_api.get(f"/scim/Users/{user_id}", headers={**headers, "If-None-Match": etag})
+        assert resp.status == 304 and etag == resp.headers.get("ETag")
+
+        # Writes change the version, and writes based on an older version fail:
+        resp = await scim_api.patch(f"/scim/Users/{user_id}", json={"displayName": "Joane Doe"},
+                                    headers={**headers, "If-Match": etag})
+        assert resp.status == 200
+        new_etag = resp.headers.get("ETag")
+        assert new_etag and new_etag != etag
+        resp = await scim_api.put(f"/scim/Users/{user_id}", json={"displayName": "John Doe"},
+                                  headers={**headers, "If-Match": etag})
+        assert resp.status == 412
+        resp = await scim_api.get(f"/scim/Users/{user_id}", headers={**headers, "If-None-Match": etag})
+        assert resp.status == 200 and "Joane Doe" == (await resp.json()).get("displayName")
+        resp = await scim_api.delete(f"/scim/Users/{user_id}", headers={**headers, "If-Match": f"{etag}, {new_etag}"})
+        assert resp.status == 200
@@ -0,0 +1,234 @@
+import asyncio
+
+import pytest
+
+from keystone_scim.store.caching_store import CachingStore
+from keystone_scim.store.invalidation import InvalidationBus
+from keystone_scim.store.memory_store import MemoryStore
+from keystone_scim.util.cache import LRUCache
+from keystone_scim.util.exc import ResourceNotFound
+
+
+def caching_stores(**kwargs):
+    user_store = CachingStore(MemoryStore("User"), **kwargs)
+    group_store = CachingStore(MemoryStore("Group", name_uniqueness=True, nested_store_attr="members"), **kwargs)
+    CachingStore.relate(user_store, group_store)
+    return user_store, group_store
+
+
+class TestCachingStore:
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_lru_cache_is_bounded():
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert 1 == cache.get("a")
+        cache.put("c", 3)
+        # "b" was the least recently used entry:
+        assert "b" not in cache
+        assert 1 == cache.get("a") and 3 == cache.get("c")
+
+        cache = LRUCache(max_size=2, ttl=-1)
+        cache.put("a", 1)
+        assert 1 == cache.get("a")
+        cache.ttl = 1e-9
+        cache.put("a", 1)
+        assert cache.get("a") is None
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_get_by_id_is_cached(single_user):
+        user_store, _ = caching_stores()
+        _ = await user_store.create(single_user)
+        user_id = single_user.get("id")
+        user = await user_store.get_by_id(user_id)
+        # Reads don't see changes made to (or by) callers:
+        user["userName"] = "changed"
+        assert single_user.get("userName") == (await user_store.get_by_id(user_id)).get("userName")
+        assert {"hits": 1, "misses": 1, "hit_ratio": 0.5, "coalesced": 0} == user_store.stats()["operations"]["get_by_id"]
+
+        # Projections are cached apart:
+        user = await user_store.get_by_id(user_id, attributes=["userName"])
+        assert "emails" not in user
+        assert 2 == user_store.stats()["misses"]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_writes_invalidate(single_user):
+        user_store, _ = caching_stores()
+        _ = await user_store.create(single_user)
+        user_id = single_user.get("id")
+        _ = await user_store.get_by_id(user_id)
+        _ = await user_store.update(user_id, **{**single_user, "displayName": "Updated"})
+        assert "Updated" == (await user_store.get_by_id(user_id)).get("displayName")
+
+        _ = await user_store.delete(user_id)
+        exc_thrown = False
+        try:
+            _ = await user_store.get_by_id(user_id)
+        except ResourceNotFound:
+            exc_thrown = True
+        assert exc_thrown
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_membership_changes_invalidate_groups(users, single_group):
+        user_store, group_store = caching_stores()
+        for u in users:
+            _ = await user_store.create(u)
+        group_id = (await group_store.create({**single_group, "members": []})).get("id")
+        assert [] == (await group_store.get_by_id(group_id)).get("members")
+        _, total = await group_store.get_members(group_id)
+        assert 0 == total
+
+        _ = await group_store.patch_group(group_id, {}, [{"value": u.get("id")} for u in users], [])
+        assert len(users) == len((await group_store.get_by_id(group_id)).get("members"))
+        _, total = await group_store.get_members(group_id)
+        assert len(users) == total
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_only_selected_operations_are_cached(users):
+        user_store, _ = caching_stores(operations=["search"])
+        for u in users:
+            _ = await user_store.create(u)
+        _ = await user_store.get_by_id(users[0].get("id"))
+        _, total = await user_store.search(_filter=None)
+        assert len(users) == total
+        _, total = await user_store.search(_filter=None)
+        assert ["search"] == list(user_store.stats()["operations"].keys())
+        assert {"hits": 1, "misses": 1, "hit_ratio": 0.5, "coalesced": 0} == user_store.stats()["operations"]["search"]
+
+        # Writes invalidate searches:
+        _ = await user_store.delete(users[0].get("id"))
+        _, total = await user_store.search(_filter=None)
+        assert len(users) - 1 == total
+
+        exc_thrown = False
+        try:
+            _ = CachingStore(MemoryStore("User"), operations=["create"])
+        except ValueError:
+            exc_thrown = True
+        assert exc_thrown
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_empty_equality_searches_are_cached(users):
+        user_store = CachingStore(MemoryStore("User"), operations=[], negative_ttl=60,
+                                  unique_attributes=("id", "userName"))
+        user_name = users[0].get("userName")
+        for _ in range(3):
+            resources, total = await user_store.search(_filter=f"userName eq \"{user_name.upper()}\"")
+            assert 0 == total and [] == resources
+        # Filters on other attributes, or with other operators, aren't cached:
+        _ = await user_store.search(_filter=f"userName co \"{user_name}\"")
+        _ = await user_store.search(_filter=f"displayName eq \"{user_name}\"")
+        assert {"size": 1, "hits": 2, "misses": 1, "hit_ratio": 2 / 3} == user_store.stats()["negative"]
+
+        # Creating a matching resource drops the negative result:
+        _ = await user_store.create(users[0])
+        _, total = await user_store.search(_filter=f"userName eq \"{user_name.upper()}\"")
+        assert 1 == total
+        # ...and so does renaming a resource to the value:
+        _ = await user_store.create(users[1])
+        _, total = await user_store.search(_filter="userName eq \"renamed\"")
+        assert 0 == total
+        _ = await user_store.update(users[1].get("id"), **{**users[1], "userName": "renamed"})
+        _, total = await user_store.search(_filter="userName eq \"renamed\"")
+        assert 1 == total
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_invalidation_bus(users, single_group):
+        user_store, group_store = caching_stores(
+            operations=["get_by_id"], negative_ttl=60, unique_attributes=("id", "userName")
+        )
+        for u in users:
+            _ = await user_store.create(u)
+        group_id = (await group_store.create({**single_group, "members": [{"value": users[0].get("id")}]})).get("id")
+        changes = asyncio.Queue()
+        connections = []
+
+        async def watch_changes(on_change, on_ready):
+            connections.append(len(connections))
+            on_ready()
+            while True:
+                change = await changes.get()
+                if change is None:
+                    raise ConnectionError("Disconnected")
+                on_change(change)
+
+        async def read_all():
+            _ = await user_store.get_by_id(users[0].get("id"))
+            _ = await user_store.get_by_id(users[1].get("id"))
+            _ = await group_store.get_by_id(group_id)
+            _ = await user_store.search(_filter="userName eq \"nobody\"")
+
+        bus = InvalidationBus({"users": user_store, "groups": group_store}, watch_changes)
+        bus.start()
+        try:
+            await asyncio.sleep(0.01)
+            await read_all()
+            assert 3 == len(user_store.cache) + len(group_store.cache)
+
+            # A change of memberships only drops the group and its members:
+            await changes.put({"type": "groups", "id": group_id, "members": [users[0].get("id")]})
+            await asyncio.sleep(0.01)
+            assert ("resource", users[1].get("id")) in user_store.cache
+            assert ("resource", users[0].get("id")) not in user_store.cache
+            assert 0 == len(group_store.cache) and 1 == len(user_store.negative_cache)
+
+            # Any other change drops the related entries and the negative results:
+            await read_all()
+            await changes.put({"type": "users", "id": users[1].get("id")})
+            await asyncio.sleep(0.01)
+            assert ("resource", users[0].get("id")) in user_store.cache
+            assert 0 == len(group_store.cache) and 0 == len(user_store.negative_cache)
+            assert 2 == bus.changes
+
+            # Reconnecting clears the caches, since changes may have been missed:
+            await read_all()
+            bus.retry_delay = 0
+            await changes.put(None)
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+            assert 2 == len(connections)
+            assert 0 == len(user_store.cache) + len(group_store.cache)
+        finally:
+            await bus.stop()
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_concurrent_reads_are_coalesced(users):
+        memory_store = MemoryStore("User")
+        user_store = CachingStore(memory_store, operations=[], coalesce=True)
+        for u in users:
+            _ = await user_store.create(u)
+        calls = []
+        get_by_id = memory_store.get_by_id
+
+        async def counted_get_by_id(*args, **kwargs):
+            calls.append(args)
+            await asyncio.sleep(0.01)
+            return await get_by_id(*args, **kwargs)
+
+        memory_store.get_by_id = counted_get_by_id
+        user_id = users[0].get("id")
+        results = await asyncio.gather(*[
+            user_store.get_by_id(user_id, attributes=attributes)
+            for attributes in (["userName", "id"], ["id", "USERNAME"], ["userName", "id"])
+        ])
+        assert 1 == len(calls)
+        assert results[0] == results[1] == results[2] and results[0] is not results[1]
+        assert 2 == user_store.stats()["operations"]["get_by_id"]["coalesced"]
+
+        # Reads that start after a write don't share the calls that started before it:
+        first = asyncio.ensure_future(user_store.get_by_id(user_id))
+        await asyncio.sleep(0)
+        _ = await user_store.update(user_id, **{**users[0], "displayName": "Updated"})
+        second = await user_store.get_by_id(user_id)
+        _ = await first
+        assert 3 == len(calls)
+        assert "Updated" == second.get("displayName")
@@ -5,6 +5,7 @@ from typing import Dict
 import pytest
 from scim2_filter_parser.parser import SCIMParserError
 
+from keystone_scim.store.memory_store import MemoryStore
 from keystone_scim.util.case_insensitive_dict import CaseInsensitiveDict
 from keystone_scim.util.exc import ResourceNotFound, ResourceAlreadyExists
 
@@ -351,3 +352,15 @@ class TestMemoryStore:
         assert len(res) == 3
         res, _ = await memory_store.search(f"USERNAME sw \"{email_to_search}\" and locale pr")
         assert len(res) == 0
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_concurrent_group_patches_keep_all_members(single_group):
+        group_store = MemoryStore("Group", name_uniqueness=True, nested_store_attr="members")
+        group_id = (await group_store.create({**single_group, "members": []})).get("id")
+        _ = await asyncio.gather(*[
+            group_store.patch_group(group_id, {}, [{"value": f"u{i}"}], []) for i in range(20)
+        ])
+        members, _ = await group_store.get_members(group_id, count=100)
+        assert {f"u{i}" for i in range(20)} == {m.get("value") for m in members}
+
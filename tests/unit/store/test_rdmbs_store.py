@@ -2,15 +2,49 @@ import uuid
 from random import choice
 
 import asyncio
+import json
+import psycopg2
+import pymysql
 import pytest
 from psycopg2.errors import UniqueViolation
 from pymysql.err import IntegrityError
+from sqlalchemy import text
 
-from keystone_scim.util.exc import ResourceNotFound
+from keystone_scim.store import mysql_queries, mysql_store, pg_sql_queries, postgresql_store
+from keystone_scim.store.postgresql_store import PostgresqlStore
+from keystone_scim.util import json_codec
+from keystone_scim.util.exc import PreconditionFailed, ResourceNotFound
 
 
 class TestRdbmsStore:
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_schema_migrations_applied(rdbms_stores):
+        user_store, _ = rdbms_stores
+        migrations = pg_sql_queries.migrations if isinstance(user_store, PostgresqlStore) \
+            else mysql_queries.migrations
+        engine = await user_store.get_engine()
+        async with engine.acquire() as conn:
+            versions = [row[0] async for row in conn.execute(text("SELECT version FROM schema_version"))]
+        assert sorted(versions) == [v for v, _ in migrations]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["mysql"], indirect=["rdbms_stores"])
+    async def test_mysql_schema_migrations_can_be_retried(rdbms_stores):
+        user_store, _ = rdbms_stores
+        last_version = mysql_queries.migrations[-1][0]
+        conn_args = mysql_store.get_conn_args(**user_store.conn_args)
+        conn = pymysql.connect(cursorclass=pymysql.cursors.DictCursor, **conn_args)
+        with conn:
+            # As if the last migration failed after its statements were committed:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM `schema_version` WHERE `version` = %s", (last_version,))
+            conn.commit()
+            assert last_version == mysql_store.migrate_schema(conn)
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -108,6 +142,55 @@ class TestRdbmsStore:
         assert 1 == count == len(res)
         assert res[0].get("userName") == username
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_search_user_with_quoted_value(rdbms_stores, single_user):
+        user_store, _ = rdbms_stores
+        display_name = "Shaquille O'Neal"
+        _ = await user_store.create({**single_user, "displayName": display_name})
+        for _filter in [f"displayName eq \"{display_name}\"", "displayName co \"O'Ne\""]:
+            res, count = await user_store.search(_filter)
+            assert 1 == count == len(res)
+            assert res[0].get("displayName") == display_name
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_pg_filter_translation():
+        user_store = PostgresqlStore("users")
+        where, params = await user_store._get_where_clause_from_filter(
+            "userName sw \"john\" and emails co \"doe\"", user_store.user_attr_map
+        )
+        assert "users.\"userName\"::text ILIKE :param_a" in where.text
+        assert "user_emails.value::text ILIKE :param_b" in where.text
+        assert {"param_a": "john%", "param_b": "%doe%"} == params
+
+        # The compiled clause is reused for filters of the same shape:
+        same_shape_where, _ = await user_store._get_where_clause_from_filter(
+            "userName sw \"jane\" and emails co \"roe\"", user_store.user_attr_map
+        )
+        assert where is same_shape_where
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql"], indirect=["rdbms_stores"])
+    async def test_pg_json_codec_is_registered_per_connection(rdbms_stores, single_user, monkeypatch):
+        user_store, _ = rdbms_stores
+        _ = await user_store.create(single_user)
+        decoded = []
+        monkeypatch.setattr(json_codec, "loads", lambda s: decoded.append(s) or json.loads(s))
+        user = await user_store.get_by_id(single_user.get("id"))
+        assert single_user.get("emails")[0].get("value") == user.get("emails")[0].get("value")
+        assert len(decoded) > 0
+        # Other psycopg2 connections of the process decode JSON values with psycopg2's defaults:
+        decoded.clear()
+        conn = psycopg2.connect(postgresql_store.build_dsn(**user_store.conn_args))
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT '{\"a\": 1}'::jsonb, '[1]'::json")
+            assert ({"a": 1}, [1]) == cursor.fetchone()
+        conn.close()
+        assert [] == decoded
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -143,6 +226,37 @@ class TestRdbmsStore:
         assert 1 == count == len(res)
         assert res[0].get("userName") == single_user.get("userName")
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_search_user_by_username_or_email(rdbms_stores, users):
+        user_store, _ = rdbms_stores
+        without_emails = await user_store.create({**users[0], "emails": []})
+        with_emails = await user_store.create(users[1])
+        _ = await user_store.create(users[2])
+        email = users[1].get("emails")[0].get("value")
+        # Users without emails still match the other predicates of the filter:
+        _filter = f"userName eq \"{without_emails.get('userName')}\" or emails.value eq \"{email}\""
+        res, count = await user_store.search(_filter)
+        assert 2 == count == len(res)
+        assert sorted([without_emails.get("id"), with_emails.get("id")]) == [u.get("id") for u in res]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_search_user_by_membership_value(rdbms_stores, users, single_group):
+        user_store, group_store = rdbms_stores
+        for u in users:
+            _ = await user_store.create(u)
+        member_id = users[0].get("id")
+        _ = await group_store.create({**single_group, "members": [{"value": member_id}]})
+        res, count = await user_store.search(f"value eq \"{member_id}\"")
+        assert 1 == count == len(res)
+        assert member_id == res[0].get("id")
+        # Users that aren't members of any group don't match:
+        res, count = await user_store.search(f"value eq \"{users[1].get('id')}\"")
+        assert 0 == count == len(res)
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -160,6 +274,25 @@ class TestRdbmsStore:
         assert len(users) == count
         assert 2 == len(res)
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_search_user_aggregates_emails_and_groups(rdbms_stores, single_user, groups):
+        user_store, group_store = rdbms_stores
+        user = await user_store.create({**single_user, "emails": single_user.get("emails") + [{
+            "value": "johndoe@emailprovider.com",
+            "primary": False,
+            "type": "home"
+        }]})
+        for g in groups[:3]:
+            group = await group_store.create(g)
+            _ = await group_store.add_user_to_group(user.get("id"), group.get("id"))
+        _filter = "emails co \"@\""
+        res, count = await user_store.search(_filter)
+        assert 1 == count == len(res)
+        assert 2 == len(res[0].get("emails"))
+        assert 3 == len(res[0].get("groups"))
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -190,6 +323,27 @@ class TestRdbmsStore:
         assert 2 == len(updated_user.get("emails"))
         assert "John Doe" == updated_user.get("displayName") == updated_user.get("name").get("formatted")
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_update_user_emails_is_isolated(rdbms_stores, users):
+        user_store, _ = rdbms_stores
+        user, other_user = users[0], users[1]
+        user_id = (await user_store.create(user)).get("id")
+        other_user_id = (await user_store.create(other_user)).get("id")
+
+        updated_user = await user_store.update(user_id, emails=[])
+        assert [] == updated_user.get("emails")
+        other_user = await user_store.get_by_id(other_user_id)
+        assert 1 == len(other_user.get("emails"))
+
+        exc_thrown = False
+        try:
+            _ = await user_store.update(str(uuid.uuid4()), displayName="John Doe", emails=user.get("emails"))
+        except ResourceNotFound:
+            exc_thrown = True
+        assert exc_thrown
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -282,6 +436,96 @@ class TestRdbmsStore:
         group = await group_store.get_by_id(group_id)
         assert len(users) == len(group.get("members"))
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_add_users_to_group_in_batch(rdbms_stores, single_group, users):
+        user_store, group_store = rdbms_stores
+        _ = await asyncio.gather(*[user_store.create(u) for u in users])
+        res = await group_store.create(single_group)
+        group_id = res.get("id")
+        _ = await group_store.add_users_to_group([u.get("id") for u in users[:2]], group_id)
+        # Existing members are skipped:
+        _ = await group_store.add_users_to_group([u.get("id") for u in users], group_id)
+        group = await group_store.get_by_id(group_id)
+        assert len(users) == len(group.get("members"))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_bulk_create(rdbms_stores, groups, users):
+        user_store, group_store = rdbms_stores
+        _ = await user_store.create(users[0])
+        # Existing users are skipped:
+        assert [None] + [u.get("id") for u in users[1:]] == await user_store.bulk_create(users)
+        user = await user_store.get_by_id(users[-1].get("id"))
+        assert users[-1].get("emails") == user.get("emails")
+
+        groups[0]["id"] = str(uuid.uuid4())
+        groups[0]["members"] = [{"value": u.get("id")} for u in users]
+        assert all(await group_store.bulk_create(groups))
+        assert not any(await group_store.bulk_create(groups))
+        group = await group_store.get_by_id(groups[0]["id"])
+        assert len(users) == len(group.get("members"))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_scan(rdbms_stores, single_group, users):
+        user_store, group_store = rdbms_stores
+        _ = await user_store.bulk_create(users)
+        single_group["members"] = [{"value": u.get("id")} for u in users]
+        _ = await group_store.create(single_group)
+        scanned_users = [u async for u in user_store.scan(batch_size=2)]
+        assert sorted([u.get("id") for u in users]) == sorted([u.get("id") for u in scanned_users])
+        assert all([len(u.get("emails")) == 1 and len(u.get("groups")) == 1 for u in scanned_users])
+        # Scans resume after an ID:
+        after = scanned_users[1].get("id")
+        assert [u.get("id") for u in scanned_users[2:]] == [u.get("id") async for u in user_store.scan(2, after)]
+        scanned_groups = [g async for g in group_store.scan(batch_size=2)]
+        assert 1 == len(scanned_groups)
+        assert len(users) == len(scanned_groups[0].get("members"))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_projection(rdbms_stores, single_group, users):
+        user_store, group_store = rdbms_stores
+        _ = await user_store.bulk_create(users)
+        single_group["members"] = [{"value": u.get("id")} for u in users]
+        group_id = (await group_store.create(single_group)).get("id")
+
+        user = await user_store.get_by_id(users[0].get("id"), attributes=["userName", "emails.value"])
+        assert {"id", "schemas", "userName", "emails"} == set(user.keys())
+        assert [{"value": users[0].get("emails")[0].get("value")}] == user.get("emails")
+        res, _ = await user_store.search(_filter=None, excluded_attributes=["groups", "emails"])
+        assert len(users) == len(res)
+        assert all(["groups" not in u and "emails" not in u and "userName" in u for u in res])
+
+        group = await group_store.get_by_id(group_id, excluded_attributes=["members"])
+        assert "members" not in group and single_group.get("displayName") == group.get("displayName")
+        res, _ = await group_store.search(_filter=None, attributes=["members"])
+        assert {"id", "members"} == set(res[0].keys())
+        assert len(users) == len(res[0].get("members"))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_get_members(rdbms_stores, single_group, users, rand_id):
+        user_store, group_store = rdbms_stores
+        _ = await user_store.bulk_create(users)
+        single_group["members"] = [{"value": u.get("id")} for u in users]
+        group_id = (await group_store.create(single_group)).get("id")
+        user_ids = sorted([u.get("id") for u in users])
+
+        members, total = await group_store.get_members(group_id, start_index=2, count=2)
+        assert len(users) == total
+        assert user_ids[1:3] == [m.get("value") for m in members]
+        members, total = await group_store.get_members(group_id, start_index=len(users) + 1, count=2)
+        assert len(users) == total and 0 == len(members)
+        with pytest.raises(ResourceNotFound):
+            _ = await group_store.get_members(rand_id)
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -324,6 +568,65 @@ class TestRdbmsStore:
         group = await group_store.get_by_id(group_id)
         assert len(users) - 2 == len(group.get("members"))
 
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_patch_group(rdbms_stores, single_group, users, rand_id):
+        user_store, group_store = rdbms_stores
+        _ = await asyncio.gather(*[user_store.create(u) for u in users])
+        single_group["members"] = [{"value": u.get("id")} for u in users[:2]]
+        res = await group_store.create(single_group)
+        group_id = res.get("id")
+        _ = await group_store.patch_group(
+            group_id,
+            attributes={"id": rand_id, "displayName": "Renamed"},
+            members_to_add=[{"value": u.get("id")} for u in users[1:3]],
+            member_ids_to_remove=[users[0].get("id")],
+        )
+        group = await group_store.get_by_id(group_id)
+        assert "Renamed" == group.get("displayName")
+        assert {u.get("id") for u in users[1:3]} == {m.get("value") for m in group.get("members")}
+
+        _ = await group_store.patch_group(group_id, {}, [], [], members=[{"value": users[-1].get("id")}])
+        group = await group_store.get_by_id(group_id)
+        assert [users[-1].get("id")] == [m.get("value") for m in group.get("members")]
+
+        exc_thrown = False
+        try:
+            _ = await group_store.patch_group(rand_id, {}, [{"value": users[0].get("id")}], [])
+        except ResourceNotFound:
+            exc_thrown = True
+        assert exc_thrown
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_watch_changes(rdbms_stores, single_group, users):
+        user_store, group_store = rdbms_stores
+        store_module = postgresql_store if isinstance(user_store, PostgresqlStore) else mysql_store
+        store_module.set_up_schema(change_notifications=True, **user_store.conn_args)
+        changes, ready = [], asyncio.Event()
+        watch = asyncio.ensure_future(
+            store_module.watch_changes(changes.append, ready.set, poll_interval=0.05, **user_store.conn_args)
+        )
+        try:
+            await asyncio.wait_for(ready.wait(), 5)
+            user = await user_store.create(users[0])
+            group = await group_store.create({**single_group, "members": [{"value": user.get("id")}]})
+            _ = await user_store.delete(user.get("id"))
+            for _ in range(50):
+                if {"type": "users", "id": user.get("id")} in changes and \
+                        {"type": "groups", "id": group.get("id"), "members": [user.get("id")]} in changes:
+                    break
+                await asyncio.sleep(0.1)
+            assert {"type": "users", "id": user.get("id")} in changes
+            assert {"type": "groups", "id": group.get("id")} in changes
+            assert {"type": "groups", "id": group.get("id"), "members": [user.get("id")]} in changes
+        finally:
+            watch.cancel()
+            _ = await asyncio.gather(watch, return_exceptions=True)
+            store_module.set_up_schema(change_notifications=False, **user_store.conn_args)
+
     @staticmethod
     @pytest.mark.asyncio
     @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
@@ -355,3 +658,72 @@ class TestRdbmsStore:
         assert 1 == count
         assert "Human Resources" == res[0].get("displayName")
 
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_writes_increment_versions(rdbms_stores, users, single_group):
+        user_store, group_store = rdbms_stores
+        for u in users:
+            _ = await user_store.create(u)
+        user_id = users[0].get("id")
+        assert 'W/"1"' == (await user_store.get_by_id(user_id))["meta"]["version"]
+        user = await user_store.update(user_id, **{**users[0], "displayName": "Updated", "version": 100})
+        assert 'W/"2"' == user["meta"]["version"] == await user_store.get_version(user_id)
+
+        group_id = (await group_store.create({**single_group, "members": []})).get("id")
+        _ = await group_store.add_users_to_group([u.get("id") for u in users], group_id)
+        _ = await group_store.patch_group(group_id, {}, [], [user_id])
+        assert 'W/"3"' == await group_store.get_version(group_id)
+        # Deleting a user changes the members of its groups:
+        _ = await user_store.delete(users[1].get("id"))
+        assert 'W/"4"' == (await group_store.get_by_id(group_id, attributes=["meta.version"]))["meta"]["version"]
+
+        exc_thrown = False
+        try:
+            _ = await group_store.get_version(str(uuid.uuid4()))
+        except ResourceNotFound:
+            exc_thrown = True
+        assert exc_thrown
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_writes_of_stale_versions_fail(rdbms_stores, single_user, single_group):
+        user_store, group_store = rdbms_stores
+        user_id = (await user_store.create(single_user)).get("id")
+        group_id = (await group_store.create({**single_group, "members": []})).get("id")
+        user = await user_store.update(user_id, expected_version='W/"1"', **{**single_user, "displayName": "New"})
+        assert 'W/"2"' == user["meta"]["version"]
+        _ = await group_store.patch_group(group_id, {"displayName": "Patched"}, [], [], expected_version='W/"1"')
+        writes = [
+            user_store.update(user_id, expected_version='W/"1"', **{**single_user, "displayName": "Stale"}),
+            user_store.delete(user_id, expected_version='W/"1"'),
+            group_store.update(group_id, expected_version='W/"1"', displayName="Stale"),
+            group_store.patch_group(group_id, {"displayName": "Stale"}, [], [], expected_version='W/"1"'),
+            group_store.delete(group_id, expected_version='W/"1"'),
+        ]
+        for write in writes:
+            exc_thrown = False
+            try:
+                _ = await write
+            except PreconditionFailed as e:
+                exc_thrown = True
+                assert 'W/"2"' == e.version
+            assert exc_thrown
+        assert "New" == (await user_store.get_by_id(user_id)).get("displayName")
+        assert "Patched" == (await group_store.get_by_id(group_id)).get("displayName")
+        _ = await user_store.delete(user_id, expected_version='W/"2"')
+        _ = await group_store.delete(group_id, expected_version='W/"2"')
+
+    @staticmethod
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("rdbms_stores", ["postgresql", "mysql"], indirect=["rdbms_stores"])
+    async def test_renaming_user_increments_group_versions(rdbms_stores, single_user, single_group):
+        user_store, group_store = rdbms_stores
+        user_id = (await user_store.create(single_user)).get("id")
+        group_id = (await group_store.create({**single_group, "members": [{"value": user_id}]})).get("id")
+        _ = await user_store.update(user_id, **{**single_user, "displayName": "Updated"})
+        assert 'W/"1"' == await group_store.get_version(group_id)
+        _ = await user_store.update(user_id, **{**single_user, "userName": single_user["userName"].upper()})
+        assert 'W/"2"' == await group_store.get_version(group_id)
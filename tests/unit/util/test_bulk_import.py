@@ -0,0 +1,67 @@
+import io
+import json
+
+import pytest
+
+from keystone_scim.store.memory_store import MemoryStore
+from keystone_scim.util.bulk_import import import_resources, read_csv, read_ndjson
+
+
+class TestBulkImport:
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_read_ndjson(users):
+        stream = io.StringIO("\n".join([json.dumps(u) for u in users]) + "\n\n")
+        assert users == list(read_ndjson(stream))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_read_ndjson_fails_on_invalid_line():
+        stream = io.StringIO("{}\n{\n")
+        exc_thrown = False
+        try:
+            _ = list(read_ndjson(stream))
+        except ValueError as e:
+            exc_thrown = "line 2" in str(e)
+        assert exc_thrown
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_read_csv():
+        stream = io.StringIO(
+            "id,userName,name.givenName,name.familyName,active,emails,locale\n"
+            "1,jdoe@company.com,John,Doe,true,\"[{\"\"value\"\": \"\"jdoe@company.com\"\"}]\",\n"
+        )
+        user = next(read_csv(stream))
+        assert {
+            "id": "1",
+            "userName": "jdoe@company.com",
+            "name": {"givenName": "John", "familyName": "Doe"},
+            "active": True,
+            "emails": [{"value": "jdoe@company.com"}],
+        } == user
+        # Only boolean attributes are read as booleans:
+        stream = io.StringIO("id,userName,displayName,active\n2,True,false,FALSE\n")
+        assert {"id": "2", "userName": "True", "displayName": "false", "active": False} == next(read_csv(stream))
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_import_resources(users, groups):
+        user_store = MemoryStore("User")
+        group_store = MemoryStore("Group", name_uniqueness=True, nested_store_attr="members")
+        groups[0]["members"] = [{"value": u["id"], "display": u["userName"]} for u in users]
+        progress_reports = []
+        progress = await import_resources(
+            user_store, group_store, iter(groups + users), batch_size=2, on_progress=progress_reports.append
+        )
+        assert len(users) == progress.created["users"] == len(user_store.resource_db)
+        assert len(groups) == progress.created["groups"] == len(group_store.resource_db)
+        assert len(progress_reports) > 0
+        imported_groups, _ = await group_store.search(f"displayName eq \"{groups[0]['displayName']}\"")
+        assert len(users) == len(imported_groups[0]["members"])
+
+        # Re-running the import skips existing resources:
+        progress = await import_resources(user_store, group_store, iter(users + groups), batch_size=2)
+        assert 0 == progress.created["users"] == progress.created["groups"]
+        assert len(users) == progress.skipped["users"]
@@ -0,0 +1,44 @@
+import pytest
+
+from keystone_scim.util import json_codec
+
+
+class TestJsonCodec:
+
+    @staticmethod
+    def test_get_codec():
+        assert "json" == json_codec.get_codec("json").name
+        assert json_codec.get_codec("auto").name in json_codec.CODECS
+        exc_thrown = False
+        try:
+            _ = json_codec.get_codec("yaml")
+        except ValueError:
+            exc_thrown = True
+        assert exc_thrown
+
+    @staticmethod
+    def test_codecs_agree(single_user):
+        try:
+            codecs = [json_codec.get_codec(name) for name in json_codec.CODECS]
+        except ImportError:
+            pytest.skip("orjson is not installed")
+        resource = {**single_user, "displayName": "Zoë Ünïcode", "meta": {"version": 'W/"1"'}}
+        for codec in codecs:
+            assert resource == codec.loads(codec.dumps(resource))
+            assert resource == codec.loads(codec.dumpb(resource))
+            assert {"1": 1} == codec.loads(codec.dumps({1: 1}))
+        assert codecs[0].loads(codecs[1].dumpb(resource)) == codecs[1].loads(codecs[0].dumpb(resource))
+
+    @staticmethod
+    def test_json_response():
+        current = json_codec.CODEC.name
+        try:
+            codec = json_codec.set_codec("json")
+            assert json_codec.dumps is codec.dumps
+            response = json_codec.json_response({"userName": "Zoë"}, status=201, headers={"ETag": 'W/"1"'})
+            assert 201 == response.status
+            assert "application/json" == response.content_type and "utf-8" == response.charset
+            assert 'W/"1"' == response.headers["ETag"]
+            assert {"userName": "Zoë"} == json_codec.loads(response.body)
+        finally:
+            json_codec.set_codec(current)
@@ -0,0 +1,32 @@
+from keystone_scim.util.projection import Projection, parse_attribute_list
+
+
+class TestProjection:
+
+    @staticmethod
+    def test_parse_attribute_list():
+        assert ["userName", "name.givenName"] == parse_attribute_list(" userName, name.givenName ,")
+        assert parse_attribute_list("") is None
+        assert parse_attribute_list(None) is None
+
+    @staticmethod
+    def test_attributes(single_user):
+        projection = Projection(["USERNAME", "urn:ietf:params:scim:schemas:core:2.0:User:name.givenName"])
+        projected = projection.apply(single_user)
+        assert {"id", "schemas", "userName", "name"} == set(projected.keys())
+        assert {"givenName"} == set(projected["name"].keys())
+        assert projection.includes("name") and not projection.includes("emails")
+
+    @staticmethod
+    def test_excluded_attributes(single_user):
+        projection = Projection(excluded_attributes=["emails.type", "name", "id"])
+        projected = projection.apply(single_user)
+        assert "name" not in projected and "id" in projected
+        assert all(["type" not in e and "value" in e for e in projected["emails"]])
+        assert projection.includes("emails") and not projection.includes("name")
+
+    @staticmethod
+    def test_identity(single_user):
+        projection = Projection()
+        assert projection.is_identity
+        assert single_user == projection.apply(single_user)
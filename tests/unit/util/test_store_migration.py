@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from keystone_scim.store.memory_store import MemoryStore
+from keystone_scim.util.store_migration import Checkpoint, load_target_stores, migrate, verify
+
+
+def _memory_stores(users=None, groups=None):
+    return (
+        MemoryStore("User", resources=users),
+        MemoryStore("Group", name_uniqueness=True, resources=groups, nested_store_attr="members"),
+    )
+
+
+class TestStoreMigration:
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_migrate_and_verify(users, groups, tmp_path):
+        source = _memory_stores()
+        groups[0]["members"] = [{"value": u["id"], "display": u["userName"]} for u in users]
+        _ = await source[0].bulk_create(users)
+        _ = await source[1].bulk_create(groups)
+        target = _memory_stores()
+        checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+
+        created = await migrate(source, target, checkpoint, batch_size=2, concurrency=2)
+        assert {"users": len(users), "groups": len(groups)} == created
+        last_ids = {"users": max(source[0].resource_db.keys()), "groups": max(source[1].resource_db.keys())}
+        assert last_ids == json.loads((tmp_path / "checkpoint.json").read_text())
+        # IDs and memberships are preserved:
+        source_group = [g async for g in source[1].scan() if g["displayName"] == groups[0]["displayName"]][0]
+        target_group = await target[1].get_by_id(source_group["id"])
+        assert {u["id"] for u in users} == {m["value"] for m in target_group["members"]}
+
+        report = await verify(source, target)
+        assert all([res["match"] for res in report.values()])
+
+        _ = await target[0].update(users[0]["id"], displayName="Changed")
+        report = await verify(source, target)
+        assert not report["users"]["match"]
+        assert report["groups"]["match"]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_migrate_resumes_from_checkpoint(users, tmp_path):
+        source = _memory_stores()
+        _ = await source[0].bulk_create(users)
+        target = _memory_stores()
+        user_ids = sorted([u["id"] for u in users])
+        checkpoint_path = tmp_path / "checkpoint.json"
+        checkpoint_path.write_text(json.dumps({"users": user_ids[1], "groups": None}))
+        # Deleting a resource before the checkpoint doesn't shift the rest of the scan:
+        _ = await source[0].delete(user_ids[0])
+
+        created = await migrate(source, target, Checkpoint(str(checkpoint_path)), batch_size=2)
+        assert len(users) - 2 == created["users"]
+        assert set(user_ids[2:]) == set(target[0].resource_db.keys())
+        assert user_ids[-1] == json.loads(checkpoint_path.read_text())["users"]
+
+    @staticmethod
+    @pytest.mark.asyncio
+    async def test_target_postgresql_schema_must_match(tmp_path):
+        config_path = tmp_path / "target.yaml"
+        config_path.write_text("store:\n  pg:\n    host: localhost\n    schema: another_schema\n")
+        exc_thrown = False
+        try:
+            _ = await load_target_stores(str(config_path))
+        except ValueError:
+            exc_thrown = True
+        assert exc_thrown